@@ -1,29 +1,20 @@
 const express = require('express');
 const path = require('path');
-const fs = require('fs');
 const multer = require('multer');
 
 const app = express();
 const port = process.env.PORT || 3000;
+// Python inference service (src/scripts/inference_server.py), e.g. http://127.0.0.1:8000
+const inferenceUrl = process.env.INFERENCE_URL;
 
-// Ensure uploads directory exists
-const uploadsDir = path.join(__dirname, 'uploads');
-if (!fs.existsSync(uploadsDir)) {
-  fs.mkdirSync(uploadsDir, { recursive: true });
-}
-
-// Multer storage configuration
-const storage = multer.diskStorage({
-  destination: (req, file, cb) => cb(null, uploadsDir),
-  filename: (req, file, cb) => {
-    const ext = path.extname(file.originalname);
-    const base = path.basename(file.originalname, ext).replace(/\s+/g, '_');
-    cb(null, `${Date.now()}_${base}${ext}`);
-  }
-});
+// Keep uploads in memory so they can be forwarded to the model without a disk round-trip
+const storage = multer.memoryStorage();
+// Same cap as MAX_UPLOAD_BYTES in inference_server.py, enforced before a file is fully buffered
+const MAX_UPLOAD_BYTES = 64 * 1024 * 1024;
 
 const upload = multer({
   storage,
+  limits: { fileSize: MAX_UPLOAD_BYTES },
   fileFilter: (req, file, cb) => {
     // Accept only image files
     if (!file.mimetype.startsWith('image/')) return cb(new Error('Only image files are allowed'));
@@ -63,9 +54,30 @@ app.get('/how-it-works.html', (req, res) => {
 });
 
 // Endpoint to receive an uploaded image. Field name: 'image'
-app.post('/upload', upload.single('image'), (req, res) => {
+app.post('/upload', upload.single('image'), async (req, res) => {
   if (!req.file) return res.status(400).json({ error: 'No file uploaded' });
 
+  if (inferenceUrl) {
+    try {
+      const response = await fetch(`${inferenceUrl}/analyze`, {
+        method: 'POST',
+        headers: { 'Content-Type': req.file.mimetype },
+        body: req.file.buffer
+      });
+      const result = await response.json();
+      if (!response.ok) return res.status(response.status).json({ error: result.error || 'Inference failed' });
+
+      return res.json({
+        filename: req.file.originalname,
+        message: null,
+        prediction: result.analysis,
+        language: req.preferredLanguage
+      });
+    } catch (err) {
+      return res.status(502).json({ error: `Inference service unavailable: ${err.message}` });
+    }
+  }
+
   // Get language-specific messages
   const messages = {
     en: 'File received. AI classification not implemented yet. This is a placeholder response.',
@@ -74,7 +86,7 @@ app.post('/upload', upload.single('image'), (req, res) => {
 
   // Placeholder response: real AI classification will be implemented later
   res.json({
-    filename: req.file.filename,
+    filename: req.file.originalname,
     message: messages[req.preferredLanguage] || messages.en,
     prediction: null,
     language: req.preferredLanguage
@@ -84,7 +96,8 @@ app.post('/upload', upload.single('image'), (req, res) => {
 // Basic error handler for upload errors
 app.use((err, req, res, next) => {
   if (err) {
-    return res.status(400).json({ error: err.message || 'Server error' });
+    const status = err.code === 'LIMIT_FILE_SIZE' ? 413 : 400;
+    return res.status(status).json({ error: err.message || 'Server error' });
   }
   next();
 });
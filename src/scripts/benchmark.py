@@ -0,0 +1,563 @@
+"""
+benchmark.py
+End-to-end benchmarks for the data preparation pipeline and inference.
+
+Everything runs offline on CPU against synthetic fixtures generated in a temporary
+directory: DICOMs (12/16-bit, MONOCHROME1/2, with and without window tags), an
+annotation CSV, translated-findings rows with matching JPGs, and a tiny randomly
+initialised vision-language model built from a local processor/config directory
+(the fine-tuned checkpoint by default). Without that directory a small LFM2-VL
+config and processor with a byte-level BPE tokenizer trained on the answer
+templates are built in code, so the model stages also run on a bare checkout.
+
+Results are written as JSON and can be compared against a stored baseline:
+
+    python benchmark.py --output results.json --save_baseline
+    python benchmark.py --output results.json      # exits 1 on regression
+"""
+
+import argparse
+import contextlib
+import csv
+import io
+import json
+import multiprocessing
+import os
+import platform
+import random
+import statistics
+import sys
+import tempfile
+import time
+from concurrent.futures import ProcessPoolExecutor
+from pathlib import Path
+
+import numpy as np
+from PIL import Image
+
+SCRIPT_DIR = Path(__file__).resolve().parent
+PROJECT_ROOT = SCRIPT_DIR.parent.parent
+DEFAULT_BASELINE_PATH = SCRIPT_DIR / "benchmark_baseline.json"
+DEFAULT_PROCESSOR_PATH = PROJECT_ROOT / "models" / "mamography-finetune-8" / "merged_model"
+DEFAULT_REPEATS = 3
+DEFAULT_TOLERANCE = 0.25
+RANDOM_SEED = 42
+
+DICOM_VARIANTS = [
+    # (bits_stored, photometric_interpretation, with_window_tags)
+    (12, "MONOCHROME2", True),
+    (12, "MONOCHROME1", False),
+    (16, "MONOCHROME2", False),
+    (16, "MONOCHROME1", True),
+]
+DICOM_SHAPE = (512, 416)
+# Small enough that the synthetic DICOMs are decoded in several strips
+DICOM_MEMORY_BUDGET_BYTES = 1 << 20
+NUM_CSV_ROWS = 200
+NUM_ANNOTATION_ROWS = 20_000
+NUM_MODEL_IMAGES = 2
+
+# Shrunk sizes for the random model; only attributes present on the config are touched
+TINY_TEXT_CONFIG = {
+    "hidden_size": 64,
+    "intermediate_size": 128,
+    "block_ff_dim": 128,
+    "num_hidden_layers": 2,
+    "num_attention_heads": 2,
+    "num_key_value_heads": 1,
+}
+TINY_VISION_CONFIG = {
+    "hidden_size": 32,
+    "intermediate_size": 64,
+    "num_hidden_layers": 1,
+    "num_attention_heads": 2,
+}
+# Tokenizer and image processor of the processor built when no checkpoint is available
+TINY_VOCAB_SIZE = 1200
+TINY_SPECIAL_TOKENS = [
+    "<|startoftext|>", "<|im_start|>", "<|im_end|>", "<|pad|>",
+    "<image>", "<|image_start|>", "<|image_end|>", "<|img_thumbnail|>",
+]
+TINY_CHAT_TEMPLATE = (
+    "{{ '<|startoftext|>' }}{% for message in messages %}{{ '<|im_start|>' + message['role'] + '\\n' }}"
+    "{% if message['content'] is string %}{{ message['content'] }}{% else %}{% for item in message['content'] %}"
+    "{% if item['type'] == 'image' %}{{ '<image>' }}{% elif item['type'] == 'text' %}{{ item['text'] }}{% endif %}"
+    "{% endfor %}{% endif %}{{ '<|im_end|>\\n' }}{% endfor %}"
+    "{% if add_generation_prompt %}{{ '<|im_start|>assistant\\n' }}{% endif %}"
+)
+TINY_IMAGE_PROCESSOR = {
+    "do_image_splitting": False,
+    "min_image_tokens": 16,
+    "max_image_tokens": 32,
+    "max_num_patches": 128,
+}
+
+
+def get_arguments():
+    """Parses command-line arguments."""
+    parser = argparse.ArgumentParser(description="Benchmark data preparation and inference stages.")
+    parser.add_argument("--output", type=Path, default=None, help="Write JSON results here (stdout if omitted).")
+    parser.add_argument("--baseline", type=Path, default=DEFAULT_BASELINE_PATH, help=f"Baseline JSON. Defaults to {DEFAULT_BASELINE_PATH}")
+    parser.add_argument("--save_baseline", action="store_true", help="Overwrite the baseline with these results.")
+    parser.add_argument("--tolerance", type=float, default=DEFAULT_TOLERANCE, help=f"Allowed relative slowdown before a stage is flagged. Defaults to {DEFAULT_TOLERANCE}")
+    parser.add_argument("--repeats", type=int, default=DEFAULT_REPEATS, help=f"Timed repeats per stage. Defaults to {DEFAULT_REPEATS}")
+    parser.add_argument("--processor_path", type=Path, default=DEFAULT_PROCESSOR_PATH, help="Local directory with the model config and processor files used to build the tiny model. A small one is built in code if it does not exist.")
+    parser.add_argument("--skip_model", action="store_true", help="Skip the inference stages.")
+    return parser.parse_args()
+
+
+# --- Synthetic fixtures ---
+
+def make_breast_phantom(rows, cols, max_value, rng):
+    """
+    Returns a uint16 image with a half-ellipse of noisy 'tissue' against a black
+    background, roughly the layout of a mammogram.
+    """
+    y, x = np.mgrid[0:rows, 0:cols].astype(np.float32)
+    center_y, radius_y, radius_x = rows / 2, rows * 0.45, cols * 0.7
+    inside = ((y - center_y) / radius_y) ** 2 + (x / radius_x) ** 2 <= 1.0
+    tissue = 0.4 + 0.3 * rng.random((rows, cols), dtype=np.float32)
+    image = np.where(inside, tissue, 0.0) * max_value
+    return image.astype(np.uint16)
+
+
+def write_synthetic_dicom(path, bits_stored, photometric, with_window, rng, shape=DICOM_SHAPE):
+    """Writes a single-frame digital mammography DICOM with synthetic pixel data."""
+    import pydicom
+    from pydicom.dataset import FileDataset, FileMetaDataset
+    from pydicom.uid import ExplicitVRLittleEndian, generate_uid
+
+    sop_class_uid = "1.2.840.10008.5.1.4.1.1.1.2"  # Digital Mammography X-Ray Image Storage - For Presentation
+    file_meta = FileMetaDataset()
+    file_meta.MediaStorageSOPClassUID = sop_class_uid
+    file_meta.MediaStorageSOPInstanceUID = generate_uid()
+    file_meta.TransferSyntaxUID = ExplicitVRLittleEndian
+
+    ds = FileDataset(str(path), {}, file_meta=file_meta, preamble=b"\0" * 128)
+    ds.SOPClassUID = sop_class_uid
+    ds.SOPInstanceUID = file_meta.MediaStorageSOPInstanceUID
+    ds.Modality = "MG"
+    ds.Rows, ds.Columns = shape
+    ds.SamplesPerPixel = 1
+    ds.PhotometricInterpretation = photometric
+    ds.BitsAllocated = 16
+    ds.BitsStored = bits_stored
+    ds.HighBit = bits_stored - 1
+    ds.PixelRepresentation = 0
+
+    max_value = 2 ** bits_stored - 1
+    pixels = make_breast_phantom(shape[0], shape[1], max_value, rng)
+    if photometric == "MONOCHROME1":
+        pixels = (max_value - pixels).astype(np.uint16)
+    if with_window:
+        ds.WindowCenter = max_value // 2
+        ds.WindowWidth = max_value
+    ds.PixelData = pixels.tobytes()
+
+    if int(pydicom.__version__.split(".")[0]) < 3:
+        ds.is_little_endian = True
+        ds.is_implicit_VR = False
+    ds.save_as(str(path))
+
+
+def write_synthetic_annotations(path, num_rows, rng):
+    """Writes a VinDr-style breast-level annotation CSV."""
+    birads = ["BI-RADS 1", "BI-RADS 2", "BI-RADS 3", "BI-RADS 4", "BI-RADS 5"]
+    densities = ["DENSITY A", "DENSITY B", "DENSITY C", "DENSITY D"]
+    with open(path, "w", newline="", encoding="utf-8") as f:
+        writer = csv.writer(f)
+        writer.writerow(["study_id", "series_id", "image_id", "laterality", "view_position",
+                         "height", "width", "breast_birads", "breast_density", "split"])
+        for i in range(num_rows):
+            study_id = f"{i // 4:08x}"
+            laterality = "L" if i % 2 else "R"
+            view = "MLO" if (i // 2) % 2 else "CC"
+            writer.writerow([study_id, f"s{study_id}", f"{i:012x}", laterality, view, 3518, 2800,
+                             birads[rng.integers(len(birads))], densities[rng.integers(len(densities))],
+                             "training"])
+
+
+def make_translated_rows(images_dir, num_rows, rng):
+    """Creates translated-findings CSV rows plus a matching JPG for each one."""
+    images_dir.mkdir(parents=True, exist_ok=True)
+    thumbnail = Image.fromarray((make_breast_phantom(64, 48, 255, rng)).astype(np.uint8))
+    rows = []
+    for i in range(num_rows):
+        file_id = str(20_000_000 + i)
+        laterality = "L" if i % 2 else "R"
+        view = "MLO" if (i // 2) % 2 else "CC"
+        thumbnail.save(images_dir / f"{file_id}_{i:016x}_MG_{laterality}_{view}_ANON.jpg")
+        rows.append({
+            "File Name": file_id,
+            "Findings Notes (English)": "nodule in the upper outer quadrant with associated microcalcifications",
+            "ACR": str(rng.integers(1, 5)),
+            "Bi-Rads": str(rng.integers(1, 6)),
+        })
+    return rows
+
+
+def build_tiny_model(processor_path, output_dir):
+    """
+    Saves a randomly initialised, shrunk copy of the model architecture described
+    by processor_path's config, together with its processor, into output_dir.
+    """
+    import torch
+    from transformers import AutoConfig, AutoModelForImageTextToText, AutoProcessor
+
+    config = AutoConfig.from_pretrained(processor_path, trust_remote_code=True)
+    for sub_config_name, overrides in (("text_config", TINY_TEXT_CONFIG), ("vision_config", TINY_VISION_CONFIG)):
+        sub_config = getattr(config, sub_config_name, None)
+        if sub_config is None:
+            continue
+        for key, value in overrides.items():
+            if hasattr(sub_config, key):
+                setattr(sub_config, key, value)
+        layer_types = getattr(sub_config, "layer_types", None)
+        if layer_types:
+            sub_config.layer_types = list(layer_types)[:sub_config.num_hidden_layers]
+    if hasattr(config, "projector_hidden_size"):
+        config.projector_hidden_size = TINY_TEXT_CONFIG["hidden_size"]
+
+    torch.manual_seed(RANDOM_SEED)
+    model = AutoModelForImageTextToText.from_config(config, trust_remote_code=True)
+    model.save_pretrained(output_dir)
+    AutoProcessor.from_pretrained(processor_path, trust_remote_code=True).save_pretrained(output_dir)
+
+
+def build_tiny_draft_model(model_dir, output_dir):
+    """Saves a randomly initialised text-only causal LM with model_dir's text config as a draft model."""
+    import torch
+    from transformers import AutoConfig, AutoModelForCausalLM
+
+    text_config = AutoConfig.from_pretrained(model_dir, trust_remote_code=True).text_config
+    torch.manual_seed(RANDOM_SEED + 1)
+    AutoModelForCausalLM.from_config(text_config).save_pretrained(output_dir)
+
+
+def build_tiny_processor(output_dir):
+    """
+    Saves an LFM2-VL config and processor into output_dir for build_tiny_model,
+    for when the fine-tuned checkpoint is not available. The tokenizer is a small
+    byte-level BPE trained on the rendered answer templates and the default prompt.
+    """
+    from tokenizers import Tokenizer, decoders, models, pre_tokenizers, trainers
+    from transformers import Lfm2VlConfig, Lfm2VlImageProcessor, Lfm2VlProcessor, PreTrainedTokenizerFast
+
+    from model import DEFAULT_PROMPT
+    from template_drafting import render_template_corpus
+
+    tokenizer = Tokenizer(models.BPE())
+    tokenizer.pre_tokenizer = pre_tokenizers.ByteLevel(add_prefix_space=False)
+    tokenizer.decoder = decoders.ByteLevel()
+    trainer = trainers.BpeTrainer(
+        vocab_size=TINY_VOCAB_SIZE, special_tokens=TINY_SPECIAL_TOKENS,
+        initial_alphabet=pre_tokenizers.ByteLevel.alphabet(),
+    )
+    tokenizer.train_from_iterator(render_template_corpus() + [DEFAULT_PROMPT, "system user assistant"], trainer)
+    fast_tokenizer = PreTrainedTokenizerFast(
+        tokenizer_object=tokenizer, bos_token="<|startoftext|>", eos_token="<|im_end|>",
+        pad_token="<|pad|>", chat_template=TINY_CHAT_TEMPLATE,
+    )
+    processor = Lfm2VlProcessor(
+        image_processor=Lfm2VlImageProcessor(**TINY_IMAGE_PROCESSOR),
+        tokenizer=fast_tokenizer, chat_template=TINY_CHAT_TEMPLATE,
+    )
+    processor.save_pretrained(output_dir)
+
+    config = Lfm2VlConfig()
+    config.text_config.vocab_size = len(fast_tokenizer)
+    config.text_config.eos_token_id = fast_tokenizer.eos_token_id
+    config.image_token_id = fast_tokenizer.convert_tokens_to_ids("<image>")
+    config.save_pretrained(output_dir)
+
+
+# --- Timing ---
+
+def time_stage(func, repeats, setup=None):
+    """Runs func `repeats` times (after optional per-run setup) and returns timing stats."""
+    durations = []
+    for _ in range(repeats):
+        if setup is not None:
+            setup()
+        start = time.perf_counter()
+        with contextlib.redirect_stdout(io.StringIO()):
+            func()
+        durations.append(time.perf_counter() - start)
+    return {
+        "median_s": statistics.median(durations),
+        "min_s": min(durations),
+        "max_s": max(durations),
+        "repeats": repeats,
+    }
+
+
+def run_data_benchmarks(workdir, repeats, results):
+    import logging
+
+    import convert_dicom
+    import create_jsonl
+    import sampler
+
+    # The pipeline scripts log every file; keep benchmark output readable
+    logging.disable(logging.INFO)
+    rng = np.random.default_rng(RANDOM_SEED)
+
+    dicom_dir = workdir / "dicom"
+    jpg_dir = workdir / "jpg"
+    dicom_dir.mkdir()
+    jpg_dir.mkdir()
+    for bits, photometric, with_window in DICOM_VARIANTS:
+        name = f"{bits}bit_{photometric}_{'window' if with_window else 'nowindow'}"
+        dicom_path = dicom_dir / f"{name}.dcm"
+        jpg_path = jpg_dir / f"{name}.jpg"
+        write_synthetic_dicom(dicom_path, bits, photometric, with_window, rng)
+        results[f"convert_dicom_to_jpg[{name}]"] = time_stage(
+            lambda: convert_dicom.convert_dicom_to_jpg(str(dicom_path), str(jpg_path)), repeats
+        )
+        results[f"convert_dicom_to_jpg[{name},bounded]"] = time_stage(
+            lambda: convert_dicom.convert_dicom_to_jpg(
+                str(dicom_path), str(jpg_path), memory_budget=DICOM_MEMORY_BUDGET_BYTES
+            ),
+            repeats,
+        )
+
+    images_dir = workdir / "images_jpg"
+    rows = make_translated_rows(images_dir, NUM_CSV_ROWS, rng)
+    missing_test_dir = workdir / "test-set" / "images"
+    results["find_matching_image"] = time_stage(
+        lambda: create_jsonl.find_matching_image(rows[-1]["File Name"], images_dir, missing_test_dir), repeats
+    )
+    results["process_rows"] = time_stage(
+        lambda: create_jsonl.process_rows(rows, images_dir, missing_test_dir), repeats
+    )
+    entries = create_jsonl.process_rows(rows, images_dir, missing_test_dir)
+    results["write_jsonl_file"] = time_stage(
+        lambda: create_jsonl.write_jsonl_file(entries, workdir / "dataset.jsonl"), repeats
+    )
+
+    annotations_path = workdir / "breast-level_annotations.csv"
+    write_synthetic_annotations(annotations_path, NUM_ANNOTATION_ROWS, rng)
+    image_list_path = workdir / "image_list.txt"
+    results["sampler.create_image_list_from_csv[no_cache]"] = time_stage(
+        lambda: sampler.create_image_list_from_csv(annotations_path, image_list_path, 1000, RANDOM_SEED, use_cache=False),
+        repeats,
+    )
+    if sampler.HAS_PYARROW:
+        sampler.create_image_list_from_csv(annotations_path, image_list_path, 1000, RANDOM_SEED)
+        results["sampler.create_image_list_from_csv[cached]"] = time_stage(
+            lambda: sampler.create_image_list_from_csv(annotations_path, image_list_path, 1000, RANDOM_SEED),
+            repeats,
+        )
+    results["sampler.create_stratified_image_list"] = time_stage(
+        lambda: sampler.create_stratified_image_list(
+            annotations_path, image_list_path, 100, RANDOM_SEED,
+            stratify_by=["breast_birads"], chunksize=5_000,
+        ),
+        repeats,
+    )
+    # The sample must not depend on how the CSV is chunked
+    results["sampler.create_stratified_image_list"]["same_sample_across_chunk_sizes"] = (
+        sampler.stream_stratified_sample(annotations_path, 100, RANDOM_SEED, ["breast_birads"], chunksize=5_000)
+        == sampler.stream_stratified_sample(annotations_path, 100, RANDOM_SEED, ["breast_birads"], chunksize=777)
+    )
+    logging.disable(logging.NOTSET)
+
+
+def _load_and_measure(model_dir, fast_start):
+    """Subprocess worker: loads one assistant and reports this process's memory use."""
+    import transformers  # noqa: F401  (imported before the baseline is taken)
+    import torch  # noqa: F401
+
+    from inference_metrics import get_peak_rss_bytes
+    from model import MammographyAssistant
+
+    baseline_peak = get_peak_rss_bytes()
+    with contextlib.redirect_stdout(io.StringIO()):
+        assistant = MammographyAssistant(str(model_dir), fast_start=fast_start, warmup=fast_start)
+    peak = get_peak_rss_bytes()
+    return {
+        "peak_rss_bytes": peak,
+        "load_peak_rss_increase_bytes": peak - baseline_peak,
+        "load_rss_increase_bytes": assistant.startup_rss_bytes,
+    }
+
+
+def measure_load_memory(model_dir, fast_start):
+    """
+    Memory used by one MammographyAssistant load, measured in a fresh process:
+    ru_maxrss is a lifetime peak, so loads in the same process would inherit each
+    other's peaks.
+    """
+    context = multiprocessing.get_context("spawn")
+    with ProcessPoolExecutor(max_workers=1, mp_context=context) as pool:
+        return pool.submit(_load_and_measure, model_dir, fast_start).result()
+
+
+def run_model_benchmarks(workdir, processor_path, repeats, results):
+    import torch
+
+    from model import MammographyAssistant
+
+    torch.set_num_threads(max(1, os.cpu_count() or 1))
+    model_dir = workdir / "tiny_model"
+    build_tiny_model(processor_path, model_dir)
+
+    rng = np.random.default_rng(RANDOM_SEED)
+    image_paths = []
+    for i in range(NUM_MODEL_IMAGES):
+        image_path = workdir / f"{30_000_000 + i}_model_MG_L_CC_ANON.jpg"
+        Image.fromarray((make_breast_phantom(512, 416, 255, rng)).astype(np.uint8)).save(image_path)
+        image_paths.append(str(image_path))
+
+    holder = {}
+    results["MammographyAssistant.__init__"] = time_stage(
+        lambda: holder.update(assistant=MammographyAssistant(str(model_dir))), 1
+    )
+    results["MammographyAssistant.__init__[fast_start]"] = time_stage(
+        lambda: holder.update(fast_assistant=MammographyAssistant(str(model_dir), fast_start=True, warmup=True)), 1
+    )
+    for name, fast_start in (("MammographyAssistant.__init__", False), ("MammographyAssistant.__init__[fast_start]", True)):
+        results[name].update(measure_load_memory(model_dir, fast_start))
+    assistant = holder["assistant"]
+    results["analyze_mammogram"] = time_stage(lambda: assistant.analyze_mammogram(image_paths[0]), repeats)
+    results["batch_analyze"] = time_stage(
+        lambda: assistant.batch_analyze(image_paths, csv.writer(io.StringIO())), repeats
+    )
+
+    # Assisted decoding must reproduce greedy output; a random model rarely follows
+    # the templates, so acceptance is also replayed against templated answers
+    speculative_assistant = MammographyAssistant(str(model_dir), speculative=True)
+    results["analyze_mammogram[speculative]"] = time_stage(
+        lambda: speculative_assistant.analyze_mammogram(image_paths[0]), repeats
+    )
+    spec_metrics = speculative_assistant.last_metrics
+    results["analyze_mammogram[speculative]"].update(
+        identical_output=(speculative_assistant.analyze_mammogram(image_paths[0])
+                          == assistant.analyze_mammogram(image_paths[0])),
+        tokens_per_step=spec_metrics.tokens_per_step,
+        draft_tokens=spec_metrics.draft_tokens,
+        accepted_draft_tokens=spec_metrics.accepted_draft_tokens,
+    )
+    results["template_draft_acceptance"] = run_template_acceptance(speculative_assistant)
+
+    # A text-only draft model must not be handed the image inputs, and its steps are counted too
+    draft_model_dir = workdir / "tiny_draft_model"
+    build_tiny_draft_model(model_dir, draft_model_dir)
+    draft_assistant = MammographyAssistant(str(model_dir), draft_model_path=str(draft_model_dir))
+    results["analyze_mammogram[draft_model]"] = time_stage(
+        lambda: draft_assistant.analyze_mammogram(image_paths[0]), repeats
+    )
+    draft_metrics = draft_assistant.last_metrics
+    results["analyze_mammogram[draft_model]"].update(
+        identical_output=(draft_assistant.analyze_mammogram(image_paths[0])
+                          == assistant.analyze_mammogram(image_paths[0])),
+        tokens_per_step=draft_metrics.tokens_per_step,
+        draft_tokens=draft_metrics.draft_tokens,
+        accepted_draft_tokens=draft_metrics.accepted_draft_tokens,
+    )
+
+
+def run_template_acceptance(assistant):
+    """Accepted tokens per verification step if the model produced the training answers verbatim."""
+    import create_jsonl
+    from template_drafting import simulate_acceptance
+
+    rng = random.Random(RANDOM_SEED)
+    tokenizer = assistant.processor.tokenizer
+    answers = []
+    for _ in range(NUM_CSV_ROWS):
+        answer = create_jsonl.create_assistant_response(
+            "nodule in the upper outer quadrant with associated microcalcifications",
+            str(rng.randint(1, 4)), str(rng.randint(1, 6)),
+            rng.randrange(len(create_jsonl.RESPONSE_TEMPLATES)),
+        )
+        answers.append(tokenizer(answer, add_special_tokens=False)["input_ids"])
+    stats = simulate_acceptance(assistant.drafter, answers)
+    return {
+        "answers": len(answers),
+        "tokens_per_step": stats.tokens_per_step,
+        "draft_tokens": stats.draft_tokens,
+        "accepted_draft_tokens": stats.accepted_tokens,
+    }
+
+
+# --- Reporting ---
+
+def compare_to_baseline(results, baseline, tolerance):
+    """Returns a list of (stage, baseline_s, current_s) for stages slower than allowed."""
+    regressions = []
+    for stage, stats in results.items():
+        reference = baseline.get(stage)
+        if not reference or "median_s" not in stats:
+            continue
+        if stats["median_s"] > reference["median_s"] * (1 + tolerance):
+            regressions.append((stage, reference["median_s"], stats["median_s"]))
+    return regressions
+
+
+def main():
+    args = get_arguments()
+    random.seed(RANDOM_SEED)
+    sys.path.insert(0, str(SCRIPT_DIR))
+
+    results = {}
+    with tempfile.TemporaryDirectory(prefix="mammo-bench-") as tmp:
+        workdir = Path(tmp)
+        run_data_benchmarks(workdir, args.repeats, results)
+
+        if args.skip_model:
+            print("Skipping model stages (--skip_model).")
+        else:
+            try:
+                processor_path = args.processor_path
+                if not processor_path.is_dir():
+                    print(f"No processor directory at {processor_path}; building a small one in code.")
+                    processor_path = workdir / "tiny_processor"
+                    build_tiny_processor(processor_path)
+                run_model_benchmarks(workdir, processor_path, args.repeats, results)
+            except Exception as e:
+                print(f"Model stages failed: {e}")
+                results["model"] = {"error": str(e)}
+
+    report = {
+        "meta": {
+            "python": platform.python_version(),
+            "platform": platform.platform(),
+            "cpu_count": os.cpu_count(),
+            "timestamp": time.strftime("%Y-%m-%dT%H:%M:%S"),
+        },
+        "results": results,
+    }
+
+    for stage, stats in results.items():
+        if "median_s" in stats:
+            print(f"{stage:55s} median {stats['median_s'] * 1000:10.2f} ms")
+
+    report_json = json.dumps(report, indent=2)
+    if args.output:
+        args.output.write_text(report_json + "\n", encoding="utf-8")
+        print(f"Results written to {args.output}")
+    else:
+        print(report_json)
+
+    if args.save_baseline:
+        args.baseline.write_text(report_json + "\n", encoding="utf-8")
+        print(f"Baseline saved to {args.baseline}")
+        return
+
+    if not args.baseline.is_file():
+        print(f"No baseline at {args.baseline}; run with --save_baseline to create one.")
+        return
+
+    baseline = json.loads(args.baseline.read_text(encoding="utf-8")).get("results", {})
+    regressions = compare_to_baseline(results, baseline, args.tolerance)
+    if regressions:
+        print(f"\nRegressions (> {args.tolerance:.0%} slower than baseline):")
+        for stage, before, after in regressions:
+            print(f"  ! {stage}: {before * 1000:.2f} ms -> {after * 1000:.2f} ms")
+        exit(1)
+    print("\nNo regressions against baseline.")
+
+
+if __name__ == "__main__":
+    main()
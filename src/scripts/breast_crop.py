@@ -0,0 +1,85 @@
+"""
+breast_crop.py
+Find the breast in a mammogram and crop away the black background.
+
+The bounding box comes from a single threshold and row/column projections of a
+downsampled copy, so it costs a few milliseconds even on full-field images. Crop
+boxes are (left, top, right, bottom) in pixel coordinates of the original image,
+the same convention as PIL's Image.crop.
+"""
+
+import numpy as np
+
+# Pixels brighter than this fraction of the image maximum count as tissue
+THRESHOLD_FRACTION = 0.08
+# A row/column needs at least this fraction of tissue pixels, which ignores
+# scanner labels and isolated noise
+MIN_PROJECTION_FRACTION = 0.01
+# Margin kept around the box, as a fraction of the image size
+MARGIN_FRACTION = 0.02
+# Downsampling stride used to compute the projections
+STRIDE = 4
+
+
+def find_breast_bbox(pixel_array, threshold_fraction=THRESHOLD_FRACTION,
+                     min_projection_fraction=MIN_PROJECTION_FRACTION,
+                     margin_fraction=MARGIN_FRACTION, stride=STRIDE):
+    """
+    Locate the breast in a 2D (or HxWxC) pixel array where tissue is bright.
+
+    Returns:
+        tuple: (left, top, right, bottom); the full frame if no tissue is found
+    """
+    array = np.asarray(pixel_array)
+    return find_breast_bbox_downsampled(
+        array[::stride, ::stride], array.shape[:2], threshold_fraction=threshold_fraction,
+        min_projection_fraction=min_projection_fraction, margin_fraction=margin_fraction, stride=stride
+    )
+
+
+def find_breast_bbox_downsampled(small, shape, threshold_fraction=THRESHOLD_FRACTION,
+                                 min_projection_fraction=MIN_PROJECTION_FRACTION,
+                                 margin_fraction=MARGIN_FRACTION, stride=STRIDE):
+    """
+    find_breast_bbox given only every stride-th row and column (small) of an
+    image of the given (height, width), e.g. collected while streaming it.
+    """
+    small = np.asarray(small)
+    if small.ndim == 3:
+        small = small.max(axis=2)
+    height, width = shape
+    full_box = (0, 0, width, height)
+
+    max_value = small.max()
+    if max_value <= 0:
+        return full_box
+
+    mask = small > max_value * threshold_fraction
+    row_counts = mask.sum(axis=1)
+    col_counts = mask.sum(axis=0)
+    rows = np.flatnonzero(row_counts >= max(1, min_projection_fraction * mask.shape[1]))
+    cols = np.flatnonzero(col_counts >= max(1, min_projection_fraction * mask.shape[0]))
+    if rows.size == 0 or cols.size == 0:
+        return full_box
+
+    margin_y = int(height * margin_fraction)
+    margin_x = int(width * margin_fraction)
+    top = max(0, rows[0] * stride - margin_y)
+    bottom = min(height, (rows[-1] + 1) * stride + margin_y)
+    left = max(0, cols[0] * stride - margin_x)
+    right = min(width, (cols[-1] + 1) * stride + margin_x)
+    return (int(left), int(top), int(right), int(bottom))
+
+
+def crop_array_to_breast(pixel_array, **kwargs):
+    """Crop a pixel array to the breast. Returns (cropped_array, box)."""
+    left, top, right, bottom = box = find_breast_bbox(pixel_array, **kwargs)
+    return pixel_array[top:bottom, left:right], box
+
+
+def crop_image_to_breast(image, **kwargs):
+    """Crop a PIL image to the breast. Returns (cropped_image, box)."""
+    box = find_breast_bbox(np.asarray(image.convert("L")), **kwargs)
+    if box == (0, 0, image.width, image.height):
+        return image, box
+    return image.crop(box), box
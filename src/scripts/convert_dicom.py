@@ -1,9 +1,12 @@
+import csv
 import os
 import pydicom
 import numpy as np
 from PIL import Image
 import logging
 
+from breast_crop import STRIDE, crop_array_to_breast, find_breast_bbox_downsampled
+
 logging.basicConfig(
     level=logging.INFO, format="%(asctime)s - %(levelname)s - %(message)s"
 )
@@ -14,6 +17,19 @@ WORKSPACE_ROOT = (
 INPUT_DIR = os.path.join(WORKSPACE_ROOT, "src/data/images")
 OUTPUT_DIR = os.path.join(WORKSPACE_ROOT, "src/data/images_jpg")
 VALID_EXTENSIONS = (".dcm", ".dcim")
+# Crop away the background around the breast; boxes are recorded in CROP_BOXES_CSV
+CROP_TO_BREAST = False
+CROP_BOXES_CSV = os.path.join(OUTPUT_DIR, "crop_boxes.csv")
+# Memory per conversion in bytes, including the uint8 output frame. None decodes
+# each file in one go; a budget streams pixel data in row strips (see convert_dicom_strips)
+MEMORY_BUDGET_BYTES = None
+# Elements larger than this are left on disk when reading the header
+DEFER_SIZE = "64 KB"
+# Float copy of a strip plus the temporaries of windowing/scaling
+WORKING_BYTES_PER_PIXEL = 32
+# Decoded frames' worth of memory pydicom uses to decode one compressed frame: the
+# compressed input, the decoder's output and the final array (RLE measured ~2.8)
+DECODE_FRAME_COPIES = 3
 
 
 def apply_windowing(image, center, width):
@@ -28,7 +44,58 @@ def apply_windowing(image, center, width):
     return windowed_image.astype(np.uint8)
 
 
-def convert_dicom_to_jpg(dicom_path, jpg_path):
+def get_window(ds):
+    """(center, width) from the first WindowCenter/WindowWidth values, or None."""
+    if "WindowCenter" not in ds or "WindowWidth" not in ds:
+        return None
+    center = ds.WindowCenter
+    width = ds.WindowWidth
+
+    if isinstance(center, pydicom.multival.MultiValue):
+        center = center[0]
+    if isinstance(width, pydicom.multival.MultiValue):
+        width = width[0]
+    return center, width
+
+
+def to_uint8(pixel_array, window, max_value, invert):
+    """Window (or scale by max_value) and optionally invert float pixels to uint8."""
+    if window is not None:
+        pixel_array = apply_windowing(pixel_array, *window)
+    else:
+        if max_value > 0:
+            pixel_array = (pixel_array / max_value) * 255.0
+        pixel_array = pixel_array.astype(np.uint8)
+
+    if invert:
+        pixel_array = np.invert(pixel_array)
+    return pixel_array
+
+
+def is_monochrome1(ds):
+    return "PhotometricInterpretation" in ds and ds.PhotometricInterpretation == "MONOCHROME1"
+
+
+def save_jpg(pixel_array, dicom_path, jpg_path, crop, crop_boxes):
+    if crop:
+        pixel_array, box = crop_array_to_breast(pixel_array)
+        if crop_boxes is not None:
+            crop_boxes[jpg_path] = box
+
+    try:
+        img = Image.fromarray(pixel_array)
+        img.save(jpg_path)
+        logging.info(f"Successfully converted {os.path.basename(dicom_path)} to JPG.")
+        return True
+    except Exception as e:
+        logging.error(f"Could not convert or save image for {dicom_path}: {e}")
+        return False
+
+
+def convert_dicom_to_jpg(dicom_path, jpg_path, crop=False, crop_boxes=None, memory_budget=MEMORY_BUDGET_BYTES):
+    if memory_budget is not None:
+        return convert_dicom_strips(dicom_path, jpg_path, memory_budget, crop=crop, crop_boxes=crop_boxes)
+
     try:
         ds = pydicom.dcmread(dicom_path)
     except Exception as e:
@@ -41,32 +108,223 @@ def convert_dicom_to_jpg(dicom_path, jpg_path):
         logging.error(f"Could not get pixel array from {dicom_path}: {e}")
         return False
 
-    if "WindowCenter" in ds and "WindowWidth" in ds:
-        center = ds.WindowCenter
-        width = ds.WindowWidth
+    window = get_window(ds)
+    max_value = pixel_array.max() if window is None else None
+    pixel_array = to_uint8(pixel_array, window, max_value, is_monochrome1(ds))
+    if get_num_frames(ds) > 1:
+        return all([
+            save_jpg(frame, dicom_path, frame_jpg_path(jpg_path, index), crop, crop_boxes)
+            for index, frame in enumerate(pixel_array)
+        ])
+    return save_jpg(pixel_array, dicom_path, jpg_path, crop, crop_boxes)
 
-        if isinstance(center, pydicom.multival.MultiValue):
-            center = center[0]
-        if isinstance(width, pydicom.multival.MultiValue):
-            width = width[0]
 
-        pixel_array = apply_windowing(pixel_array, center, width)
-    else:
-        if pixel_array.max() > 0:
-            pixel_array = (pixel_array / pixel_array.max()) * 255.0
-        pixel_array = pixel_array.astype(np.uint8)
+# --- Memory-bounded decoding ---
 
-    if "PhotometricInterpretation" in ds and ds.PhotometricInterpretation == "MONOCHROME1":
-        pixel_array = np.invert(pixel_array)
+def frame_jpg_path(jpg_path, index):
+    """Output path of one frame of a multi-frame DICOM (e.g. tomosynthesis slices)."""
+    stem, ext = os.path.splitext(jpg_path)
+    return f"{stem}_frame{index:04d}{ext}"
+
+
+def get_num_frames(ds):
+    """Number of frames in a dataset (1 for single-frame images)."""
+    return int(ds.get("NumberOfFrames", 1) or 1)
+
+
+def output_jpg_paths(dicom_path, jpg_path):
+    """The JPGs convert_dicom_to_jpg writes for dicom_path: jpg_path, or one per frame."""
+    num_frames = get_num_frames(pydicom.dcmread(dicom_path, stop_before_pixels=True))
+    if num_frames == 1:
+        return [jpg_path]
+    return [frame_jpg_path(jpg_path, index) for index in range(num_frames)]
+
+
+def get_decoded_frame_bytes(ds):
+    """
+    Estimated memory pydicom needs to decode one whole frame when the pixel data
+    cannot be read in strips (see native_pixel_layout), or 0 when it can.
+    """
+    if native_pixel_layout(ds) is not None:
+        return 0
+    frame_bytes = ds.Rows * ds.Columns * ds.get("SamplesPerPixel", 1) * ((ds.BitsAllocated + 7) // 8)
+    return DECODE_FRAME_COPIES * frame_bytes
 
+
+def get_strip_rows(ds, memory_budget):
+    """
+    Rows per strip so that a strip's working copy, a whole uint8 output frame and
+    any frame pydicom has to decode stay within memory_budget; 0 if not even one
+    row fits next to the frames.
+    """
+    pixels_per_row = ds.Columns * ds.get("SamplesPerPixel", 1)
+    strip_budget = memory_budget - ds.Rows * pixels_per_row - get_decoded_frame_bytes(ds)
+    return max(0, min(ds.Rows, strip_budget // (pixels_per_row * WORKING_BYTES_PER_PIXEL)))
+
+
+def native_pixel_layout(ds):
+    """
+    File offset and dtype of uncompressed grayscale pixel data that can be read
+    strip by strip, or None if pydicom has to decode it (encapsulated or
+    deflated transfer syntaxes, bit-packed or multi-sample pixels).
+    """
+    element = ds.get_item("PixelData", keep_deferred=True)
+    if element is None or getattr(element, "value_tell", None) is None:
+        return None
+    transfer_syntax = ds.file_meta.get("TransferSyntaxUID")
+    if transfer_syntax is None or transfer_syntax.is_compressed or transfer_syntax.is_deflated:
+        return None
+    if element.length == 0xFFFFFFFF or ds.BitsAllocated not in (8, 16, 32) or ds.get("SamplesPerPixel", 1) != 1:
+        return None
+
+    byte_order = "<" if transfer_syntax.is_little_endian else ">"
+    kind = "i" if ds.PixelRepresentation == 1 else "u"
+    return element.value_tell, np.dtype(f"{byte_order}{kind}{ds.BitsAllocated // 8}")
+
+
+def mask_bits_stored(strip, ds):
+    """Drop bits above BitsStored the way pydicom's pixel_array does (sign-extending signed data)."""
+    bits_stored, bits_allocated = ds.BitsStored, ds.BitsAllocated
+    if bits_stored >= bits_allocated:
+        return strip
+    if ds.PixelRepresentation == 1:
+        shift = bits_allocated - bits_stored
+        return (strip << shift) >> shift
+    return strip & ((1 << bits_stored) - 1)
+
+
+def iter_strips(dicom_path, ds, strip_rows):
+    """
+    Yields (frame_index, first_row, strip) over all frames. Uncompressed data is
+    read straight from the file, one strip at a time; anything else is decoded
+    one frame at a time by pydicom and then split into strips.
+    """
+    num_frames = get_num_frames(ds)
+    rows, columns = ds.Rows, ds.Columns
+    layout = native_pixel_layout(ds)
+    if layout is None:
+        for frame_index, frame in enumerate(pydicom.pixels.iter_pixels(dicom_path)):
+            for first_row in range(0, rows, strip_rows):
+                yield frame_index, first_row, frame[first_row:first_row + strip_rows]
+        return
+
+    offset, dtype = layout
+    frame_bytes = rows * columns * dtype.itemsize
+    with open(dicom_path, "rb") as f:
+        for frame_index in range(num_frames):
+            for first_row in range(0, rows, strip_rows):
+                strip_height = min(strip_rows, rows - first_row)
+                f.seek(offset + frame_index * frame_bytes + first_row * columns * dtype.itemsize)
+                strip = np.fromfile(f, dtype=dtype, count=strip_height * columns)
+                if strip.size != strip_height * columns:
+                    raise ValueError(f"Pixel data of {dicom_path} ends in frame {frame_index}")
+                yield frame_index, first_row, mask_bits_stored(strip.reshape(strip_height, columns), ds)
+
+
+def find_crop_boxes(dicom_path, ds, strip_rows, window, max_value, invert):
+    """
+    Breast crop box of every frame, found on every STRIDE-th row and column of
+    its uint8 strips, which is what crop_array_to_breast looks at.
+    """
+    boxes = []
+    samples = []
+    frame_index = None
+    for index, first_row, strip in iter_strips(dicom_path, ds, strip_rows):
+        if index != frame_index:
+            if samples:
+                boxes.append(find_breast_bbox_downsampled(np.concatenate(samples), (ds.Rows, ds.Columns)))
+            frame_index, samples = index, []
+        sample = strip[(-first_row) % STRIDE::STRIDE, ::STRIDE]
+        if sample.shape[0]:
+            samples.append(to_uint8(sample.astype(float), window, max_value, invert))
+    if samples:
+        boxes.append(find_breast_bbox_downsampled(np.concatenate(samples), (ds.Rows, ds.Columns)))
+    return boxes
+
+
+def convert_dicom_strips(dicom_path, jpg_path, memory_budget, crop=False, crop_boxes=None):
+    """
+    convert_dicom_to_jpg in at most memory_budget bytes of pixel memory.
+
+    PIL encodes a JPG from a whole image, so one uint8 frame is held in memory
+    and counts against the budget. Uncompressed pixel data is left on disk when
+    the header is read and streamed in row strips through windowing and inversion
+    into that frame; compressed data (e.g. JPEG 2000) is decoded by pydicom one
+    whole frame at a time, and the decoder's memory counts too. That part is an
+    estimate (DECODE_FRAME_COPIES), so for compressed files the bound is only as
+    good as the estimate is for their codec.
+    Files whose frames leave no room for a strip are not converted.
+    Without a VOI window the maximum is found in a first pass over the strips;
+    when cropping, the box is found in another and only the crop is allocated.
+    Multi-frame files get one JPG per frame (frame_jpg_path). The output matches
+    convert_dicom_to_jpg for single-frame files.
+    """
     try:
-        img = Image.fromarray(pixel_array)
-        img.save(jpg_path)
-        logging.info(f"Successfully converted {os.path.basename(dicom_path)} to JPG.")
-        return True
+        ds = pydicom.dcmread(dicom_path, defer_size=DEFER_SIZE)
     except Exception as e:
-        logging.error(f"Could not convert or save image for {dicom_path}: {e}")
+        logging.error(f"Could not read DICOM file {dicom_path}: {e}")
+        return False
+
+    try:
+        strip_rows = get_strip_rows(ds, memory_budget)
+        if strip_rows == 0:
+            frame_bytes = ds.Rows * ds.Columns * ds.get("SamplesPerPixel", 1) + get_decoded_frame_bytes(ds)
+            logging.error(
+                f"Memory budget of {memory_budget} bytes is too small for {dicom_path}: "
+                f"its {ds.Rows}x{ds.Columns} frames alone take {frame_bytes} bytes"
+            )
+            return False
+        window = get_window(ds)
+        invert = is_monochrome1(ds)
+        num_frames = get_num_frames(ds)
+        max_value = None
+        if window is None:
+            max_value = max(float(strip.max()) for _, _, strip in iter_strips(dicom_path, ds, strip_rows))
+        boxes = find_crop_boxes(dicom_path, ds, strip_rows, window, max_value, invert) if crop else None
+
+        success = True
+        frame_index, output, box = None, None, None
+        for index, first_row, strip in iter_strips(dicom_path, ds, strip_rows):
+            if index != frame_index:
+                if output is not None:
+                    success &= save_frame(output, box, dicom_path, jpg_path, frame_index, num_frames, crop, crop_boxes)
+                frame_index, output = index, None
+                box = boxes[index] if crop else (0, 0, ds.Columns, ds.Rows)
+                left, top, right, bottom = box
+                output = np.empty((bottom - top, right - left, *strip.shape[2:]), dtype=np.uint8)
+            start, stop = max(top, first_row), min(bottom, first_row + strip.shape[0])
+            if start < stop:
+                output[start - top:stop - top] = to_uint8(
+                    strip[start - first_row:stop - first_row, left:right].astype(float), window, max_value, invert
+                )
+        if output is not None:
+            success &= save_frame(output, box, dicom_path, jpg_path, frame_index, num_frames, crop, crop_boxes)
+    except Exception as e:
+        logging.error(f"Could not get pixel array from {dicom_path}: {e}")
         return False
+    return success
+
+
+def save_frame(output, box, dicom_path, jpg_path, frame_index, num_frames, crop, crop_boxes):
+    if num_frames > 1:
+        jpg_path = frame_jpg_path(jpg_path, frame_index)
+    if crop and crop_boxes is not None:
+        crop_boxes[jpg_path] = box
+    # Already cropped while streaming
+    return save_jpg(output, dicom_path, jpg_path, False, None)
+
+
+def write_crop_boxes(crop_boxes, csv_path):
+    """Record each output JPG's crop box in original DICOM pixel coordinates."""
+    try:
+        with open(csv_path, "w", newline="", encoding="utf-8") as f:
+            writer = csv.writer(f)
+            writer.writerow(["jpg_path", "left", "top", "right", "bottom"])
+            for jpg_path, box in sorted(crop_boxes.items()):
+                writer.writerow([os.path.relpath(jpg_path, OUTPUT_DIR), *box])
+        logging.info(f"Wrote {len(crop_boxes)} crop boxes to {csv_path}")
+    except OSError as e:
+        logging.error(f"Could not write crop boxes to {csv_path}: {e}")
 
 
 def main():
@@ -83,6 +341,7 @@ def main():
 
     converted_count = 0
     failed_count = 0
+    crop_boxes = {}
 
     for root, _, files in os.walk(INPUT_DIR):
         for file in files:
@@ -97,11 +356,15 @@ def main():
             file_name_without_ext = os.path.splitext(file)[0]
             jpg_path = os.path.join(output_subdir, f"{file_name_without_ext}.jpg")
 
-            if convert_dicom_to_jpg(dicom_path, jpg_path):
+            if convert_dicom_to_jpg(dicom_path, jpg_path, crop=CROP_TO_BREAST, crop_boxes=crop_boxes,
+                                    memory_budget=MEMORY_BUDGET_BYTES):
                 converted_count += 1
             else:
                 failed_count += 1
 
+    if crop_boxes:
+        write_crop_boxes(crop_boxes, CROP_BOXES_CSV)
+
     logging.info("Conversion process finished.")
     logging.info(f"Total files converted: {converted_count}")
     logging.info(f"Total files failed: {failed_count}")
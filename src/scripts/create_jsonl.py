@@ -1,11 +1,17 @@
 import os
 import csv
+import hashlib
 import json
 import random
 import logging
 import shutil
+import sys
+from concurrent.futures import ThreadPoolExecutor, as_completed
 from pathlib import Path
 
+from phash_index import DEFAULT_MAX_DISTANCE, PHashIndex
+from report_fields import CLINICAL_ACTIONS, DEFAULT_CLINICAL_ACTION, RESPONSE_TEMPLATES
+
 logging.basicConfig(
     level=logging.INFO, format="%(asctime)s - %(levelname)s - %(message)s"
 )
@@ -20,10 +26,20 @@ TEST_SET_DIR = WORKSPACE_ROOT / "src" / "data" / "test-set"
 
 TRAINING_JSONL_FILE = OUTPUT_DIR / "dataset.jsonl"
 TEST_SET_CSV_FILE = TEST_SET_DIR / "test_set.csv"
+TEST_MANIFEST_NAME = "manifest.json"
 
 LAMBDA_IMAGE_BASE_PATH = "/home/ubuntu/data/images"
 TEST_SET_SIZE = 25
 RANDOM_SEED = 42
+# Parallel link/copy operations when staging the test images
+STAGING_WORKERS = 16
+
+# Near-duplicate handling: None, "drop" (keep one image per duplicate group) or
+# "group" (keep all, but never split a group across train and test). Off by
+# default: check DUPLICATE_MAX_DISTANCE against the real images first
+# (python phash_index.py --images_dir ... reports nearest-neighbour distances)
+DEDUP_MODE = None
+DUPLICATE_MAX_DISTANCE = DEFAULT_MAX_DISTANCE
 
 SYSTEM_PROMPT = """You are an expert radiologist assistant analyzing mammography images. Provide clear, professional assessments including findings, breast density, BI-RADS classification, and clinical recommendations."""
 
@@ -94,43 +110,83 @@ def find_matching_image(file_name_id, primary_images_dir, secondary_images_dir):
 def get_clinical_action(birads_value):
     """Returns a concise, action-oriented recommendation based on the BI-RADS value."""
     birads_str = str(birads_value).strip()
-    actions = {
-        "0": "Recommend additional imaging or prior studies for comparison.",
-        "1": "Recommend routine screening mammography.",
-        "2": "Recommend routine screening mammography.",
-        "3": "Recommend 6-month follow-up imaging.",
-        "4": "Recommend tissue biopsy for histological diagnosis.",
-        "4a": "Consider biopsy given low suspicion findings.",
-        "4b": "Biopsy indicated for moderate suspicion lesion.",
-        "4c": "Strongly recommend biopsy given high suspicion.",
-        "5": "Biopsy required; arrange oncology consultation.",
-        "6": "Proceed with treatment planning and oncology care.",
-    }
-    return actions.get(birads_str, "Recommend radiologist review.")
+    return CLINICAL_ACTIONS.get(birads_str, DEFAULT_CLINICAL_ACTION)
+
+
+def split_key(seed, image_filename):
+    """
+    Seeded 64-bit hash of an image name. The test set is the entries with the
+    smallest keys and entries are written in key order, so create_jsonl.py and
+    the streaming pipeline produce the same split and file for a given seed.
+    """
+    digest = hashlib.sha256(f"{seed}:{image_filename}".encode("utf-8")).digest()
+    return int.from_bytes(digest[:8], "big")
+
+
+def pick_template_index(seed, image_filename):
+    """Response template for an image, derived from the seed and its file id rather than call order."""
+    file_id = image_filename.split("_")[0]
+    digest = hashlib.sha256(f"{seed}:template:{file_id}".encode("utf-8")).digest()
+    return int.from_bytes(digest[:8], "big") % len(RESPONSE_TEMPLATES)
+
+
+def create_assistant_response(findings, acr_value, birads_value, template_index=None):
+    if template_index is None:
+        template_index = random.randrange(len(RESPONSE_TEMPLATES))
+    return RESPONSE_TEMPLATES[template_index].format(
+        findings=findings,
+        acr=acr_value,
+        birads=birads_value,
+        clinical_action=get_clinical_action(birads_value),
+    )
 
 
-def create_assistant_response(findings, acr_value, birads_value):
-    clinical_action = get_clinical_action(birads_value)
+class DatasetEntry:
+    """
+    One accepted CSV row, kept as the few fields the training example is built
+    from. The chat JSON is only rendered (render_json_entry) when it is written,
+    so building a dataset does not hold a nested message structure per image.
+    """
 
-    responses = [
-        f"Assessment: {findings}. Breast density is ACR {acr_value}. This is classified as BI-RADS {birads_value}. {clinical_action}",
-        f"The mammogram shows {findings}, with ACR {acr_value} density. I would classify this as BI-RADS {birads_value}. {clinical_action}",
-        f"My assessment reveals {findings}. The breast composition is ACR {acr_value}. This warrants a BI-RADS {birads_value} classification. {clinical_action}",
-        f"Findings include {findings}. Breast density is ACR {acr_value}. Based on these findings, I recommend BI-RADS {birads_value}. {clinical_action}",
-    ]
-    
-    return random.choice(responses)
+    __slots__ = (
+        "row_index", "image_filename", "findings", "acr", "birads",
+        "template_index", "image_base_path", "duplicate_group", "csv_row",
+    )
 
+    def __init__(self, row_index, image_filename, findings, acr, birads, template_index,
+                 image_base_path=LAMBDA_IMAGE_BASE_PATH, csv_row=None):
+        self.row_index = row_index
+        self.image_filename = image_filename
+        self.findings = findings
+        # ACR/BI-RADS values and the base path repeat across rows; share one copy
+        self.acr = sys.intern(acr)
+        self.birads = sys.intern(birads)
+        self.template_index = template_index
+        self.image_base_path = sys.intern(image_base_path)
+        self.duplicate_group = None
+        # Only set for rows that do not come from a CSV file (see write_test_csv)
+        self.csv_row = csv_row
+
+    @classmethod
+    def from_row(cls, row, image_filename, image_base_path=LAMBDA_IMAGE_BASE_PATH, row_index=None, keep_row=False,
+                 seed=RANDOM_SEED):
+        """Picks the response template from the seed and file id (see pick_template_index)."""
+        return cls(
+            row_index,
+            image_filename,
+            row.get("Findings Notes (English)", "").strip(),
+            row.get("ACR", "").strip(),
+            row.get("Bi-Rads", "").strip(),
+            pick_template_index(seed, image_filename),
+            image_base_path,
+            csv_row=row if keep_row else None,
+        )
+
+
+def render_json_entry(entry):
+    """Builds the chat-format training example for a DatasetEntry."""
+    assistant_text = create_assistant_response(entry.findings, entry.acr, entry.birads, entry.template_index)
 
-def create_json_entry(row, image_filename):
-    lambda_image_path = f"{LAMBDA_IMAGE_BASE_PATH}/{image_filename}"
-    
-    findings = row.get("Findings Notes (English)", "").strip()
-    acr = row.get("ACR", "").strip()
-    birads = row.get("Bi-Rads", "").strip()
-    
-    assistant_text = create_assistant_response(findings, acr, birads)
-    
     json_entry = {
         "messages": [
             {
@@ -147,7 +203,7 @@ def create_json_entry(row, image_filename):
                 "content": [
                     {
                         "type": "image",
-                        "image": lambda_image_path
+                        "image": f"{entry.image_base_path}/{entry.image_filename}"
                     },
                     {
                         "type": "text",
@@ -170,6 +226,10 @@ def create_json_entry(row, image_filename):
     return json_entry
 
 
+def create_json_entry(row, image_filename, image_base_path=LAMBDA_IMAGE_BASE_PATH):
+    return render_json_entry(DatasetEntry.from_row(row, image_filename, image_base_path))
+
+
 def process_rows(rows, images_dir, test_images_dir):
     valid_entries = []
     skipped_count = 0
@@ -189,13 +249,7 @@ def process_rows(rows, images_dir, test_images_dir):
             skipped_count += 1
             continue
         
-        json_entry = create_json_entry(row, image_filename)
-        entry_with_metadata = {
-            "json_entry": json_entry,
-            "image_filename": image_filename,
-            "csv_row": row
-        }
-        valid_entries.append(entry_with_metadata)
+        valid_entries.append(DatasetEntry.from_row(row, image_filename, row_index=idx - 1))
         
         if idx % 50 == 0:
             logging.info(f"Processed {idx} rows...")
@@ -206,44 +260,118 @@ def process_rows(rows, images_dir, test_images_dir):
     return valid_entries
 
 
-def split_train_test(entries, test_set_dir, fallback_test_size, seed):
-    test_images_dir = test_set_dir / "images"
-    existing_test_filenames = set()
+def mark_duplicates(entries, images_dir, test_images_dir, max_distance):
+    """Tags every entry with a "duplicate_group" id from a perceptual-hash index of its image."""
+    paths = []
+    for entry_data in entries:
+        image_filename = entry_data.image_filename
+        path = images_dir / image_filename
+        if not path.exists() and test_images_dir is not None:
+            path = test_images_dir / image_filename
+        paths.append(path)
+
+    index = PHashIndex.build(paths)
+    groups = index.duplicate_groups(max_distance)
+
+    for entry_data in entries:
+        # Unhashable images form their own group
+        entry_data.duplicate_group = groups.get(entry_data.image_filename, entry_data.image_filename)
+
+    group_sizes = {}
+    for entry_data in entries:
+        group_sizes[entry_data.duplicate_group] = group_sizes.get(entry_data.duplicate_group, 0) + 1
+    duplicate_count = sum(size - 1 for size in group_sizes.values())
+    logging.info(
+        f"Found {duplicate_count} near-duplicate images in "
+        f"{sum(1 for size in group_sizes.values() if size > 1)} groups (max distance {max_distance})"
+    )
+    return entries
+
+
+def drop_duplicates(entries, preferred_filenames=()):
+    """Keeps one entry per duplicate group, preferring images in preferred_filenames (e.g. the test set)."""
+    preferred_filenames = set(preferred_filenames)
+    ordered_entries = sorted(entries, key=lambda entry_data: entry_data.image_filename not in preferred_filenames)
+    kept_ids = set()
+    seen_groups = set()
+    for entry_data in ordered_entries:
+        group = entry_data.duplicate_group
+        if group in seen_groups:
+            logging.info(f"Dropping near-duplicate image {entry_data.image_filename}")
+            continue
+        seen_groups.add(group)
+        kept_ids.add(id(entry_data))
+    # Preserve the original order of the kept entries
+    return [entry_data for entry_data in entries if id(entry_data) in kept_ids]
+
 
-    if test_images_dir.exists():
-        existing_test_filenames = {f.name for f in test_images_dir.iterdir() if f.is_file()}
+def get_test_set_size(total_entries, test_set_size):
+    """Requested test size, or a tenth of the entries when there are fewer than requested."""
+    if total_entries < test_set_size:
+        logging.warning(
+            f"Dataset has only {total_entries} entries, less than requested test size {test_set_size}"
+        )
+        return max(1, total_entries // 10)
+    return test_set_size
+
+
+def split_train_test(entries, test_set_dir, fallback_test_size, seed):
+    """
+    Splits entries into (training_set, test_set), both ordered by split_key.
+    Committed test images define the test set; otherwise it is the
+    fallback_test_size entries with the smallest keys (whole duplicate groups
+    when dedup is on). pipeline.py's DatasetWriter makes the same split.
+    """
+    existing_test_filenames = get_committed_test_filenames(test_set_dir)
+    ordered_entries = sorted(entries, key=lambda entry: split_key(seed, entry.image_filename))
 
     if existing_test_filenames:
-        logging.info(f"Found {len(existing_test_filenames)} existing images in {test_images_dir}. Using them for the test set.")
+        logging.info(f"Found {len(existing_test_filenames)} committed test images in {test_set_dir}. Using them for the test set.")
         test_set = []
         training_set = []
         
-        for entry in entries:
-            if entry["image_filename"] in existing_test_filenames:
+        for entry in ordered_entries:
+            if entry.image_filename in existing_test_filenames:
                 test_set.append(entry)
             else:
                 training_set.append(entry)
 
-        found_test_filenames = {entry['image_filename'] for entry in test_set}
+        if entries and entries[0].duplicate_group is not None:
+            test_groups = {entry.duplicate_group for entry in test_set}
+            leaked = [entry for entry in training_set if entry.duplicate_group in test_groups]
+            if leaked:
+                logging.warning(
+                    f"Removing {len(leaked)} training images that are near-duplicates of test images: "
+                    f"{', '.join(entry.image_filename for entry in leaked)}"
+                )
+                training_set = [entry for entry in training_set if entry.duplicate_group not in test_groups]
+
+        found_test_filenames = {entry.image_filename for entry in test_set}
         missing_from_csv = existing_test_filenames - found_test_filenames
         if missing_from_csv:
             logging.warning(f"The following images from the test set directory were not found in the CSV and will be ignored: {', '.join(missing_from_csv)}")
     else:
-        logging.info("No existing test set images found. Performing random split.")
-        random.seed(seed)
-        
-        total_entries = len(entries)
-        if total_entries < fallback_test_size:
-            logging.warning(
-                f"Dataset has only {total_entries} entries, less than requested test size {fallback_test_size}"
-            )
-            fallback_test_size = max(1, total_entries // 10)
-        
-        shuffled_entries = entries.copy()
-        random.shuffle(shuffled_entries)
+        logging.info("No existing test set images found. Performing seeded split.")
+        fallback_test_size = get_test_set_size(len(entries), fallback_test_size)
         
-        test_set = shuffled_entries[:fallback_test_size]
-        training_set = shuffled_entries[fallback_test_size:]
+        if entries and entries[0].duplicate_group is not None:
+            # Draw whole duplicate groups so no group straddles the split
+            group_sizes = {}
+            for entry in ordered_entries:
+                group_sizes[entry.duplicate_group] = group_sizes.get(entry.duplicate_group, 0) + 1
+            test_groups = set()
+            test_count = 0
+            for entry in ordered_entries:
+                if test_count >= fallback_test_size:
+                    break
+                if entry.duplicate_group not in test_groups:
+                    test_groups.add(entry.duplicate_group)
+                    test_count += group_sizes[entry.duplicate_group]
+            test_set = [entry for entry in ordered_entries if entry.duplicate_group in test_groups]
+            training_set = [entry for entry in ordered_entries if entry.duplicate_group not in test_groups]
+        else:
+            test_set = ordered_entries[:fallback_test_size]
+            training_set = ordered_entries[fallback_test_size:]
 
     logging.info(f"Training set size: {len(training_set)}")
     logging.info(f"Test set size: {len(test_set)}")
@@ -259,7 +387,7 @@ def write_jsonl_file(entries, output_path):
     try:
         with open(output_path, "w", encoding="utf-8") as file:
             for entry_data in entries:
-                json_entry = entry_data["json_entry"]
+                json_entry = render_json_entry(entry_data)
                 json_line = json.dumps(json_entry, ensure_ascii=False)
                 file.write(json_line + "\n")
         
@@ -270,18 +398,27 @@ def write_jsonl_file(entries, output_path):
         return False
 
 
-def write_test_csv(test_entries, output_path, original_csv_path):
+def write_test_csv(test_entries, output_path, original_csv_path=None):
     if not test_entries:
         logging.warning(f"No test entries to write to {output_path}")
         return False
     
-    try:
-        with open(original_csv_path, "r", encoding="utf-8") as file:
-            reader = csv.DictReader(file)
-            fieldnames = reader.fieldnames
-    except Exception as e:
-        logging.error(f"Failed to read CSV headers: {e}")
-        return False
+    if original_csv_path is None:
+        # Rows built in memory (e.g. by pipeline.py) carry their own columns
+        fieldnames = list(test_entries[0].csv_row.keys())
+        csv_rows = [entry_data.csv_row for entry_data in test_entries]
+    else:
+        # Entries only keep their row position; re-read just the test rows
+        wanted = {entry_data.row_index for entry_data in test_entries}
+        try:
+            with open(original_csv_path, "r", encoding="utf-8") as file:
+                reader = csv.DictReader(file)
+                fieldnames = reader.fieldnames
+                rows_by_index = {idx: row for idx, row in enumerate(reader) if idx in wanted}
+        except Exception as e:
+            logging.error(f"Failed to read CSV headers: {e}")
+            return False
+        csv_rows = [rows_by_index[entry_data.row_index] for entry_data in test_entries]
     
     if not fieldnames:
         logging.error("No fieldnames found in original CSV")
@@ -292,8 +429,7 @@ def write_test_csv(test_entries, output_path, original_csv_path):
             writer = csv.DictWriter(file, fieldnames=fieldnames)
             writer.writeheader()
             
-            for entry_data in test_entries:
-                csv_row = entry_data["csv_row"]
+            for csv_row in csv_rows:
                 writer.writerow(csv_row)
         
         logging.info(f"Successfully wrote {len(test_entries)} rows to {output_path}")
@@ -303,46 +439,199 @@ def write_test_csv(test_entries, output_path, original_csv_path):
         return False
 
 
-def move_test_images(test_entries, images_dir, test_set_dir):
+def write_test_manifest(manifest, test_set_dir):
+    """Write the manifest atomically: readers see either the old or the new file, never a partial one."""
+    manifest_path = test_set_dir / TEST_MANIFEST_NAME
+    tmp_path = manifest_path.with_name(manifest_path.name + ".tmp")
+    with open(tmp_path, "w", encoding="utf-8") as file:
+        json.dump(manifest, file, indent=2)
+        file.flush()
+        os.fsync(file.fileno())
+    os.replace(tmp_path, manifest_path)
+    fsync_directory(test_set_dir)
+
+
+def read_test_manifest(test_set_dir):
+    manifest_path = test_set_dir / TEST_MANIFEST_NAME
+    if not manifest_path.exists():
+        return None
+    with open(manifest_path, "r", encoding="utf-8") as file:
+        return json.load(file)
+
+
+def fsync_directory(path):
+    """Persist renames and new links in a directory (a no-op where unsupported)."""
+    try:
+        fd = os.open(path, os.O_RDONLY)
+    except OSError:
+        return
+    try:
+        os.fsync(fd)
+    except OSError:
+        pass
+    finally:
+        os.close(fd)
+
+
+def get_committed_test_filenames(test_set_dir):
+    """
+    Image names of the committed test set, or an empty set if there is none.
+
+    Test sets staged before manifests existed have no manifest; for those the
+    contents of the images directory are used as before.
+    """
+    manifest = read_test_manifest(test_set_dir)
+    if manifest is not None:
+        if manifest.get("status") != "committed":
+            logging.warning(f"Ignoring uncommitted test set manifest in {test_set_dir}")
+            return set()
+        return set(manifest["images"])
+
+    test_images_dir = test_set_dir / "images"
+    if not test_images_dir.exists():
+        return set()
+    return {f.name for f in test_images_dir.iterdir() if f.is_file()}
+
+
+def rollback_test_staging(test_set_dir):
+    """
+    Undo an interrupted stage_test_images run: remove the images it added and
+    restore the previous manifest. Returns True if anything was rolled back.
+    """
+    manifest = read_test_manifest(test_set_dir)
+    if manifest is None or manifest.get("status") != "staging":
+        return False
+
+    test_images_dir = test_set_dir / "images"
+    source_dir = Path(manifest["source_dir"])
+    previously_present = set(manifest.get("previously_present", []))
+    removed_count = 0
+    for image_filename in manifest["images"]:
+        if image_filename in previously_present:
+            continue
+        staged_path = test_images_dir / image_filename
+        # Sources are only deleted after the commit, so this never drops the last copy
+        if staged_path.exists() and (source_dir / image_filename).exists():
+            staged_path.unlink()
+            removed_count += 1
+        partial_path = staged_path.with_name(staged_path.name + ".tmp")
+        if partial_path.exists():
+            partial_path.unlink()
+
+    previous = manifest.get("previous")
+    if previous is not None:
+        write_test_manifest(previous, test_set_dir)
+    else:
+        (test_set_dir / TEST_MANIFEST_NAME).unlink()
+        fsync_directory(test_set_dir)
+    logging.warning(f"Rolled back an interrupted test set staging ({removed_count} images removed)")
+    return True
+
+
+def _stage_image(source_path, dest_path):
+    """Hard-link source into the test set, copying when linking is not possible (e.g. across devices)."""
+    if dest_path.exists():
+        return "present"
+    try:
+        os.link(source_path, dest_path)
+        return "linked"
+    except FileExistsError:
+        return "present"
+    except OSError:
+        # Copy under a temporary name so a crash never leaves a truncated image
+        tmp_path = dest_path.with_name(dest_path.name + ".tmp")
+        shutil.copy2(source_path, tmp_path)
+        os.replace(tmp_path, dest_path)
+        return "copied"
+
+
+def stage_test_images(test_entries, images_dir, test_set_dir, workers=STAGING_WORKERS):
+    """
+    Move the test images into test_set_dir/images as one transaction.
+
+    1. A manifest listing the test images is written with status "staging".
+    2. Images are hard-linked (or copied) in parallel; sources stay in place.
+    3. The manifest is atomically rewritten with status "committed".
+    4. Only then are the sources removed from images_dir.
+
+    A failure before the commit rolls the staging back. A crash leaves the
+    "staging" manifest behind, and rollback_test_staging undoes it on the next run.
+    """
     if not test_entries:
         logging.warning("No test entries to move images for")
         return False
-    
+
+    rollback_test_staging(test_set_dir)
     test_images_dir = test_set_dir / "images"
     test_images_dir.mkdir(parents=True, exist_ok=True)
-    
-    moved_count = 0
-    failed_count = 0
-    already_present_count = 0
-    
-    for entry_data in test_entries:
-        image_filename = entry_data["image_filename"]
-        source_path = images_dir / image_filename
-        dest_path = test_images_dir / image_filename
-        
-        if dest_path.exists():
-            already_present_count += 1
-            continue
-            
-        if not source_path.exists():
-            logging.warning(f"Source image not found: {source_path}")
-            failed_count += 1
-            continue
-        
-        try:
-            shutil.move(str(source_path), str(dest_path))
-            moved_count += 1
-        except Exception as e:
-            logging.error(f"Failed to move {image_filename}: {e}")
-            failed_count += 1
-    
-    logging.info(f"Moved {moved_count} new images to {test_images_dir}")
-    if already_present_count > 0:
-        logging.info(f"{already_present_count} images were already in the test set directory.")
-    if failed_count > 0:
-        logging.warning(f"Failed to move {failed_count} images")
-    
-    return moved_count > 0 or already_present_count > 0
+
+    image_filenames = sorted({entry_data.image_filename for entry_data in test_entries})
+    previously_present = [name for name in image_filenames if (test_images_dir / name).exists()]
+    missing = [
+        name for name in image_filenames
+        if name not in previously_present and not (images_dir / name).exists()
+    ]
+    for name in missing:
+        logging.warning(f"Source image not found: {images_dir / name}")
+    image_filenames = [name for name in image_filenames if name not in missing]
+
+    write_test_manifest({
+        "status": "staging",
+        "source_dir": str(images_dir),
+        "images": image_filenames,
+        "previously_present": previously_present,
+        "previous": read_test_manifest(test_set_dir),
+    }, test_set_dir)
+
+    to_stage = [name for name in image_filenames if name not in previously_present]
+    results = {}
+    failed = []
+    with ThreadPoolExecutor(max_workers=workers) as executor:
+        futures = {
+            executor.submit(_stage_image, images_dir / name, test_images_dir / name): name
+            for name in to_stage
+        }
+        for future in as_completed(futures):
+            name = futures[future]
+            try:
+                results[name] = future.result()
+            except Exception as e:
+                logging.error(f"Failed to stage {name}: {e}")
+                failed.append(name)
+
+    if failed:
+        rollback_test_staging(test_set_dir)
+        logging.error(f"Test set staging rolled back after {len(failed)} failures")
+        return False
+
+    fsync_directory(test_images_dir)
+    write_test_manifest({
+        "status": "committed",
+        "source_dir": str(images_dir),
+        "images": image_filenames,
+    }, test_set_dir)
+
+    # The test set is committed; the originals can go. Leftovers from a crash
+    # here are harmless, since test membership comes from the manifest.
+    with ThreadPoolExecutor(max_workers=workers) as executor:
+        list(executor.map(_remove_source, (images_dir / name for name in to_stage)))
+
+    linked_count = sum(1 for result in results.values() if result == "linked")
+    copied_count = sum(1 for result in results.values() if result == "copied")
+    logging.info(f"Staged {len(to_stage)} new images in {test_images_dir} ({linked_count} linked, {copied_count} copied)")
+    if previously_present:
+        logging.info(f"{len(previously_present)} images were already in the test set directory.")
+    if missing:
+        logging.warning(f"Failed to stage {len(missing)} images")
+
+    return bool(image_filenames) and not missing
+
+
+def _remove_source(source_path):
+    try:
+        source_path.unlink()
+    except FileNotFoundError:
+        pass
 
 
 def main():
@@ -353,12 +642,22 @@ def main():
         logging.error("Failed to read CSV data. Exiting.")
         return
     
+    # Undo a test set staging that was interrupted by a crash
+    rollback_test_staging(TEST_SET_DIR)
+
     test_images_dir = TEST_SET_DIR / "images"
     valid_entries = process_rows(csv_rows, IMAGES_DIR, test_images_dir)
+    # Entries keep only what they need; the test CSV re-reads its rows from CSV_FILE_PATH
+    del csv_rows
     if not valid_entries:
         logging.error("No valid entries found. Exiting.")
         return
     
+    if DEDUP_MODE:
+        valid_entries = mark_duplicates(valid_entries, IMAGES_DIR, test_images_dir, DUPLICATE_MAX_DISTANCE)
+        if DEDUP_MODE == "drop":
+            valid_entries = drop_duplicates(valid_entries, get_committed_test_filenames(TEST_SET_DIR))
+    
     training_set, test_set = split_train_test(
         valid_entries, TEST_SET_DIR, TEST_SET_SIZE, RANDOM_SEED
     )
@@ -368,13 +667,13 @@ def main():
     
     training_success = write_jsonl_file(training_set, TRAINING_JSONL_FILE)
     test_csv_success = write_test_csv(test_set, TEST_SET_CSV_FILE, CSV_FILE_PATH)
-    test_images_success = move_test_images(test_set, IMAGES_DIR, TEST_SET_DIR)
+    test_images_success = stage_test_images(test_set, IMAGES_DIR, TEST_SET_DIR)
     
     if training_success and test_csv_success and test_images_success:
         logging.info("Dataset creation completed successfully!")
         logging.info(f"Training JSONL: {TRAINING_JSONL_FILE}")
         logging.info(f"Test CSV: {TEST_SET_CSV_FILE}")
-        logging.info(f"Test images moved to: {TEST_SET_DIR / 'images'}")
+        logging.info(f"Test images staged to: {TEST_SET_DIR / 'images'}")
     else:
         logging.error("Dataset creation completed with errors.")
 
@@ -0,0 +1,369 @@
+"""
+evaluate.py
+Score a checkpoint on the held-out test set.
+
+The test images are spread over worker processes, each holding its own copy of
+the model (pinned to one GPU with --devices). Every answer is parsed for BI-RADS
+and ACR as soon as it comes back and joined against test_set.csv (written by
+create_jsonl.write_test_csv) by File Name. Accuracy and confusion matrices are
+updated as results arrive, logged every --report_every images and written to
+--metrics_path, so a bad checkpoint shows up long before the run finishes.
+
+    python evaluate.py --model_path models/new/merged_model --workers 2 --devices 0 1 \
+        --baseline evaluation_metrics_previous.json --stop_if_worse
+"""
+
+import argparse
+import csv
+import json
+import logging
+import multiprocessing
+import os
+import random
+import time
+from concurrent.futures import ProcessPoolExecutor, as_completed
+
+import numpy as np
+
+from report_fields import parse_report
+
+SCRIPT_DIR = os.path.dirname(os.path.abspath(__file__))
+PROJECT_ROOT = os.path.dirname(os.path.dirname(SCRIPT_DIR))
+MODEL_PATH = os.path.join(PROJECT_ROOT, "models", "mamography-finetune-8", "merged_model")
+TEST_SET_DIR = os.path.join(PROJECT_ROOT, "src", "data", "test-set")
+PREDICTIONS_CSV_PATH = os.path.join(PROJECT_ROOT, "evaluation_predictions.csv")
+METRICS_JSON_PATH = os.path.join(PROJECT_ROOT, "evaluation_metrics.json")
+
+BIRADS_LABELS = ("0", "1", "2", "3", "4", "4a", "4b", "4c", "5", "6")
+ACR_LABELS = ("1", "2", "3", "4")
+# The model may answer with the letter form of the density categories
+ACR_LETTERS = {"A": "1", "B": "2", "C": "3", "D": "4"}
+UNPARSED = "unparsed"
+REPORT_EVERY = 10
+RANDOM_SEED = 42
+
+
+def normalize_label(value):
+    """Lower-case a BI-RADS/ACR value and drop the '.0' pandas/Excel add to numbers."""
+    if value is None:
+        return None
+    value = str(value).strip()
+    value = ACR_LETTERS.get(value.upper(), value)
+    if value.endswith(".0"):
+        value = value[:-2]
+    return value.lower() or None
+
+
+def image_id_from_path(image_path):
+    """'20586908_6c613a14b80a8591_MG_R_CC_ANON.jpg' -> '20586908'"""
+    return os.path.basename(image_path).split("_")[0]
+
+
+def load_ground_truth(csv_path):
+    """
+    Index test_set.csv on File Name.
+
+    Returns:
+        dict: image id -> {"birads": ..., "acr": ...}
+    """
+    ground_truth = {}
+    with open(csv_path, "r", encoding="utf-8") as f:
+        for row in csv.DictReader(f):
+            file_name_id = row.get("File Name", "").replace(".0", "").strip()
+            if file_name_id:
+                ground_truth[file_name_id] = {
+                    "birads": normalize_label(row.get("Bi-Rads")),
+                    "acr": normalize_label(row.get("ACR")),
+                }
+    return ground_truth
+
+
+def wilson_interval(successes, total, z=1.96):
+    """95% Wilson score interval for a proportion; stays sensible for small counts."""
+    if total == 0:
+        return (0.0, 1.0)
+    p = successes / total
+    denominator = 1 + z * z / total
+    centre = (p + z * z / (2 * total)) / denominator
+    half_width = z * np.sqrt(p * (1 - p) / total + z * z / (4 * total * total)) / denominator
+    return (float(max(0.0, centre - half_width)), float(min(1.0, centre + half_width)))
+
+
+class ConfusionMatrix:
+    """
+    Counts of (true label, predicted label). The extra last column counts answers
+    the label could not be parsed from; truths outside the label set are ignored.
+    """
+
+    def __init__(self, labels):
+        self.labels = tuple(labels)
+        self.index = {label: i for i, label in enumerate(self.labels)}
+        self.counts = np.zeros((len(self.labels), len(self.labels) + 1), dtype=np.int64)
+
+    def update(self, truths, predictions):
+        """Add a batch of (truth, prediction) pairs in one vectorized scatter-add."""
+        rows = np.array([self.index.get(t, -1) for t in truths], dtype=np.int64)
+        cols = np.array([self.index.get(p, len(self.labels)) for p in predictions], dtype=np.int64)
+        keep = rows >= 0
+        np.add.at(self.counts, (rows[keep], cols[keep]), 1)
+
+    def summary(self):
+        n = len(self.labels)
+        total = int(self.counts.sum())
+        correct = int(np.trace(self.counts[:, :n]))
+        support = self.counts.sum(axis=1)
+        predicted = self.counts[:, :n].sum(axis=0)
+        diagonal = np.diag(self.counts[:, :n])
+        with np.errstate(divide="ignore", invalid="ignore"):
+            recall = np.where(support > 0, diagonal / support, np.nan)
+            precision = np.where(predicted > 0, diagonal / predicted, np.nan)
+
+        return {
+            "total": total,
+            "accuracy": correct / total if total else None,
+            "accuracy_ci95": wilson_interval(correct, total),
+            "parsed_rate": 1 - self.counts[:, n].sum() / total if total else None,
+            "macro_recall": float(np.nanmean(recall)) if (support > 0).any() else None,
+            "recall": {label: float(r) for label, r in zip(self.labels, recall) if not np.isnan(r)},
+            "precision": {label: float(p) for label, p in zip(self.labels, precision) if not np.isnan(p)},
+            "confusion": {
+                "labels": list(self.labels) + [UNPARSED],
+                "counts": self.counts.tolist(),
+            },
+        }
+
+
+class Evaluation:
+    """Running BI-RADS/ACR scores; answers are parsed on arrival and scored in batches."""
+
+    def __init__(self, ground_truth, total):
+        self.ground_truth = ground_truth
+        self.total = total
+        self.birads = ConfusionMatrix(BIRADS_LABELS)
+        self.acr = ConfusionMatrix(ACR_LABELS)
+        self.pending = []
+        self.completed = 0
+        self.errors = 0
+        self.unmatched = 0
+        self.start = time.perf_counter()
+
+    def add(self, image_path, text, error=None):
+        """
+        Parse one answer and queue it for scoring.
+
+        Returns:
+            dict: the parsed prediction and its ground truth, for the predictions CSV
+        """
+        self.completed += 1
+        truth = self.ground_truth.get(image_id_from_path(image_path))
+        fields = parse_report(text) if error is None else {"birads": None, "acr": None}
+        prediction = {
+            "birads": normalize_label(fields["birads"]),
+            "acr": normalize_label(fields["acr"]),
+        }
+
+        if error is not None:
+            self.errors += 1
+        if truth is None:
+            self.unmatched += 1
+        else:
+            self.pending.append((truth, prediction))
+        return {"truth": truth or {}, "prediction": prediction}
+
+    def flush(self):
+        if not self.pending:
+            return
+        truths, predictions = zip(*self.pending)
+        self.birads.update([t["birads"] for t in truths], [p["birads"] for p in predictions])
+        self.acr.update([t["acr"] for t in truths], [p["acr"] for p in predictions])
+        self.pending = []
+
+    def metrics(self):
+        self.flush()
+        elapsed = time.perf_counter() - self.start
+        return {
+            "completed": self.completed,
+            "total": self.total,
+            "errors": self.errors,
+            "unmatched": self.unmatched,
+            "elapsed_seconds": elapsed,
+            "images_per_second": self.completed / elapsed if elapsed > 0 else 0.0,
+            "birads": self.birads.summary(),
+            "acr": self.acr.summary(),
+        }
+
+
+def is_worse_than_baseline(metrics, baseline):
+    """True once even the optimistic end of the BI-RADS accuracy interval is below the baseline's."""
+    baseline_accuracy = (baseline.get("birads") or {}).get("accuracy")
+    if baseline_accuracy is None or metrics["birads"]["total"] == 0:
+        return False
+    return metrics["birads"]["accuracy_ci95"][1] < baseline_accuracy
+
+
+def write_metrics(metrics, output_path):
+    """Write atomically, so the file can be read at any point during the run."""
+    tmp_path = f"{output_path}.tmp"
+    with open(tmp_path, "w", encoding="utf-8") as f:
+        json.dump(metrics, f, indent=2)
+    os.replace(tmp_path, output_path)
+
+
+def log_metrics(metrics, baseline=None):
+    birads, acr = metrics["birads"], metrics["acr"]
+
+    def fmt(value):
+        return "n/a" if value is None else f"{value:.3f}"
+
+    line = (
+        f"[{metrics['completed']}/{metrics['total']}] "
+        f"BI-RADS acc {fmt(birads['accuracy'])} "
+        f"(95% CI {birads['accuracy_ci95'][0]:.2f}-{birads['accuracy_ci95'][1]:.2f}, parsed {fmt(birads['parsed_rate'])}) | "
+        f"ACR acc {fmt(acr['accuracy'])} (parsed {fmt(acr['parsed_rate'])}) | "
+        f"{metrics['images_per_second']:.2f} img/s, {metrics['errors']} errors"
+    )
+    if baseline is not None:
+        line += f" | baseline BI-RADS acc {fmt((baseline.get('birads') or {}).get('accuracy'))}"
+    logging.info(line)
+
+
+# --- Workers ---
+
+_assistant = None
+_structured = False
+
+
+def _init_worker(model_path, assistant_kwargs, structured, device_queue):
+    """Load one model per worker process, pinned to its own GPU when devices are given."""
+    global _assistant, _structured
+    if device_queue is not None:
+        os.environ["CUDA_VISIBLE_DEVICES"] = str(device_queue.get())
+    from model import MammographyAssistant
+
+    _assistant = MammographyAssistant(model_path, **assistant_kwargs)
+    _structured = structured
+
+
+def _evaluate_image(image_path):
+    """Worker: returns (image_path, answer, seconds, error)."""
+    start = time.perf_counter()
+    try:
+        if _structured:
+            text = _assistant.analyze_structured(image_path)["text"]
+        else:
+            text = _assistant.analyze_mammogram(image_path)
+        return image_path, text, time.perf_counter() - start, None
+    except Exception as e:
+        return image_path, "", time.perf_counter() - start, str(e)
+
+
+def find_test_images(images_dir):
+    return sorted(
+        os.path.join(images_dir, f) for f in os.listdir(images_dir) if f.lower().endswith(".jpg")
+    )
+
+
+def get_arguments():
+    """Parses command-line arguments."""
+    parser = argparse.ArgumentParser(description="Evaluate a checkpoint on the test set with parallel workers.")
+    parser.add_argument("--model_path", default=MODEL_PATH, help=f"Model directory. Defaults to {MODEL_PATH}")
+    parser.add_argument("--test_set_dir", default=TEST_SET_DIR, help=f"Directory with test_set.csv and images/. Defaults to {TEST_SET_DIR}")
+    parser.add_argument("--workers", type=int, default=1, help="Worker processes, each with its own copy of the model. Defaults to 1")
+    parser.add_argument("--devices", nargs="+", default=None, help="GPU ids, one per worker (e.g. --devices 0 1).")
+    parser.add_argument("--fast_start", action="store_true", help="Use fast-start loading in each worker.")
+    parser.add_argument("--dtype", default=None, help="Load the weights in this torch dtype (e.g. bfloat16).")
+    parser.add_argument("--crop", action="store_true", help="Crop images to the breast before inference.")
+    parser.add_argument("--structured", action="store_true", help="Stop each generation once all report fields are produced.")
+    parser.add_argument("--speculative", action="store_true", help="Template-drafted assisted decoding (same output as greedy).")
+    parser.add_argument("--limit", type=int, default=None, help="Evaluate only this many (randomly chosen) images.")
+    parser.add_argument("--seed", type=int, default=RANDOM_SEED, help=f"Seed for the evaluation order. Defaults to {RANDOM_SEED}")
+    parser.add_argument("--report_every", type=int, default=REPORT_EVERY, help=f"Log and write partial metrics every N images. Defaults to {REPORT_EVERY}")
+    parser.add_argument("--predictions_path", default=PREDICTIONS_CSV_PATH, help=f"Per-image predictions CSV. Defaults to {PREDICTIONS_CSV_PATH}")
+    parser.add_argument("--metrics_path", default=METRICS_JSON_PATH, help=f"Metrics JSON, rewritten during the run. Defaults to {METRICS_JSON_PATH}")
+    parser.add_argument("--baseline", default=None, help="Metrics JSON of a previous checkpoint to compare against.")
+    parser.add_argument("--stop_if_worse", action="store_true", help="Stop early once BI-RADS accuracy is confidently below the baseline.")
+    return parser.parse_args()
+
+
+def main():
+    logging.basicConfig(
+        level=logging.INFO, format="%(asctime)s - %(levelname)s - %(message)s"
+    )
+    args = get_arguments()
+
+    ground_truth = load_ground_truth(os.path.join(args.test_set_dir, "test_set.csv"))
+    image_paths = find_test_images(os.path.join(args.test_set_dir, "images"))
+    # Random order, so partial metrics are a fair sample rather than the first patients by id
+    random.Random(args.seed).shuffle(image_paths)
+    if args.limit is not None:
+        image_paths = image_paths[:args.limit]
+
+    baseline = None
+    if args.baseline:
+        with open(args.baseline, "r", encoding="utf-8") as f:
+            baseline = json.load(f)
+
+    workers = len(args.devices) if args.devices else max(1, args.workers)
+    context = multiprocessing.get_context("spawn")
+    device_queue = None
+    if args.devices:
+        device_queue = context.Queue()
+        for device in args.devices:
+            device_queue.put(device)
+    assistant_kwargs = {
+        "fast_start": args.fast_start,
+        "dtype": args.dtype,
+        "crop_to_breast": args.crop,
+        "speculative": args.speculative,
+    }
+
+    logging.info(f"Evaluating {args.model_path} on {len(image_paths)} images with {workers} worker(s)")
+    evaluation = Evaluation(ground_truth, len(image_paths))
+    stopped_early = False
+
+    with open(args.predictions_path, "w", newline="", encoding="utf-8") as f, ProcessPoolExecutor(
+        max_workers=workers,
+        mp_context=context,
+        initializer=_init_worker,
+        initargs=(args.model_path, assistant_kwargs, args.structured, device_queue),
+    ) as executor:
+        writer = csv.writer(f)
+        writer.writerow([
+            "Image ID", "True BI-RADS", "Predicted BI-RADS", "True ACR", "Predicted ACR",
+            "Seconds", "Analysis",
+        ])
+        futures = [executor.submit(_evaluate_image, path) for path in image_paths]
+
+        for future in as_completed(futures):
+            image_path, text, seconds, error = future.result()
+            scored = evaluation.add(image_path, text, error)
+            writer.writerow([
+                image_id_from_path(image_path),
+                scored["truth"].get("birads"), scored["prediction"]["birads"],
+                scored["truth"].get("acr"), scored["prediction"]["acr"],
+                f"{seconds:.2f}", text if error is None else f"ERROR: {error}",
+            ])
+            f.flush()
+
+            if evaluation.completed % args.report_every == 0:
+                metrics = evaluation.metrics()
+                write_metrics(metrics, args.metrics_path)
+                log_metrics(metrics, baseline)
+                if baseline is not None and is_worse_than_baseline(metrics, baseline):
+                    logging.warning("BI-RADS accuracy is below the baseline with 95% confidence")
+                    if args.stop_if_worse:
+                        stopped_early = True
+                        for pending in futures:
+                            pending.cancel()
+                        break
+
+    metrics = evaluation.metrics()
+    metrics["stopped_early"] = stopped_early
+    write_metrics(metrics, args.metrics_path)
+    log_metrics(metrics, baseline)
+    logging.info(f"Predictions: {args.predictions_path}")
+    logging.info(f"Metrics: {args.metrics_path}")
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,233 @@
+"""
+inference_metrics.py
+Per-request instrumentation for MammographyAssistant.
+
+Each analysis records stage timings, token counts, throughput and peak RSS. Results
+are emitted as one JSON log line per request and aggregated into counters that can
+be rendered in the Prometheus text exposition format.
+"""
+
+import json
+import logging
+import os
+import resource
+import sys
+import threading
+import time
+from contextlib import contextmanager
+
+STAGES = ("image_load", "crop", "cache_lookup", "preprocess", "prefill", "decode", "batch_decode")
+
+logger = logging.getLogger("mammography.metrics")
+
+
+def speculative_tokens_per_step(accepted_tokens, steps):
+    """Tokens produced per target-model forward pass of assisted decoding."""
+    # Every verification step also yields the target model's own next token
+    return (accepted_tokens + steps) / steps if steps else 0.0
+
+
+def get_peak_rss_bytes():
+    """Returns the peak resident set size of this process in bytes."""
+    # Linux keeps ru_maxrss across exec, so a spawned worker would report its
+    # parent's peak; VmHWM starts afresh with each program
+    try:
+        with open("/proc/self/status", "r", encoding="ascii") as f:
+            for line in f:
+                if line.startswith("VmHWM:"):
+                    return int(line.split()[1]) * 1024
+    except (OSError, ValueError, IndexError):
+        pass
+    peak = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+    # Linux reports kilobytes, macOS reports bytes
+    return peak if sys.platform == "darwin" else peak * 1024
+
+
+def get_current_rss_bytes():
+    """Returns the current resident set size of this process in bytes (None if unavailable)."""
+    try:
+        with open("/proc/self/statm", "r", encoding="ascii") as f:
+            return int(f.read().split()[1]) * os.sysconf("SC_PAGE_SIZE")
+    except (OSError, ValueError, IndexError):
+        pass
+    try:
+        import psutil
+    except ImportError:
+        return None
+    return psutil.Process().memory_info().rss
+
+
+class RequestMetrics:
+    """Timings and counters for a single analysis."""
+
+    def __init__(self):
+        self.stage_seconds = {}
+        self.image_tokens = 0
+        self.prompt_tokens = 0
+        self.generated_tokens = 0
+        self.peak_rss_bytes = 0
+        self.started_at = time.perf_counter()
+        self.total_seconds = 0.0
+        self.crop_boxes = []
+        self.cache_hit = False
+        # Speculative decoding: verification steps and drafted/accepted tokens
+        self.speculative_steps = 0
+        self.draft_tokens = 0
+        self.accepted_draft_tokens = 0
+
+    @contextmanager
+    def stage(self, name):
+        """Times the enclosed block and adds it to the named stage."""
+        start = time.perf_counter()
+        try:
+            yield
+        finally:
+            self.stage_seconds[name] = self.stage_seconds.get(name, 0.0) + time.perf_counter() - start
+
+    def finish(self):
+        self.total_seconds = time.perf_counter() - self.started_at
+        self.peak_rss_bytes = get_peak_rss_bytes()
+
+    @property
+    def decode_tokens_per_second(self):
+        decode_seconds = self.stage_seconds.get("decode", 0.0)
+        # The first generated token is produced by the prefill pass
+        decode_tokens = max(self.generated_tokens - 1, 0)
+        return decode_tokens / decode_seconds if decode_seconds > 0 else 0.0
+
+    @property
+    def tokens_per_step(self):
+        """Generated tokens per target-model forward pass (1.0 without speculation)."""
+        if not self.speculative_steps:
+            return 1.0 if self.generated_tokens else 0.0
+        return speculative_tokens_per_step(self.accepted_draft_tokens, self.speculative_steps)
+
+    def to_dict(self):
+        return {
+            "stage_seconds": {k: round(v, 6) for k, v in self.stage_seconds.items()},
+            "total_seconds": round(self.total_seconds, 6),
+            "image_tokens": self.image_tokens,
+            "prompt_tokens": self.prompt_tokens,
+            "generated_tokens": self.generated_tokens,
+            "decode_tokens_per_second": round(self.decode_tokens_per_second, 3),
+            "peak_rss_bytes": self.peak_rss_bytes,
+            "crop_boxes": self.crop_boxes,
+            "cache_hit": self.cache_hit,
+            "speculative_steps": self.speculative_steps,
+            "draft_tokens": self.draft_tokens,
+            "accepted_draft_tokens": self.accepted_draft_tokens,
+        }
+
+
+class MetricsRegistry:
+    """Thread-safe aggregate of every RequestMetrics recorded by a process."""
+
+    def __init__(self):
+        self.lock = threading.Lock()
+        self.requests_total = 0
+        self.errors_total = 0
+        self.cache_hits_total = 0
+        self.stage_seconds_total = {stage: 0.0 for stage in STAGES}
+        self.request_seconds_total = 0.0
+        self.image_tokens_total = 0
+        self.prompt_tokens_total = 0
+        self.generated_tokens_total = 0
+        self.draft_tokens_total = 0
+        self.accepted_draft_tokens_total = 0
+        self.peak_rss_bytes = 0
+        self.last_request = None
+        self.startup_seconds = None
+
+    def record(self, metrics):
+        """Adds a finished request and writes its structured log line."""
+        with self.lock:
+            self.requests_total += 1
+            self.cache_hits_total += int(metrics.cache_hit)
+            for stage, seconds in metrics.stage_seconds.items():
+                self.stage_seconds_total[stage] = self.stage_seconds_total.get(stage, 0.0) + seconds
+            self.request_seconds_total += metrics.total_seconds
+            self.image_tokens_total += metrics.image_tokens
+            self.prompt_tokens_total += metrics.prompt_tokens
+            self.generated_tokens_total += metrics.generated_tokens
+            self.draft_tokens_total += metrics.draft_tokens
+            self.accepted_draft_tokens_total += metrics.accepted_draft_tokens
+            self.peak_rss_bytes = max(self.peak_rss_bytes, metrics.peak_rss_bytes)
+            self.last_request = metrics.to_dict()
+        logger.info(json.dumps({"event": "inference", **metrics.to_dict()}))
+
+    def record_error(self):
+        with self.lock:
+            self.errors_total += 1
+
+    def render_prometheus(self, prefix="mammography"):
+        """Renders the aggregates in the Prometheus text exposition format."""
+        with self.lock:
+            lines = [
+                f"# HELP {prefix}_requests_total Completed analyses.",
+                f"# TYPE {prefix}_requests_total counter",
+                f"{prefix}_requests_total {self.requests_total}",
+                f"# HELP {prefix}_errors_total Failed analyses.",
+                f"# TYPE {prefix}_errors_total counter",
+                f"{prefix}_errors_total {self.errors_total}",
+                f"# HELP {prefix}_cache_hits_total Analyses answered from the exact-match result cache.",
+                f"# TYPE {prefix}_cache_hits_total counter",
+                f"{prefix}_cache_hits_total {self.cache_hits_total}",
+                f"# HELP {prefix}_request_seconds_total Wall time spent in analyses.",
+                f"# TYPE {prefix}_request_seconds_total counter",
+                f"{prefix}_request_seconds_total {self.request_seconds_total:.6f}",
+                f"# HELP {prefix}_stage_seconds_total Wall time per inference stage.",
+                f"# TYPE {prefix}_stage_seconds_total counter",
+            ]
+            for stage, seconds in self.stage_seconds_total.items():
+                lines.append(f'{prefix}_stage_seconds_total{{stage="{stage}"}} {seconds:.6f}')
+            lines += [
+                f"# HELP {prefix}_tokens_total Tokens processed, by kind.",
+                f"# TYPE {prefix}_tokens_total counter",
+                f'{prefix}_tokens_total{{kind="image"}} {self.image_tokens_total}',
+                f'{prefix}_tokens_total{{kind="prompt"}} {self.prompt_tokens_total}',
+                f'{prefix}_tokens_total{{kind="generated"}} {self.generated_tokens_total}',
+                f'{prefix}_tokens_total{{kind="draft"}} {self.draft_tokens_total}',
+                f'{prefix}_tokens_total{{kind="accepted_draft"}} {self.accepted_draft_tokens_total}',
+                f"# HELP {prefix}_peak_rss_bytes Peak resident set size of the process.",
+                f"# TYPE {prefix}_peak_rss_bytes gauge",
+                f"{prefix}_peak_rss_bytes {max(self.peak_rss_bytes, get_peak_rss_bytes())}",
+            ]
+            if self.startup_seconds is not None:
+                lines += [
+                    f"# HELP {prefix}_startup_seconds Time from model load start until the worker was ready.",
+                    f"# TYPE {prefix}_startup_seconds gauge",
+                    f"{prefix}_startup_seconds {self.startup_seconds:.6f}",
+                ]
+        return "\n".join(lines) + "\n"
+
+
+class GenerationTimer:
+    """
+    Minimal transformers streamer that splits generate() into prefill and decode.
+    generate() calls put() once with the prompt, then once per new token.
+    """
+
+    def __init__(self):
+        self.started_at = None
+        self.first_token_at = None
+        self.ended_at = None
+        self.calls = 0
+
+    def put(self, value):
+        now = time.perf_counter()
+        self.calls += 1
+        if self.calls == 1:
+            self.started_at = now
+        elif self.first_token_at is None:
+            self.first_token_at = now
+
+    def end(self):
+        self.ended_at = time.perf_counter()
+
+    def apply_to(self, metrics):
+        """Stores prefill/decode durations on metrics once generation has finished."""
+        if self.started_at is None or self.ended_at is None:
+            return
+        first_token_at = self.first_token_at or self.ended_at
+        metrics.stage_seconds["prefill"] = first_token_at - self.started_at
+        metrics.stage_seconds["decode"] = self.ended_at - first_token_at
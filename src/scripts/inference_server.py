@@ -0,0 +1,153 @@
+"""
+inference_server.py
+Minimal HTTP inference service around MammographyAssistant.
+
+Uploads are analyzed straight from the request body, so nothing is written to disk
+between the HTTP layer and the model.
+
+    POST /analyze   body: encoded image bytes (JPEG/PNG/...), optional ?prompt=...
+                    and ?structured=1 for parsed findings/ACR/BI-RADS/recommendation
+    GET  /health
+    GET  /metrics   Prometheus text format (stage timings, tokens, peak RSS)
+
+Every analysis is also logged as one JSON line on the "mammography.metrics" logger.
+"""
+
+import argparse
+import json
+import logging
+import os
+import threading
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+from urllib.parse import parse_qs, urlparse
+
+from model import ImageDecodeError, MammographyAssistant
+
+SCRIPT_DIR = os.path.dirname(os.path.abspath(__file__))
+PROJECT_ROOT = os.path.dirname(os.path.dirname(SCRIPT_DIR))
+DEFAULT_MODEL_PATH = os.path.join(PROJECT_ROOT, "models", "mamography-finetune-8", "merged_model")
+DEFAULT_HOST = "127.0.0.1"
+DEFAULT_PORT = 8000
+MAX_UPLOAD_BYTES = 64 * 1024 * 1024
+
+
+def get_arguments():
+    """Parses command-line arguments."""
+    parser = argparse.ArgumentParser(description="Serve MammographyAssistant over HTTP.")
+    parser.add_argument("--model_path", default=DEFAULT_MODEL_PATH, help=f"Model directory. Defaults to {DEFAULT_MODEL_PATH}")
+    parser.add_argument("--host", default=DEFAULT_HOST, help=f"Bind address. Defaults to {DEFAULT_HOST}")
+    parser.add_argument("--port", type=int, default=DEFAULT_PORT, help=f"Port. Defaults to {DEFAULT_PORT}")
+    parser.add_argument("--fast_start", action="store_true", help="Memory-mapped, low-memory loading straight to the target dtype/device.")
+    parser.add_argument("--dtype", default=None, help="Load the weights in this torch dtype (e.g. bfloat16).")
+    parser.add_argument("--crop", action="store_true", help="Crop uploads to the breast before inference.")
+    parser.add_argument("--cache_size", type=int, default=0, help="Answers kept for re-uploads of pixel-identical images (0 disables the cache).")
+    parser.add_argument("--speculative", action="store_true", help="Template-drafted assisted decoding (same output as greedy).")
+    parser.add_argument("--draft_model", default=None, help="Small causal LM sharing the tokenizer, used as the speculative drafter.")
+    parser.add_argument("--no_warmup", action="store_true", help="Skip the warmup generation before serving.")
+    parser.add_argument("--profile_first_request", default=None, help="Write a torch profiler Chrome trace of the first request to this path.")
+    return parser.parse_args()
+
+
+class InferenceHandler(BaseHTTPRequestHandler):
+    """Routes requests to the shared assistant; generation is serialized by a lock."""
+
+    assistant = None
+    inference_lock = threading.Lock()
+
+    def send_json(self, status, payload):
+        body = json.dumps(payload, ensure_ascii=False).encode("utf-8")
+        self.send_response(status)
+        self.send_header("Content-Type", "application/json; charset=utf-8")
+        self.send_header("Content-Length", str(len(body)))
+        self.end_headers()
+        self.wfile.write(body)
+
+    def send_text(self, status, text, content_type="text/plain; version=0.0.4; charset=utf-8"):
+        body = text.encode("utf-8")
+        self.send_response(status)
+        self.send_header("Content-Type", content_type)
+        self.send_header("Content-Length", str(len(body)))
+        self.end_headers()
+        self.wfile.write(body)
+
+    def do_GET(self):
+        path = urlparse(self.path).path
+        if path == "/health":
+            self.send_json(200, {"status": "ok"})
+            return
+        if path == "/metrics":
+            self.send_text(200, self.assistant.metrics.render_prometheus())
+            return
+        self.send_json(404, {"error": "Not found"})
+
+    def do_POST(self):
+        url = urlparse(self.path)
+        if url.path != "/analyze":
+            self.send_json(404, {"error": "Not found"})
+            return
+
+        content_length = int(self.headers.get("Content-Length", 0))
+        if content_length <= 0:
+            self.send_json(400, {"error": "Empty request body"})
+            return
+        if content_length > MAX_UPLOAD_BYTES:
+            self.send_json(413, {"error": "Upload too large"})
+            return
+
+        image_bytes = self.rfile.read(content_length)
+        query = parse_qs(url.query)
+        prompt = query.get("prompt", [None])[0]
+        structured = query.get("structured", ["0"])[0].lower() in ("1", "true", "yes")
+
+        try:
+            with self.inference_lock:
+                # The assistant decodes the upload so the decode is timed as image_load
+                if structured:
+                    analysis = self.assistant.analyze_structured(image_bytes, prompt)
+                else:
+                    analysis = self.assistant.analyze_mammogram(image_bytes, prompt)
+                request_metrics = self.assistant.last_metrics.to_dict()
+        except ImageDecodeError as e:
+            # Only decoding errors are the client's fault; inference errors are a 500
+            self.send_json(400, {"error": str(e)})
+            return
+        except Exception as e:
+            self.send_json(500, {"error": str(e)})
+            return
+
+        self.send_json(200, {"analysis": analysis, "metrics": request_metrics})
+
+
+def main():
+    args = get_arguments()
+
+    if not os.path.isdir(args.model_path):
+        print(f"Error: Model directory not found at '{args.model_path}'")
+        exit(1)
+
+    logging.basicConfig(level=logging.INFO, format="%(asctime)s - %(levelname)s - %(message)s")
+
+    InferenceHandler.assistant = MammographyAssistant(
+        args.model_path,
+        fast_start=args.fast_start,
+        dtype=args.dtype,
+        warmup=not args.no_warmup,
+        crop_to_breast=args.crop,
+        cache_size=args.cache_size,
+        speculative=args.speculative,
+        draft_model_path=args.draft_model
+    )
+    if args.profile_first_request:
+        InferenceHandler.assistant.profile_next_request(args.profile_first_request)
+    server = ThreadingHTTPServer((args.host, args.port), InferenceHandler)
+    print(f"Inference service listening on http://{args.host}:{args.port}")
+    try:
+        server.serve_forever()
+    except KeyboardInterrupt:
+        print("\nShutting down.")
+    finally:
+        server.server_close()
+
+
+if __name__ == "__main__":
+    main()
@@ -3,100 +3,701 @@ mammography_inference.py
 Run inference with fine-tuned LFM2-VL-1.6B mammography model
 """
 
+import contextlib
 import csv
-from transformers import AutoProcessor, AutoModelForImageTextToText
+import hashlib
+import importlib.util
+import io
+import json
+import os
+import re
+import time
+from collections import OrderedDict
 from PIL import Image
-import torch
+import numpy as np
 import argparse
 
+from inference_metrics import GenerationTimer, MetricsRegistry, RequestMetrics, get_current_rss_bytes
+from report_fields import REPORT_FIELDS, is_report_complete, parse_report
+from breast_crop import crop_image_to_breast
+from template_drafting import TemplateDrafter, install_speculation
+
+# torch and transformers are imported inside the methods that need them, so that
+# importing this module (e.g. from the inference server) stays cheap.
+
+DEFAULT_PROMPT = "Please provide a complete radiological assessment of this mammogram. Include the BI-RADS category, detailed finding notes, your diagnosis, and any recommended next steps."
+
+DEFAULT_STUDY_PROMPT = (
+    "These are the views of one screening mammography study. Compare both breasts and all views, "
+    "then provide a complete radiological assessment including detailed finding notes, breast density, "
+    "your diagnosis and any recommended next steps. End with one line per breast in the form "
+    "'Right breast: BI-RADS <category>' and 'Left breast: BI-RADS <category>'."
+)
+
+# Screening order radiologists read a study in: R/L CC, then R/L MLO
+VIEW_ORDER = [("R", "CC"), ("L", "CC"), ("R", "MLO"), ("L", "MLO")]
+LATERALITY_NAMES = {"R": "Right", "L": "Left"}
+
+# e.g. 22678622_61b13c59bcba149e_MG_R_CC_ANON.jpg -> image id, study id, laterality, view
+VIEW_FILENAME_PATTERN = re.compile(
+    r"^(?P<image_id>[^_]+)_(?P<study_id>[^_]+)_MG_(?P<laterality>[LR])_(?P<view>CC|MLO)",
+    re.IGNORECASE
+)
+BREAST_BIRADS_PATTERN = re.compile(
+    r"\b(?P<side>left|right)\s+breast\b[^\n.]*?BI-?RADS\s*(?:category\s*)?(?P<category>[0-6][abc]?)",
+    re.IGNORECASE
+)
+
+# Trained answers are one short paragraph; structured mode stops long before this cap
+STRUCTURED_MAX_NEW_TOKENS = 192
+
+# Written next to the weights by export_fast_start_artifact
+FAST_START_MARKER = "fast_start.json"
+WARMUP_IMAGE_SIZE = (64, 64)
+
+# Tokens drafted per verification step in speculative mode
+SPECULATIVE_DRAFT_TOKENS = 10
+
+
+def resolve_dtype(dtype):
+    """Map a dtype name such as 'bfloat16' to the torch dtype (None passes through)."""
+    import torch
+
+    if dtype is None or not isinstance(dtype, str):
+        return dtype
+    if dtype == "auto":
+        return "auto"
+    resolved = getattr(torch, dtype, None)
+    if not isinstance(resolved, torch.dtype):
+        raise ValueError(f"Unknown torch dtype: {dtype}")
+    return resolved
+
+
+def read_fast_start_marker(model_path):
+    """Return the fast-start metadata stored with a converted artifact, or None."""
+    marker_path = os.path.join(model_path, FAST_START_MARKER)
+    if not os.path.isfile(marker_path):
+        return None
+    with open(marker_path, "r", encoding="utf-8") as f:
+        return json.load(f)
+
+
+def export_fast_start_artifact(model_path, output_dir, dtype="bfloat16"):
+    """
+    Convert a checkpoint once to the serving dtype and save it as safetensors, so
+    workers can memory-map it straight into the right dtype at startup.
+    
+    Args:
+        model_path: Source checkpoint directory
+        output_dir: Where to write the converted artifact
+        dtype: Target torch dtype name (e.g. 'bfloat16', 'float16', 'float32')
+    """
+    from transformers import AutoProcessor, AutoModelForImageTextToText
+
+    torch_dtype = resolve_dtype(dtype)
+    model = AutoModelForImageTextToText.from_pretrained(
+        model_path,
+        trust_remote_code=True,
+        dtype=torch_dtype,
+        low_cpu_mem_usage=True
+    )
+    model.save_pretrained(output_dir, safe_serialization=True)
+    AutoProcessor.from_pretrained(model_path, trust_remote_code=True).save_pretrained(output_dir)
+    with open(os.path.join(output_dir, FAST_START_MARKER), "w", encoding="utf-8") as f:
+        json.dump({"dtype": dtype, "source": os.path.abspath(model_path)}, f, indent=2)
+    print(f"✓ Fast-start artifact ({dtype}) written to {output_dir}")
+
+
+def load_image(source):
+    """
+    Convert any supported image source into an RGB PIL image without touching disk
+    unless a path is given.
+
+    Args:
+        source: Filesystem path (str or os.PathLike), encoded image bytes
+                (JPEG/PNG/...), a NumPy array (HxW grayscale or HxWxC), or a PIL image
+
+    Returns:
+        PIL.Image.Image: RGB image
+    """
+    if isinstance(source, Image.Image):
+        image = source
+    elif isinstance(source, (bytes, bytearray, memoryview)):
+        image = Image.open(io.BytesIO(source))
+    elif isinstance(source, np.ndarray):
+        array = source
+        if array.dtype != np.uint8:
+            # Scale high bit-depth arrays (e.g. raw 12/16-bit pixels) into 8-bit range;
+            # data with negative values (signed pixels) is shifted so its minimum maps to 0
+            array = array.astype(np.float32)
+            min_value = min(float(array.min()), 0.0)
+            value_range = float(array.max()) - min_value
+            if value_range > 0:
+                array = (array - min_value) / value_range * 255.0
+            array = np.clip(array, 0.0, 255.0).astype(np.uint8)
+        image = Image.fromarray(array)
+    elif isinstance(source, (str, os.PathLike)):
+        image = Image.open(source)
+    else:
+        raise TypeError(f"Unsupported image source type: {type(source).__name__}")
+
+    return image.convert('RGB')
+
+
+def parse_view_filename(image_path):
+    """
+    Extract the identifiers encoded in an image file name.
+    
+    Args:
+        image_path: Path or name like '22678622_61b13c59bcba149e_MG_R_CC_ANON.jpg'
+    
+    Returns:
+        dict with image_id, study_id, laterality ('L'/'R') and view ('CC'/'MLO'),
+        or None if the name does not follow the convention
+    """
+    match = VIEW_FILENAME_PATTERN.match(os.path.basename(str(image_path)))
+    if match is None:
+        return None
+    info = match.groupdict()
+    info["laterality"] = info["laterality"].upper()
+    info["view"] = info["view"].upper()
+    return info
+
+
+def group_by_study(image_paths):
+    """
+    Group image paths into studies using the study ID in their file names.
+    
+    Args:
+        image_paths: Iterable of image paths
+    
+    Returns:
+        dict: study_id -> {(laterality, view): path}; files that do not follow
+              the naming convention are skipped
+    """
+    studies = {}
+    for image_path in image_paths:
+        info = parse_view_filename(image_path)
+        if info is None:
+            print(f"!! Skipping {image_path}: cannot determine study and view from the file name")
+            continue
+        views = studies.setdefault(info["study_id"], {})
+        views.setdefault((info["laterality"], info["view"]), image_path)
+    return studies
+
+
+def parse_breast_birads(text):
+    """
+    Extract the per-breast BI-RADS categories from a study-level answer.
+    
+    Returns:
+        dict: {'R': category or None, 'L': category or None}; the last mention wins
+    """
+    birads = {"R": None, "L": None}
+    for match in BREAST_BIRADS_PATTERN.finditer(text):
+        birads[match.group("side")[0].upper()] = match.group("category").lower()
+    return birads
+
+
+def make_report_stopping_criteria(tokenizer, prompt_length):
+    """
+    Build a transformers StoppingCriteriaList that ends generation as soon as the
+    answer contains every structured field (see report_fields.is_report_complete).
+    
+    Args:
+        tokenizer: Tokenizer used to decode the generated tokens
+        prompt_length: Number of prompt tokens to skip when decoding
+    """
+    import torch
+    from transformers import StoppingCriteria, StoppingCriteriaList
+
+    class ReportCompleteCriteria(StoppingCriteria):
+        def __call__(self, input_ids, scores, **kwargs):
+            done = [
+                is_report_complete(tokenizer.decode(sequence[prompt_length:], skip_special_tokens=True))
+                for sequence in input_ids
+            ]
+            return torch.tensor(done, dtype=torch.bool, device=input_ids.device)
+
+    return StoppingCriteriaList([ReportCompleteCriteria()])
+
+
+def image_content_hash(image):
+    """SHA-256 of a PIL image's mode, size and pixels; equal only for identical pixel data."""
+    digest = hashlib.sha256(f"{image.mode}:{image.size}".encode("ascii"))
+    digest.update(image.tobytes())
+    return digest.hexdigest()
+
+
+class ImageDecodeError(ValueError):
+    """Raised when an image source cannot be decoded, e.g. a corrupt or unsupported upload."""
+
+
+class ResultCache:
+    """
+    Bounded FIFO cache of answers keyed by prompt/mode and image content hash.
+    Only pixel-identical images hit; a near-duplicate is a different image and
+    must get its own report.
+    """
+
+    def __init__(self, max_entries):
+        self.max_entries = max_entries
+        self.entries = OrderedDict()
+
+    def get(self, key):
+        return self.entries.get(key)
+
+    def put(self, key, value):
+        self.entries[key] = value
+        while len(self.entries) > self.max_entries:
+            self.entries.popitem(last=False)
+
+
 class MammographyAssistant:
-    def __init__(self, model_path):
+    def __init__(self, model_path, fast_start=False, dtype=None, warmup=False, crop_to_breast=False,
+                 cache_size=0, speculative=False,
+                 draft_model_path=None):
         """
         Initialize the fine-tuned mammography model
         
         Args:
             model_path: Path to fine-tuned checkpoint
                        (e.g., './mammography-finetune-4/checkpoint-final')
+            fast_start: Memory-map safetensors and load them directly to the target
+                        dtype/device instead of materialising a CPU copy first
+            dtype: Optional torch dtype name; defaults to the dtype recorded in a
+                   fast-start artifact, otherwise the checkpoint's own dtype
+            warmup: Run one tiny generation after loading so the first real
+                    request does not pay one-off initialisation costs
+            crop_to_breast: Crop each image to the breast bounding box before
+                            inference; boxes are kept in last_metrics.crop_boxes
+            cache_size: Number of single-image answers to keep; only an image
+                        with exactly the same pixels (after cropping) and prompt
+                        reuses a cached answer (0 disables the cache)
+            speculative: Assisted greedy decoding: tokens drafted from the answer
+                         templates (or prompt lookup) are verified several per
+                         forward pass; the output is the same as plain greedy
+            draft_model_path: Small causal LM with the same tokenizer to draft with
+                              instead of the templates (implies speculative)
         """
+        import torch
+        from transformers import AutoProcessor, AutoModelForImageTextToText
+
+        start = time.perf_counter()
+        start_rss_bytes = get_current_rss_bytes()
         self.device = "cuda" if torch.cuda.is_available() else "cpu"
-        print(f"Loading model and processor onto {self.device}...")
-        self.model = AutoModelForImageTextToText.from_pretrained(
-            model_path,
-            trust_remote_code=True
-        ).to(self.device)
+
+        marker = read_fast_start_marker(model_path)
+        if marker is not None:
+            fast_start = True
+            dtype = dtype or marker.get("dtype")
+
+        print(f"Loading model and processor onto {self.device}{' (fast start)' if fast_start else ''}...")
+        if fast_start:
+            load_kwargs = {
+                "trust_remote_code": True,
+                "use_safetensors": True,
+                "low_cpu_mem_usage": True,
+                "dtype": resolve_dtype(dtype) or "auto",
+            }
+            # device_map places weights on the target device while loading (needs accelerate)
+            if importlib.util.find_spec("accelerate") is not None:
+                load_kwargs["device_map"] = self.device
+            self.model = AutoModelForImageTextToText.from_pretrained(model_path, **load_kwargs)
+            if "device_map" not in load_kwargs:
+                self.model.to(self.device)
+        else:
+            load_kwargs = {"trust_remote_code": True}
+            if dtype is not None:
+                load_kwargs["dtype"] = resolve_dtype(dtype)
+            self.model = AutoModelForImageTextToText.from_pretrained(
+                model_path,
+                **load_kwargs
+            ).to(self.device)
+        self.model.eval()
         self.processor = AutoProcessor.from_pretrained(
             model_path,
             trust_remote_code=True
         )
-        print("✓ Model loaded")
+        self.image_token_id = self._find_image_token_id()
+        self.metrics = MetricsRegistry()
+        self.last_metrics = None
+        self.profile_trace_path = None
+        self.crop_to_breast = crop_to_breast
+        self.cache = ResultCache(cache_size) if cache_size > 0 else None
+
+        self.draft_model = None
+        self.drafter = None
+        self.speculation = None
+        if draft_model_path is not None:
+            # Without the hook the draft model would be handed the image features too
+            self.speculation = install_speculation(self.model)
+            if self.speculation is not None:
+                from transformers import AutoModelForCausalLM
+
+                self.draft_model = AutoModelForCausalLM.from_pretrained(
+                    draft_model_path, dtype=self.model.dtype
+                ).to(self.device).eval()
+        elif speculative:
+            blocked_token_ids = [self.image_token_id] if self.image_token_id is not None else []
+            self.drafter = TemplateDrafter(self.processor.tokenizer, blocked_token_ids=blocked_token_ids)
+            self.speculation = install_speculation(self.model, self.drafter)
+            if self.speculation is None:
+                self.drafter = None
+
+        self.load_seconds = time.perf_counter() - start
+        if warmup:
+            self.warmup()
+        self.startup_seconds = time.perf_counter() - start
+        # Growth of current RSS over loading; the process-wide peak (ru_maxrss) would also
+        # include whatever ran before, e.g. another assistant loaded in the same process
+        end_rss_bytes = get_current_rss_bytes()
+        self.startup_rss_bytes = None if start_rss_bytes is None else end_rss_bytes - start_rss_bytes
+        self.metrics.startup_seconds = self.startup_seconds
+        rss_note = "" if self.startup_rss_bytes is None else f", +{self.startup_rss_bytes / 2**20:.0f} MiB RSS"
+        print(f"✓ Model loaded in {self.load_seconds:.2f}s (ready in {self.startup_seconds:.2f}s{rss_note})")
+
+    def warmup(self):
+        """Run a single-token generation on a blank image to initialise kernels and caches."""
+        content = [
+            {"type": "image", "image": Image.new("RGB", WARMUP_IMAGE_SIZE)},
+            {"type": "text", "text": DEFAULT_PROMPT}
+        ]
+        # Not recorded in self.metrics: warmup is not a real request
+        self._generate(content, RequestMetrics(), max_new_tokens=1)
+
+    def _find_image_token_id(self):
+        """Looks up the placeholder token id the processor expands image tiles into."""
+        token_id = getattr(self.processor, "image_token_id", None)
+        if token_id is None:
+            config = self.model.config
+            token_id = getattr(config, "image_token_id", getattr(config, "image_token_index", None))
+        return token_id
+
+    def profile_next_request(self, trace_path):
+        """
+        Record a torch profiler trace for the next analysis only
+        
+        Args:
+            trace_path: Where to write the Chrome trace JSON
+        """
+        self.profile_trace_path = trace_path
 
     def analyze_mammogram(self, image_path, custom_prompt=None):
         """ 
         Analyze a mammogram image
         
         Args:
-            image_path: Path to mammogram image
+            image_path: Path to mammogram image. Encoded bytes, NumPy arrays and
+                        PIL images are accepted too (see load_image)
+            custom_prompt: Optional custom prompt (uses default if None)
+        
+        Returns:
+            str: Model's analysis
+        """
+        metrics = RequestMetrics()
+        image = self._load_image(image_path, metrics)
+        return self.analyze_image(image, custom_prompt, metrics=metrics)
+
+    def analyze_structured(self, image_path, custom_prompt=None):
+        """
+        Analyze a mammogram and return the answer as parsed fields, stopping
+        generation as soon as findings, ACR, BI-RADS and recommendation are produced
+        
+        Args:
+            image_path: Anything load_image accepts
+            custom_prompt: Optional custom prompt (uses default if None)
+        
+        Returns:
+            dict: findings, acr, birads, recommendation (None if missing) and the raw text
+        """
+        metrics = RequestMetrics()
+        image = self._load_image(image_path, metrics)
+        content = [
+            {"type": "image", "image": image},
+            {"type": "text", "text": custom_prompt or DEFAULT_PROMPT}
+        ]
+        text = self._run(content, metrics, structured=True)
+        fields = parse_report(text)
+        fields["text"] = text
+        fields["crop_box"] = metrics.crop_boxes[0] if metrics.crop_boxes else None
+        return fields
+
+    def analyze_bytes(self, image_bytes, custom_prompt=None):
+        """
+        Analyze an encoded image held in memory, e.g. the body of an HTTP upload
+        
+        Args:
+            image_bytes: Encoded image (JPEG/PNG/...) as bytes
             custom_prompt: Optional custom prompt (uses default if None)
         
         Returns:
             str: Model's analysis
         """
-        image = Image.open(image_path).convert('RGB')
+        metrics = RequestMetrics()
+        image = self._load_image(image_bytes, metrics)
+        return self.analyze_image(image, custom_prompt, metrics=metrics)
+
+    def analyze_array(self, pixel_array, custom_prompt=None):
+        """
+        Analyze a mammogram given as a NumPy pixel array
+        
+        Args:
+            pixel_array: HxW grayscale or HxWxC array; non-uint8 data is rescaled
+            custom_prompt: Optional custom prompt (uses default if None)
+        
+        Returns:
+            str: Model's analysis
+        """
+        metrics = RequestMetrics()
+        image = self._load_image(pixel_array, metrics)
+        return self.analyze_image(image, custom_prompt, metrics=metrics)
+
+    def _load_image(self, source, metrics):
+        """
+        Decode source with load_image (timed, failures counted as errors). Decoding
+        failures are raised as ImageDecodeError so callers can tell them apart from
+        inference failures.
+        """
+        try:
+            with metrics.stage("image_load"):
+                return load_image(source)
+        except (OSError, ValueError, TypeError, Image.DecompressionBombError) as e:
+            # PIL raises UnidentifiedImageError (an OSError) for undecodable data
+            self.metrics.record_error()
+            raise ImageDecodeError(f"Could not decode image: {e}") from e
+        except Exception:
+            self.metrics.record_error()
+            raise
+
+    def _crop_images(self, content, metrics):
+        """Crop every image of a user turn to the breast, recording the boxes in metrics."""
+        cropped = []
+        for part in content:
+            if part["type"] == "image":
+                with metrics.stage("crop"):
+                    image, box = crop_image_to_breast(part["image"])
+                metrics.crop_boxes.append(box)
+                part = dict(part, image=image)
+            cropped.append(part)
+        return cropped
+
+    def analyze_image(self, image, custom_prompt=None, metrics=None):
+        """
+        Analyze an already decoded PIL image
+        
+        Args:
+            image: PIL image (converted to RGB if needed)
+            custom_prompt: Optional custom prompt (uses default if None)
+            metrics: Optional RequestMetrics already holding the image load time
+        
+        Returns:
+            str: Model's analysis
+        """
+        if image.mode != 'RGB':
+            image = image.convert('RGB')
+
+        if custom_prompt is None:
+            custom_prompt = DEFAULT_PROMPT
+
+        content = [
+            {"type": "image", "image": image},
+            {"type": "text", "text": custom_prompt}
+        ]
+        return self._run(content, metrics)
+
+    def analyze_study(self, views, custom_prompt=None):
+        """
+        Analyze all views of one study in a single conversation and generation
+        
+        Args:
+            views: dict {(laterality, view): image source}, e.g. {('R', 'CC'): path};
+                   sources may be anything load_image accepts
+            custom_prompt: Optional custom prompt (uses DEFAULT_STUDY_PROMPT if None)
+        
+        Returns:
+            dict: 'assessment' (combined text), 'birads' ({'R': ..., 'L': ...})
+                  and 'views' (the (laterality, view) keys in the order shown)
+        """
+        if not views:
+            raise ValueError("A study needs at least one view")
 
         if custom_prompt is None:
-            custom_prompt = "Please provide a complete radiological assessment of this mammogram. Include the BI-RADS category, detailed finding notes, your diagnosis, and any recommended next steps."
+            custom_prompt = DEFAULT_STUDY_PROMPT
+
+        ordered_keys = [key for key in VIEW_ORDER if key in views]
+        ordered_keys += sorted(key for key in views if key not in VIEW_ORDER)
+
+        metrics = RequestMetrics()
+        content = []
+        for laterality, view in ordered_keys:
+            image = self._load_image(views[(laterality, view)], metrics)
+            label = f"{LATERALITY_NAMES.get(laterality, laterality)} {view} view:"
+            content.append({"type": "text", "text": label})
+            content.append({"type": "image", "image": image})
+        content.append({"type": "text", "text": custom_prompt})
+
+        assessment = self._run(content, metrics)
+        return {
+            "assessment": assessment,
+            "birads": parse_breast_birads(assessment),
+            "views": ordered_keys,
+        }
+
+    def _run(self, content, metrics=None, structured=False):
+        """Generate a reply to one user turn, with profiling and metrics recording."""
+        import torch
+
+        if metrics is None:
+            metrics = RequestMetrics()
+        # Every entry point (paths, bytes, arrays, PIL images, studies) passes through here
+        if self.crop_to_breast:
+            content = self._crop_images(content, metrics)
+
+        cache_key = None
+        images = [part["image"] for part in content if part["type"] == "image"]
+        if self.cache is not None and len(images) == 1:
+            with metrics.stage("cache_lookup"):
+                cache_key = (structured, image_content_hash(images[0])) + tuple(
+                    part["text"] for part in content if part["type"] == "text"
+                )
+                cached = self.cache.get(cache_key)
+            if cached is not None:
+                metrics.cache_hit = True
+                metrics.finish()
+                self.last_metrics = metrics
+                self.metrics.record(metrics)
+                return cached
+
+        trace_path, self.profile_trace_path = self.profile_trace_path, None
+        if trace_path is None:
+            profiler = contextlib.nullcontext()
+        else:
+            profiler = torch.profiler.profile(record_shapes=True, profile_memory=True)
+
+        try:
+            with profiler:
+                response = self._generate(content, metrics, structured=structured)
+        except Exception:
+            self.metrics.record_error()
+            raise
+
+        if trace_path is not None:
+            profiler.export_chrome_trace(str(trace_path))
+            print(f"Profiler trace written to {trace_path}")
+
+        if cache_key is not None:
+            self.cache.put(cache_key, response)
+
+        metrics.finish()
+        self.last_metrics = metrics
+        self.metrics.record(metrics)
+        return response
+
+    def _generate(self, content, metrics, max_new_tokens=512, structured=False):
+        """Runs templating, generation and decoding, recording each stage on metrics."""
+        import torch
 
         conversation = [
             {
                 "role": "user",
-                "content": [
-                    {"type": "image", "image": image},
-                    {"type": "text", "text": custom_prompt}
-                ]
+                "content": content
             }
         ]
 
-        inputs = self.processor.apply_chat_template(
-            conversation,
-            add_generation_prompt=True,
-            return_tensors="pt",
-            return_dict=True,
-            tokenize=True
-        ).to(self.model.device)
+        with metrics.stage("preprocess"):
+            inputs = self.processor.apply_chat_template(
+                conversation,
+                add_generation_prompt=True,
+                return_tensors="pt",
+                return_dict=True,
+                tokenize=True
+            ).to(self.model.device)
+
+        input_ids = inputs["input_ids"]
+        metrics.prompt_tokens = int(input_ids.shape[1])
+        if self.image_token_id is not None:
+            metrics.image_tokens = int((input_ids == self.image_token_id).sum().item())
+
+        generate_kwargs = {}
+        if self.draft_model is not None:
+            generate_kwargs["assistant_model"] = self.draft_model
+        elif self.drafter is not None:
+            generate_kwargs["prompt_lookup_num_tokens"] = SPECULATIVE_DRAFT_TOKENS
+        if structured:
+            generate_kwargs["stopping_criteria"] = make_report_stopping_criteria(
+                self.processor.tokenizer, metrics.prompt_tokens
+            )
+            max_new_tokens = min(max_new_tokens, STRUCTURED_MAX_NEW_TOKENS)
 
         print("Analyzing mammogram...")
+        timer = GenerationTimer()
         with torch.no_grad():
             outputs = self.model.generate(
                 **inputs,
-                max_new_tokens=512,
+                max_new_tokens=max_new_tokens,
                 do_sample=False,
                 temperature=None,
                 min_p=None,
-                repetition_penalty=None
+                repetition_penalty=None,
+                streamer=timer,
+                **generate_kwargs
             )
+        timer.apply_to(metrics)
+        metrics.generated_tokens = int(outputs.shape[1] - input_ids.shape[1])
+        if self.speculation is not None and self.speculation.last_stats is not None:
+            stats = self.speculation.last_stats
+            metrics.speculative_steps = stats.steps
+            metrics.draft_tokens = stats.draft_tokens
+            metrics.accepted_draft_tokens = stats.accepted_tokens
 
-        response = self.processor.batch_decode(outputs, skip_special_tokens=True)[0]
+        with metrics.stage("batch_decode"):
+            response = self.processor.batch_decode(outputs, skip_special_tokens=True)[0]
         if "assistant\n" in response:
             response = response.split("assistant\n")[1].strip()
         return response
 
-    def batch_analyze(self, image_paths, csv_writer):
+    @staticmethod
+    def print_metrics(metrics):
+        """Print a one-line summary of a request's stage timings and token counts."""
+        stages = ", ".join(f"{name} {seconds * 1000:.0f}ms" for name, seconds in metrics.stage_seconds.items())
+        print(
+            f"   {stages} | image tokens {metrics.image_tokens}, generated {metrics.generated_tokens} "
+            f"({metrics.decode_tokens_per_second:.1f} tok/s) | peak RSS {metrics.peak_rss_bytes / 2**20:.0f} MiB"
+        )
+        if metrics.speculative_steps:
+            print(
+                f"   speculative: {metrics.accepted_draft_tokens}/{metrics.draft_tokens} drafted tokens accepted, "
+                f"{metrics.tokens_per_step:.2f} tokens per forward pass"
+            )
+
+    def batch_analyze(self, image_paths, csv_writer, structured=False):
         """
         Analyze multiple mammograms and write results to a CSV file row by row.
         
         Args:
             image_paths: List of paths to mammogram images.
             csv_writer: A csv.writer object to write results.
+            structured: Write findings/ACR/BI-RADS/recommendation columns using
+                        analyze_structured instead of the free-text analysis
         """
         for i, img_path in enumerate(image_paths, 1):
             print(f"\n[{i}/{len(image_paths)}] Analyzing: {img_path}")
             
             try:
+                image_id = os.path.basename(img_path).split('_')[0]
+                if structured:
+                    fields = self.analyze_structured(img_path)
+                    print(f"-> ACR {fields['acr']}, BI-RADS {fields['birads']}: {fields['recommendation']}")
+                    self.print_metrics(self.last_metrics)
+                    csv_writer.writerow([image_id] + [fields[name] for name in REPORT_FIELDS])
+                    continue
+
                 analysis = self.analyze_mammogram(img_path)
                 print(f"-> Analysis result: {analysis[:120]}...") # Print a snippet
+                self.print_metrics(self.last_metrics)
                 
-                # Extract image ID and write to CSV
-                image_id = os.path.basename(img_path).split('_')[0]
+                # Write to CSV
                 csv_writer.writerow([image_id, analysis])
                 
             except Exception as e:
@@ -104,39 +705,92 @@ class MammographyAssistant:
                 image_id = os.path.basename(img_path).split('_')[0]
                 csv_writer.writerow([image_id, f"ERROR: {e}"])
 
-if __name__ == "__main__":
-    import os
+    def batch_analyze_studies(self, image_paths, csv_writer):
+        """
+        Group images by study, analyze each study in one call and write results row by row.
+        
+        Args:
+            image_paths: List of paths to mammogram images.
+            csv_writer: A csv.writer object to write results.
+        """
+        studies = group_by_study(image_paths)
+        for i, (study_id, views) in enumerate(studies.items(), 1):
+            view_names = ", ".join(f"{lat}_{view}" for lat, view in views)
+            print(f"\n[{i}/{len(studies)}] Analyzing study {study_id} ({view_names})")
 
+            try:
+                result = self.analyze_study(views)
+                print(f"-> Right: BI-RADS {result['birads']['R']}, Left: BI-RADS {result['birads']['L']}")
+                self.print_metrics(self.last_metrics)
+                csv_writer.writerow([study_id, result["birads"]["R"], result["birads"]["L"], result["assessment"]])
+
+            except Exception as e:
+                print(f"!! Failed to analyze study {study_id}: {e}")
+                csv_writer.writerow([study_id, None, None, f"ERROR: {e}"])
+
+if __name__ == "__main__":
     SCRIPT_DIR = os.path.dirname(os.path.abspath(__file__))
     PROJECT_ROOT = os.path.dirname(os.path.dirname(SCRIPT_DIR))
     MODEL_PATH = os.path.join(PROJECT_ROOT, "models", "mamography-finetune-8", "merged_model")
     RESULTS_CSV_PATH = os.path.join(PROJECT_ROOT, "mammography_results.csv")
 
-    if not os.path.isdir(MODEL_PATH):
-        print(f"Error: Model directory not found at '{MODEL_PATH}'")
+    parser = argparse.ArgumentParser(description="Run batch inference over the test set.")
+    parser.add_argument("--model_path", default=MODEL_PATH, help=f"Model directory. Defaults to {MODEL_PATH}")
+    parser.add_argument("--fast_start", action="store_true", help="Memory-mapped, low-memory loading straight to the target dtype/device.")
+    parser.add_argument("--dtype", default=None, help="Load the weights in this torch dtype (e.g. bfloat16).")
+    parser.add_argument("--structured", action="store_true", help="Write parsed findings/ACR/BI-RADS/recommendation columns and stop generation early.")
+    parser.add_argument("--crop", action="store_true", help="Crop images to the breast before inference.")
+    parser.add_argument("--by_study", action="store_true", help="Analyze all views of each study in one call.")
+    parser.add_argument("--speculative", action="store_true", help="Draft tokens from the answer templates and verify several per forward pass (same output as greedy).")
+    parser.add_argument("--draft_model", default=None, help="Small causal LM sharing the tokenizer, used as the speculative drafter instead of the templates.")
+    parser.add_argument("--export_fast_start", default=None, metavar="DIR", help="Write a pre-converted fast-start artifact to DIR and exit.")
+    args = parser.parse_args()
+
+    if not os.path.isdir(args.model_path):
+        print(f"Error: Model directory not found at '{args.model_path}'")
         print("Please make sure the model is located at 'models/mamography-finetune-8/merged_model'")
         exit(1)
 
-    print(f"Using model: {MODEL_PATH}")
+    if args.export_fast_start:
+        export_fast_start_artifact(args.model_path, args.export_fast_start, args.dtype or "bfloat16")
+        exit(0)
+
+    print(f"Using model: {args.model_path}")
 
-    assistant = MammographyAssistant(MODEL_PATH)
+    assistant = MammographyAssistant(
+        args.model_path,
+        fast_start=args.fast_start,
+        dtype=args.dtype,
+        crop_to_breast=args.crop,
+        speculative=args.speculative,
+        draft_model_path=args.draft_model
+    )
 
     test_images_dir = os.path.join(PROJECT_ROOT, "src", "data", "test-set", "images")
     test_images = sorted([os.path.join(test_images_dir, f) for f in os.listdir(test_images_dir) if f.endswith(".jpg")])
 
-    test_images = test_images[:10]
+    if not args.by_study:
+        test_images = test_images[:10]
     print(f"Testing with {len(test_images)} images")
 
     try:
         with open(RESULTS_CSV_PATH, "w", newline="", encoding="utf-8") as f:
             writer = csv.writer(f)
-            writer.writerow(["Image ID", "Analysis"])
+            if args.by_study:
+                writer.writerow(["Study ID", "Right BI-RADS", "Left BI-RADS", "Analysis"])
+            elif args.structured:
+                writer.writerow(["Image ID", "Findings", "ACR", "BI-RADS", "Recommendation"])
+            else:
+                writer.writerow(["Image ID", "Analysis"])
 
             print("\n" + "="*60)
             print(f"Batch Analysis Started: Writing results to {RESULTS_CSV_PATH}")
             print("="*60)
 
-            assistant.batch_analyze(test_images, writer)
+            if args.by_study:
+                assistant.batch_analyze_studies(test_images, writer)
+            else:
+                assistant.batch_analyze(test_images, writer, structured=args.structured)
 
         print(f"\n✓ Batch analysis complete. Results saved to {RESULTS_CSV_PATH}")
 
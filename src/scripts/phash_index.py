@@ -0,0 +1,232 @@
+"""
+phash_index.py
+Perceptual-hash index for finding near-duplicate mammograms.
+
+Each image is reduced to a 256-bit DCT hash (pHash): grayscale, resized to 64x64,
+2D DCT, and the top-left 16x16 low-frequency block thresholded at its median.
+Hashes are stored as rows of four uint64 words. Re-exports and re-scans of the
+same mammogram land within a few bits of each other, so duplicates are found by
+Hamming distance.
+
+Images within DEFAULT_MAX_DISTANCE = 8 bits are treated as duplicates; the CLI
+reports nearest-neighbour distances to check that threshold on a new image set.
+
+Hashing is batched (one matrix product per chunk of images) and spread over
+worker processes; Hamming queries run vectorized over the whole index.
+
+    python phash_index.py --images_dir src/data/images_jpg --output phash_index.npz
+"""
+
+import argparse
+import logging
+import os
+from concurrent.futures import ProcessPoolExecutor
+from pathlib import Path
+
+import numpy as np
+from PIL import Image
+
+HASH_IMAGE_SIZE = 64
+HASH_BLOCK_SIZE = 16
+HASH_WORDS = HASH_BLOCK_SIZE * HASH_BLOCK_SIZE // 64
+DEFAULT_MAX_DISTANCE = 8
+CHUNK_SIZE = 64
+IMAGE_EXTENSIONS = (".jpg", ".jpeg", ".png")
+
+
+def _dct_matrix(size):
+    """Orthonormal DCT-II basis, so dct2(x) = D @ x @ D.T."""
+    k = np.arange(size)[:, None]
+    n = np.arange(size)[None, :]
+    matrix = np.cos(np.pi * (2 * n + 1) * k / (2 * size)) * np.sqrt(2.0 / size)
+    matrix[0] /= np.sqrt(2.0)
+    return matrix.astype(np.float32)
+
+
+DCT_MATRIX = _dct_matrix(HASH_IMAGE_SIZE)
+
+
+def image_to_hash_input(image):
+    """Reduce a PIL image or 2D array to the float32 64x64 grayscale hash input."""
+    if not isinstance(image, Image.Image):
+        image = Image.fromarray(np.asarray(image))
+    small = image.convert("L").resize((HASH_IMAGE_SIZE, HASH_IMAGE_SIZE), Image.BILINEAR)
+    return np.asarray(small, dtype=np.float32)
+
+
+def phash_batch(pixels):
+    """
+    Hash a stack of 64x64 grayscale images.
+
+    Args:
+        pixels: float array of shape (N, 64, 64)
+
+    Returns:
+        np.ndarray: uint64 hashes of shape (N, HASH_WORDS)
+    """
+    coefficients = DCT_MATRIX @ pixels @ DCT_MATRIX.T
+    block = coefficients[:, :HASH_BLOCK_SIZE, :HASH_BLOCK_SIZE].reshape(len(pixels), -1)
+    # The DC term only encodes mean brightness, so it is left out of the median
+    medians = np.median(block[:, 1:], axis=1, keepdims=True)
+    bits = np.packbits(block > medians, axis=1)
+    return bits.view(">u8").astype(np.uint64)
+
+
+def _hash_files(paths):
+    """Worker: hash a chunk of files in one batch. Unreadable files get None."""
+    inputs = []
+    readable = []
+    for path in paths:
+        try:
+            with Image.open(path) as image:
+                inputs.append(image_to_hash_input(image))
+            readable.append(True)
+        except (OSError, ValueError):
+            readable.append(False)
+
+    hashes = iter(phash_batch(np.stack(inputs))) if inputs else iter(())
+    return [next(hashes) if ok else None for ok in readable]
+
+
+def hash_files(paths, workers=None, chunk_size=CHUNK_SIZE):
+    """
+    Hash image files in parallel.
+
+    Returns:
+        list: one (HASH_WORDS,) uint64 hash per path, or None where the file could not be read
+    """
+    paths = [str(p) for p in paths]
+    chunks = [paths[i:i + chunk_size] for i in range(0, len(paths), chunk_size)]
+    if not chunks:
+        return []
+    if workers == 1 or len(chunks) == 1:
+        results = map(_hash_files, chunks)
+        return [h for chunk in results for h in chunk]
+    with ProcessPoolExecutor(max_workers=workers) as executor:
+        return [h for chunk in executor.map(_hash_files, chunks) for h in chunk]
+
+
+def hamming_distances(hashes, query):
+    """Vectorized Hamming distance between one hash and an (N, HASH_WORDS) array of hashes."""
+    xor = np.ascontiguousarray(np.bitwise_xor(hashes, np.asarray(query, dtype=np.uint64)))
+    if hasattr(np, "bitwise_count"):
+        return np.bitwise_count(xor).sum(axis=1, dtype=np.int64)
+    return np.unpackbits(xor.view(np.uint8).reshape(len(xor), -1), axis=1).sum(axis=1)
+
+
+class PHashIndex:
+    """Keys (e.g. image file names) with their 256-bit perceptual hashes."""
+
+    def __init__(self, keys=None, hashes=None):
+        self.keys = list(keys or [])
+        self.hashes = np.asarray(hashes if hashes is not None else [], dtype=np.uint64).reshape(-1, HASH_WORDS)
+
+    def __len__(self):
+        return len(self.keys)
+
+    @classmethod
+    def build(cls, paths, workers=None, key=os.path.basename):
+        """Hash every path in parallel and index the readable ones under key(path)."""
+        paths = list(paths)
+        hashes = hash_files(paths, workers=workers)
+        pairs = [(key(str(p)), h) for p, h in zip(paths, hashes) if h is not None]
+        skipped = len(paths) - len(pairs)
+        if skipped:
+            logging.warning(f"Could not hash {skipped} unreadable images")
+        return cls([k for k, _ in pairs], [h for _, h in pairs])
+
+    def query(self, hash_value, max_distance=DEFAULT_MAX_DISTANCE):
+        """Returns [(key, distance)] within max_distance, closest first."""
+        if not self.keys:
+            return []
+        distances = hamming_distances(self.hashes, hash_value)
+        matches = np.flatnonzero(distances <= max_distance)
+        matches = matches[np.argsort(distances[matches], kind="stable")]
+        return [(self.keys[i], int(distances[i])) for i in matches]
+
+    def duplicate_groups(self, max_distance=DEFAULT_MAX_DISTANCE):
+        """
+        Group keys around leaders: in index order, each key not yet grouped
+        becomes a leader and takes every ungrouped key within max_distance of it.
+        Members are compared with the leader only, never chained through other
+        members, so a series of small differences cannot merge unrelated images.
+        Returns a dict key -> group id (the leader's position).
+        """
+        group_ids = np.full(len(self.keys), -1, dtype=np.int64)
+        for i in range(len(self.keys)):
+            if group_ids[i] != -1:
+                continue
+            distances = hamming_distances(self.hashes[i:], self.hashes[i])
+            members = np.flatnonzero((distances <= max_distance) & (group_ids[i:] == -1)) + i
+            group_ids[members] = i
+
+        return {key: int(group_ids[i]) for i, key in enumerate(self.keys)}
+
+    def nearest_distances(self):
+        """Hamming distance from every hash to its nearest other hash (for checking thresholds)."""
+        nearest = np.empty(len(self.keys), dtype=np.int64)
+        for i in range(len(self.keys)):
+            distances = hamming_distances(self.hashes, self.hashes[i])
+            distances[i] = HASH_BLOCK_SIZE * HASH_BLOCK_SIZE
+            nearest[i] = distances.min()
+        return nearest
+
+    def save(self, path):
+        np.savez(path, keys=np.asarray(self.keys, dtype=str), hashes=self.hashes)
+
+    @classmethod
+    def load(cls, path):
+        data = np.load(path)
+        hashes = data["hashes"]
+        if hashes.ndim != 2 or hashes.shape[1] != HASH_WORDS:
+            raise ValueError(f"{path} was built with a different hash size; rebuild it")
+        return cls(data["keys"].tolist(), hashes)
+
+
+def find_images(images_dir):
+    """All image files directly inside images_dir, sorted by name."""
+    return sorted(
+        p for p in Path(images_dir).iterdir()
+        if p.is_file() and p.name.lower().endswith(IMAGE_EXTENSIONS)
+    )
+
+
+def get_arguments():
+    """Parses command-line arguments."""
+    parser = argparse.ArgumentParser(description="Build a perceptual-hash index and report near-duplicate images.")
+    parser.add_argument("--images_dir", type=Path, nargs="+", required=True, help="Directories of images to index.")
+    parser.add_argument("--output", type=Path, default=None, help="Save the index to this .npz file.")
+    parser.add_argument("--max_distance", type=int, default=DEFAULT_MAX_DISTANCE, help=f"Hamming distance treated as duplicate. Defaults to {DEFAULT_MAX_DISTANCE}")
+    parser.add_argument("--workers", type=int, default=None, help="Worker processes. Defaults to the CPU count.")
+    return parser.parse_args()
+
+
+def main():
+    logging.basicConfig(
+        level=logging.INFO, format="%(asctime)s - %(levelname)s - %(message)s"
+    )
+    args = get_arguments()
+    paths = [p for images_dir in args.images_dir for p in find_images(images_dir)]
+    logging.info(f"Hashing {len(paths)} images...")
+    index = PHashIndex.build(paths, workers=args.workers)
+
+    if args.output:
+        index.save(args.output)
+        logging.info(f"Saved index of {len(index)} images to {args.output}")
+
+    if len(index) > 1:
+        nearest = index.nearest_distances()
+        percentiles = np.percentile(nearest, [0, 1, 5, 50]).astype(int).tolist()
+        logging.info(f"Nearest-neighbour distance min/1%/5%/median: {percentiles}")
+
+    groups = {}
+    for key, group_id in index.duplicate_groups(args.max_distance).items():
+        groups.setdefault(group_id, []).append(key)
+    duplicates = [keys for keys in groups.values() if len(keys) > 1]
+    logging.info(f"Found {len(duplicates)} groups of near-duplicates (max distance {args.max_distance})")
+    for keys in duplicates:
+        logging.info(f"  - {', '.join(keys)}")
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,587 @@
+"""
+pipeline.py
+Runs the whole data preparation as one streaming DAG:
+
+    discover DICOMs --> convert to JPG --------+
+                                               +--> join on File Name --> split + write JSONL
+    read findings CSV --> translate findings --+
+
+Every stage has its own worker pool (processes for DICOM conversion, a single
+rate-limited thread for translation) and hands items to the next stage through a
+bounded queue. An image becomes a JSONL entry as soon as both its JPG and its
+translated findings exist, and a slow stage applies backpressure instead of letting
+work pile up in memory, so total time approaches that of the slowest stage.
+
+All paths come from one JSON config file (relative paths are resolved against the
+config file's directory):
+
+    python pipeline.py --config ../pipeline_config.json
+
+Setting "sampler" in the config to
+    {"annotations_csv": ..., "dicom_root": ..., "sample_size": 1000, "seed": 42,
+     "stratify_by": [], "laterality": "L", "view_position": "MLO"}
+converts a stratified sample of a VinDr-style export instead of walking dicom_dir.
+DICOMs are discovered directly, so the separate copy made by process_dicom_dirs.py
+is not needed.
+"""
+
+import argparse
+import csv
+import heapq
+import json
+import logging
+import multiprocessing
+import os
+import queue
+import threading
+import time
+from concurrent.futures import ProcessPoolExecutor
+from pathlib import Path
+
+logging.basicConfig(
+    level=logging.INFO, format="%(asctime)s - %(levelname)s - %(message)s"
+)
+
+SCRIPT_DIR = Path(__file__).resolve().parent
+DEFAULT_CONFIG_PATH = SCRIPT_DIR.parent / "pipeline_config.json"
+DICOM_EXTENSIONS = (".dcm", ".dcim", ".dicom")
+DEFAULT_QUEUE_SIZE = 64
+
+# Marks the end of a stage's input
+_DONE = object()
+
+
+# --- Streaming DAG ---
+
+class Stage:
+    """
+    One node of the DAG. func(item) returns an iterable of outputs, each of which is
+    sent to every downstream stage. A stage without upstreams is a source: its func
+    is called once with None. on_finish() runs after the last item and may return
+    final outputs.
+    """
+
+    def __init__(self, name, func, workers=1, queue_size=DEFAULT_QUEUE_SIZE, use_processes=False, on_finish=None):
+        self.name = name
+        self.func = func
+        self.workers = workers
+        self.use_processes = use_processes
+        self.on_finish = on_finish
+        self.inbox = queue.Queue(maxsize=queue_size)
+        self.downstream = []
+        self.upstream_count = 0
+        self.remaining_upstreams = 0
+        self.lock = threading.Lock()
+        self.processed = 0
+        self.emitted = 0
+        self.failed = 0
+        self.busy_seconds = 0.0
+
+    def then(self, stage):
+        """Connects this stage's outputs to stage and returns stage for chaining."""
+        self.downstream.append(stage)
+        stage.upstream_count += 1
+        return stage
+
+    def emit(self, outputs):
+        for output in outputs:
+            for stage in self.downstream:
+                # Blocks while the downstream queue is full
+                stage.inbox.put(output)
+            with self.lock:
+                self.emitted += 1
+
+    def upstream_finished(self):
+        with self.lock:
+            self.remaining_upstreams -= 1
+            all_done = self.remaining_upstreams == 0
+        if all_done:
+            self.inbox.put(_DONE)
+
+    def run_item(self, item, pool=None):
+        start = time.perf_counter()
+        try:
+            outputs = pool.submit(self.func, item).result() if pool is not None else self.func(item)
+            self.emit(outputs or ())
+        except Exception as e:
+            logging.error(f"[{self.name}] Failed on {item!r}: {e}")
+            with self.lock:
+                self.failed += 1
+        with self.lock:
+            self.processed += 1
+            self.busy_seconds += time.perf_counter() - start
+
+    def work(self, pool):
+        while True:
+            item = self.inbox.get()
+            if item is _DONE:
+                # Leave the marker for the other workers of this stage
+                self.inbox.put(_DONE)
+                return
+            self.run_item(item, pool)
+
+
+class Pipeline:
+    """Runs every stage concurrently until all sources are exhausted."""
+
+    def __init__(self, stages):
+        self.stages = stages
+
+    def _run_stage(self, stage):
+        pool = None
+        if stage.use_processes:
+            # Forking while other stage threads hold locks (logging, queues) can
+            # deadlock the children, so workers start from a fresh interpreter
+            pool = ProcessPoolExecutor(max_workers=stage.workers, mp_context=multiprocessing.get_context("spawn"))
+        try:
+            if stage.upstream_count == 0:
+                stage.run_item(None)
+            else:
+                workers = [
+                    threading.Thread(target=stage.work, args=(pool,), name=f"{stage.name}-{i}", daemon=True)
+                    for i in range(stage.workers)
+                ]
+                for worker in workers:
+                    worker.start()
+                for worker in workers:
+                    worker.join()
+            if stage.on_finish is not None:
+                stage.emit(stage.on_finish() or ())
+        except Exception as e:
+            logging.error(f"[{stage.name}] Stage crashed: {e}")
+            with stage.lock:
+                stage.failed += 1
+        finally:
+            if pool is not None:
+                pool.shutdown()
+            for downstream in stage.downstream:
+                downstream.upstream_finished()
+
+    def run(self):
+        start = time.perf_counter()
+        for stage in self.stages:
+            stage.remaining_upstreams = stage.upstream_count
+
+        threads = [
+            threading.Thread(target=self._run_stage, args=(stage,), name=stage.name, daemon=True)
+            for stage in self.stages
+        ]
+        for thread in threads:
+            thread.start()
+        for thread in threads:
+            thread.join()
+
+        elapsed = time.perf_counter() - start
+        logging.info(f"Pipeline finished in {elapsed:.1f}s")
+        for stage in self.stages:
+            logging.info(
+                f"  - {stage.name}: {stage.processed} in, {stage.emitted} out, {stage.failed} failed, "
+                f"{stage.busy_seconds:.1f}s busy across {stage.workers} worker(s)"
+            )
+        return all(stage.failed == 0 for stage in self.stages)
+
+
+# --- Config ---
+
+def load_config(config_path):
+    """Reads the JSON config and resolves every path against the config's directory."""
+    config_path = Path(config_path).resolve()
+    with open(config_path, "r", encoding="utf-8") as f:
+        config = json.load(f)
+
+    base_dir = config_path.parent
+    config["paths"] = {name: (base_dir / value).resolve() for name, value in config["paths"].items()}
+    sampler_config = config.get("sampler")
+    if sampler_config:
+        for name in ("annotations_csv", "dicom_root"):
+            sampler_config[name] = (base_dir / sampler_config[name]).resolve()
+    return config
+
+
+# --- Stage functions ---
+
+def convert_task(task):
+    """
+    Process-pool worker: converts one DICOM unless its JPGs already exist. Multi-frame
+    files give one image per frame; the Joiner pairs the CSV row with the first.
+    """
+    import convert_dicom
+
+    dicom_path, jpg_path, test_jpg_path, crop, memory_budget = task
+    try:
+        jpg_paths = convert_dicom.output_jpg_paths(dicom_path, jpg_path)
+    except Exception as e:
+        raise RuntimeError(f"Could not read {dicom_path}: {e}") from e
+    test_images_dir = os.path.dirname(test_jpg_path)
+    jpg_names = [os.path.basename(path) for path in jpg_paths]
+    if all(os.path.exists(path) or os.path.exists(os.path.join(test_images_dir, name))
+           for path, name in zip(jpg_paths, jpg_names)):
+        return [("image", name, None) for name in jpg_names]
+
+    os.makedirs(os.path.dirname(jpg_path), exist_ok=True)
+    crop_boxes = {}
+    if not convert_dicom.convert_dicom_to_jpg(dicom_path, jpg_path, crop=crop, crop_boxes=crop_boxes,
+                                              memory_budget=memory_budget):
+        raise RuntimeError(f"Could not convert {dicom_path}")
+    return [("image", name, crop_boxes.get(path)) for path, name in zip(jpg_paths, jpg_names)]
+
+
+def make_discover_source(config):
+    """Yields conversion tasks for the configured DICOM files."""
+    paths = config["paths"]
+    jpg_dir = paths["jpg_dir"]
+    test_images_dir = paths["test_set_dir"] / "images"
+    crop = config.get("convert", {}).get("crop_to_breast", False)
+    # Per-worker decode budget; large and multi-frame DICOMs are streamed in strips
+    memory_budget_mb = config.get("convert", {}).get("memory_budget_mb")
+    memory_budget = int(memory_budget_mb * 2**20) if memory_budget_mb else None
+    sampler_config = config.get("sampler")
+
+    def dicom_files():
+        if sampler_config:
+            import sampler
+
+            samples = sampler.stream_stratified_sample(
+                sampler_config["annotations_csv"],
+                sampler_config.get("sample_size", sampler.SAMPLE_SIZE),
+                sampler_config.get("seed", sampler.RANDOM_STATE),
+                sampler_config.get("stratify_by", []),
+                laterality=sampler_config.get("laterality", sampler.LATERALITY),
+                view_position=sampler_config.get("view_position", sampler.VIEW_POSITION),
+            )
+            for _, study_id, image_id in samples:
+                yield sampler_config["dicom_root"] / "images" / study_id / f"{image_id}.dicom"
+            return
+
+        for root, _, files in os.walk(paths["dicom_dir"]):
+            for file in sorted(files):
+                if file.lower().endswith(DICOM_EXTENSIONS):
+                    yield Path(root) / file
+
+    def discover(_):
+        # JPGs are written flat into jpg_dir: the join, the JSONL image paths and
+        # the test-set staging all address images by bare file name
+        seen = {}
+        for dicom_path in dicom_files():
+            jpg_name = f"{dicom_path.stem}.jpg"
+            if jpg_name in seen:
+                logging.warning(f"Skipping {dicom_path}: {jpg_name} is already produced by {seen[jpg_name]}")
+                continue
+            seen[jpg_name] = dicom_path
+            yield (str(dicom_path), str(jpg_dir / jpg_name), str(test_images_dir / jpg_name), crop, memory_budget)
+
+    return discover
+
+
+def make_row_source(config):
+    """Yields (index, row) for every row of the findings CSV."""
+    findings_csv = config["paths"]["findings_csv"]
+
+    def read_rows(_):
+        with open(findings_csv, "r", encoding="utf-8") as f:
+            for index, row in enumerate(csv.DictReader(f)):
+                yield ("row", index, row)
+
+    return read_rows
+
+
+class Translator:
+    """
+    Fills the English findings column, reusing translation.py's journal so a
+    restarted pipeline only pays for rows that were never translated.
+    """
+
+    def __init__(self, config):
+        self.enabled = config.get("translate", {}).get("enabled", True)
+        self.journal_path = config["paths"].get("translation_journal")
+        self.translated_csv = config["paths"].get("translated_csv")
+        self.lock = threading.Lock()
+        self.rows = {}
+        self.client = None
+        self.journal_file = None
+        self.completed = {}
+
+        if self.enabled:
+            import translation
+
+            self.translation = translation
+            self.client = translation.configure_llm()
+            if self.client is None:
+                raise RuntimeError("Translation is enabled but no Gemini client could be configured")
+            if self.journal_path is not None:
+                self.completed = translation.load_journal(self.journal_path)
+                self.journal_file = translation.open_journal(self.journal_path)
+
+    def __call__(self, item):
+        _, index, row = item
+        english_column = "Findings Notes (English)"
+
+        if self.enabled and not (row.get(english_column) or "").strip():
+            translation = self.translation
+            source_text = row.get(translation.COLUMN_TO_TRANSLATE)
+            if translation.is_row_done(self.completed, index, source_text):
+                row[english_column] = translation.get_journaled_translation(self.completed, index, source_text)
+            else:
+                text, llm_used = translation.translate_text(self.client, source_text)
+                row[english_column] = text
+                with self.lock:
+                    self.completed[index] = {"translation": text, "source": translation.source_hash(source_text)}
+                    if self.journal_file is not None:
+                        translation.append_to_journal(self.journal_file, index, text, source_text)
+                if llm_used:
+                    # Respect the free-tier rate limit
+                    time.sleep(translation.REQUEST_DELAY)
+
+        with self.lock:
+            self.rows[index] = row
+        return [("row", row)]
+
+    def finish(self):
+        if self.journal_file is not None:
+            self.journal_file.close()
+        if self.translated_csv is None or not self.rows:
+            return []
+
+        rows = [self.rows[i] for i in sorted(self.rows)]
+        fieldnames = list(rows[0].keys())
+        tmp_path = self.translated_csv.with_name(self.translated_csv.name + ".tmp")
+        with open(tmp_path, "w", encoding="utf-8", newline="") as f:
+            writer = csv.DictWriter(f, fieldnames=fieldnames, extrasaction="ignore")
+            writer.writeheader()
+            writer.writerows(rows)
+        os.replace(tmp_path, self.translated_csv)
+        logging.info(f"Wrote {len(rows)} translated rows to {self.translated_csv}")
+        return []
+
+
+class Joiner:
+    """Pairs each valid CSV row with its JPG by File Name ID as soon as both have arrived."""
+
+    def __init__(self, config):
+        self.image_base_path = config.get("image_base_path")
+        self.jpg_dir = config["paths"]["jpg_dir"]
+        # Templates are derived from the split seed and file id, so reruns render the same answers
+        self.seed = config.get("split", {}).get("seed", 42)
+        self.rows_by_id = {}
+        self.images_by_id = {}
+        self.crop_boxes = {}
+        self.skipped_rows = 0
+
+    @staticmethod
+    def clean_id(file_name_id):
+        return str(file_name_id).replace(".0", "").strip()
+
+    def make_entry(self, row, image_filename):
+        import create_jsonl
+
+        kwargs = {"image_base_path": self.image_base_path} if self.image_base_path else {}
+        kwargs["seed"] = self.seed
+        # Rows arrive from a stream, so the test CSV is written from the kept row
+        return create_jsonl.DatasetEntry.from_row(row, image_filename, keep_row=True, **kwargs)
+
+    def __call__(self, item):
+        import create_jsonl
+
+        if item[0] == "row":
+            row = item[1]
+            if not create_jsonl.validate_row(row):
+                self.skipped_rows += 1
+                return []
+            file_id = self.clean_id(row["File Name"])
+            if file_id in self.images_by_id:
+                return [self.make_entry(row, self.images_by_id.pop(file_id))]
+            self.rows_by_id[file_id] = row
+            return []
+
+        _, image_filename, crop_box = item
+        if crop_box is not None:
+            self.crop_boxes[image_filename] = crop_box
+        file_id = image_filename.split("_")[0]
+        if file_id in self.rows_by_id:
+            return [self.make_entry(self.rows_by_id.pop(file_id), image_filename)]
+        self.images_by_id.setdefault(file_id, image_filename)
+        return []
+
+    def finish(self):
+        if self.rows_by_id:
+            logging.warning(f"{len(self.rows_by_id)} CSV rows had no matching image: {', '.join(sorted(self.rows_by_id))}")
+        if self.images_by_id:
+            logging.info(f"{len(self.images_by_id)} images had no matching CSV row")
+        if self.skipped_rows:
+            logging.info(f"Skipped {self.skipped_rows} CSV rows without file name, findings or BI-RADS")
+        if self.crop_boxes:
+            crop_boxes_path = self.jpg_dir / "crop_boxes.csv"
+            with open(crop_boxes_path, "w", newline="", encoding="utf-8") as f:
+                writer = csv.writer(f)
+                writer.writerow(["jpg_name", "left", "top", "right", "bottom"])
+                for image_filename, box in sorted(self.crop_boxes.items()):
+                    writer.writerow([image_filename, *box])
+        return []
+
+
+class DatasetWriter:
+    """
+    Streams training entries to the JSONL file as they arrive and keeps the test set.
+
+    If the test-set directory already holds images, those define the test set.
+    Otherwise the test set is the test_set_size entries with the smallest
+    create_jsonl.split_key (bottom-k sampling), so it is reproducible and every
+    other entry can be rendered immediately. This is the split
+    create_jsonl.split_train_test makes for the same seed. Training lines are
+    streamed to a temporary file and copied into key order at the end, so the
+    JSONL does not depend on which worker finished first.
+    """
+
+    def __init__(self, config):
+        paths = config["paths"]
+        split_config = config.get("split", {})
+        self.jpg_dir = paths["jpg_dir"]
+        self.training_jsonl = paths["training_jsonl"]
+        self.test_set_dir = paths["test_set_dir"]
+        self.test_set_size = split_config.get("test_set_size", 25)
+        self.seed = split_config.get("seed", 42)
+
+        import create_jsonl
+
+        create_jsonl.rollback_test_staging(self.test_set_dir)
+        self.existing_test_filenames = create_jsonl.get_committed_test_filenames(self.test_set_dir)
+        if self.existing_test_filenames:
+            logging.info(f"Using the {len(self.existing_test_filenames)} committed images in {self.test_set_dir} as the test set")
+
+        self.test_entries = []
+        self.reservoir = []
+        self.training_count = 0
+        self.counter = 0
+        self.training_jsonl.parent.mkdir(parents=True, exist_ok=True)
+        self.tmp_path = self.training_jsonl.with_name(self.training_jsonl.name + ".tmp")
+        self.unordered_path = self.training_jsonl.with_name(self.training_jsonl.name + ".unordered")
+        self.training_file = open(self.unordered_path, "wb")
+        # (split key, offset, length) of every line in the unordered file
+        self.training_lines = []
+
+    def split_key(self, image_filename):
+        import create_jsonl
+
+        return create_jsonl.split_key(self.seed, image_filename)
+
+    def write_training(self, entry_data):
+        import create_jsonl
+
+        line = (json.dumps(create_jsonl.render_json_entry(entry_data), ensure_ascii=False) + "\n").encode("utf-8")
+        self.training_lines.append((self.split_key(entry_data.image_filename), self.training_file.tell(), len(line)))
+        self.training_file.write(line)
+        self.training_count += 1
+
+    def write_ordered_training(self):
+        """Copies the training lines into split-key order, then replaces the JSONL atomically."""
+        with open(self.unordered_path, "rb") as source, open(self.tmp_path, "wb") as target:
+            for _, offset, length in sorted(self.training_lines):
+                source.seek(offset)
+                target.write(source.read(length))
+        os.replace(self.tmp_path, self.training_jsonl)
+        os.remove(self.unordered_path)
+
+    def __call__(self, entry_data):
+        if self.existing_test_filenames:
+            if entry_data.image_filename in self.existing_test_filenames:
+                self.test_entries.append(entry_data)
+            else:
+                self.write_training(entry_data)
+            return []
+
+        # Max-heap on key; the counter breaks ties without comparing dicts
+        self.counter += 1
+        item = (-self.split_key(entry_data.image_filename), self.counter, entry_data)
+        if len(self.reservoir) < self.test_set_size:
+            heapq.heappush(self.reservoir, item)
+        elif item[0] > self.reservoir[0][0]:
+            self.write_training(heapq.heapreplace(self.reservoir, item)[2])
+        else:
+            self.write_training(entry_data)
+        return []
+
+    def finish(self):
+        import create_jsonl
+
+        if self.existing_test_filenames:
+            self.test_entries.sort(key=lambda entry: self.split_key(entry.image_filename))
+        else:
+            self.test_entries = [entry for _, _, entry in sorted(self.reservoir, reverse=True)]
+            # Fewer entries than test_set_size: same fallback as split_train_test
+            test_set_size = create_jsonl.get_test_set_size(len(self.test_entries), self.test_set_size)
+            for entry_data in self.test_entries[test_set_size:]:
+                self.write_training(entry_data)
+            self.test_entries = self.test_entries[:test_set_size]
+
+        self.training_file.close()
+        if self.training_count:
+            self.write_ordered_training()
+            logging.info(f"Wrote {self.training_count} training entries to {self.training_jsonl}")
+        else:
+            os.remove(self.unordered_path)
+            logging.warning("No training entries were produced")
+
+        self.test_set_dir.mkdir(parents=True, exist_ok=True)
+        create_jsonl.write_test_csv(self.test_entries, self.test_set_dir / "test_set.csv")
+        staged = create_jsonl.stage_test_images(self.test_entries, self.jpg_dir, self.test_set_dir)
+        logging.info(f"Training set size: {self.training_count}")
+        logging.info(f"Test set size: {len(self.test_entries)}")
+        if self.test_entries and not staged:
+            raise RuntimeError(f"Not every test image could be staged in {self.test_set_dir}")
+        return []
+
+
+def build_pipeline(config):
+    queue_size = config.get("queue_size", DEFAULT_QUEUE_SIZE)
+    convert_config = config.get("convert", {})
+    translate_config = config.get("translate", {})
+
+    translator = Translator(config)
+    joiner = Joiner(config)
+    writer = DatasetWriter(config)
+
+    discover = Stage("discover", make_discover_source(config), queue_size=queue_size)
+    convert = Stage("convert", convert_task, workers=convert_config.get("workers", os.cpu_count() or 1),
+                    queue_size=queue_size, use_processes=True)
+    read_rows = Stage("read_rows", make_row_source(config), queue_size=queue_size)
+    translate = Stage("translate", translator, workers=translate_config.get("workers", 1),
+                      queue_size=queue_size, on_finish=translator.finish)
+    join = Stage("join", joiner, queue_size=queue_size, on_finish=joiner.finish)
+    write = Stage("write", writer, queue_size=queue_size, on_finish=writer.finish)
+
+    discover.then(convert).then(join)
+    read_rows.then(translate).then(join)
+    join.then(write)
+
+    return Pipeline([discover, convert, read_rows, translate, join, write])
+
+
+def get_arguments():
+    """Parses command-line arguments."""
+    parser = argparse.ArgumentParser(description="Run the data preparation pipeline as a streaming DAG.")
+    parser.add_argument("--config", type=Path, default=DEFAULT_CONFIG_PATH, help=f"Pipeline config JSON. Defaults to {DEFAULT_CONFIG_PATH}")
+    return parser.parse_args()
+
+
+def main():
+    args = get_arguments()
+    if not args.config.is_file():
+        logging.error(f"Config file not found: {args.config}")
+        return
+
+    config = load_config(args.config)
+    logging.info(f"Starting pipeline with config {args.config}")
+    try:
+        pipeline = build_pipeline(config)
+    except (OSError, RuntimeError) as e:
+        logging.error(f"Could not set up the pipeline: {e}")
+        return
+
+    if pipeline.run():
+        logging.info("Pipeline completed successfully!")
+    else:
+        logging.error("Pipeline completed with errors.")
+
+
+if __name__ == "__main__":
+    main()
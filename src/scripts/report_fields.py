@@ -0,0 +1,89 @@
+"""
+report_fields.py
+Parse the short assessments the fine-tune was trained on into structured fields.
+
+Training answers (create_jsonl.create_assistant_response) are one paragraph with
+findings, ACR density, BI-RADS category and a clinical action, e.g.
+"Assessment: nodule. Breast density is ACR 2. This is classified as BI-RADS 3. Recommend 6-month follow-up imaging."
+"""
+
+import re
+
+# BI-RADS category -> recommended action used in the training targets
+CLINICAL_ACTIONS = {
+    "0": "Recommend additional imaging or prior studies for comparison.",
+    "1": "Recommend routine screening mammography.",
+    "2": "Recommend routine screening mammography.",
+    "3": "Recommend 6-month follow-up imaging.",
+    "4": "Recommend tissue biopsy for histological diagnosis.",
+    "4a": "Consider biopsy given low suspicion findings.",
+    "4b": "Biopsy indicated for moderate suspicion lesion.",
+    "4c": "Strongly recommend biopsy given high suspicion.",
+    "5": "Biopsy required; arrange oncology consultation.",
+    "6": "Proceed with treatment planning and oncology care.",
+}
+DEFAULT_CLINICAL_ACTION = "Recommend radiologist review."
+
+# Sentence templates of the training answers; clinical_action is one of the above
+RESPONSE_TEMPLATES = (
+    "Assessment: {findings}. Breast density is ACR {acr}. This is classified as BI-RADS {birads}. {clinical_action}",
+    "The mammogram shows {findings}, with ACR {acr} density. I would classify this as BI-RADS {birads}. {clinical_action}",
+    "My assessment reveals {findings}. The breast composition is ACR {acr}. This warrants a BI-RADS {birads} classification. {clinical_action}",
+    "Findings include {findings}. Breast density is ACR {acr}. Based on these findings, I recommend BI-RADS {birads}. {clinical_action}",
+)
+
+REPORT_FIELDS = ("findings", "acr", "birads", "recommendation")
+
+FINDINGS_PATTERN = re.compile(
+    r"(?:Assessment:|The mammogram shows|My assessment reveals|Findings include)\s*(?P<findings>.+?)"
+    r"(?:,\s*with ACR|\.\s+(?:Breast density|The breast composition))",
+    re.IGNORECASE | re.DOTALL
+)
+ACR_PATTERN = re.compile(r"\bACR\s*(?P<acr>[A-D1-4])\b", re.IGNORECASE)
+BIRADS_PATTERN = re.compile(r"\bBI-?RADS\s*(?:category\s*)?(?P<birads>[0-6][abc]?)\b", re.IGNORECASE)
+SENTENCE_END_PATTERN = re.compile(r"[.!?](?:\s|$)")
+
+
+def parse_report(text):
+    """
+    Extract findings, ACR density, BI-RADS category and recommendation from an answer.
+
+    Args:
+        text: Model answer
+
+    Returns:
+        dict with the keys in REPORT_FIELDS; a field is None until it is fully present
+        (the recommendation only counts once its sentence has ended)
+    """
+    fields = dict.fromkeys(REPORT_FIELDS)
+
+    findings_match = FINDINGS_PATTERN.search(text)
+    if findings_match:
+        fields["findings"] = findings_match.group("findings").strip()
+
+    acr_match = ACR_PATTERN.search(text)
+    if acr_match:
+        fields["acr"] = acr_match.group("acr").upper()
+
+    birads_match = BIRADS_PATTERN.search(text)
+    if birads_match is None:
+        return fields
+    fields["birads"] = birads_match.group("birads").lower()
+
+    # The recommendation is the sentence after the one naming the BI-RADS category
+    rest = text[birads_match.end():]
+    birads_sentence_end = SENTENCE_END_PATTERN.search(rest)
+    if birads_sentence_end is None:
+        return fields
+    rest = rest[birads_sentence_end.end():].lstrip()
+    recommendation_end = SENTENCE_END_PATTERN.search(rest)
+    if recommendation_end is not None:
+        fields["recommendation"] = rest[:recommendation_end.start() + 1].strip()
+
+    return fields
+
+
+def is_report_complete(text):
+    """True once ACR, BI-RADS and a finished recommendation sentence are all present."""
+    fields = parse_report(text)
+    return all(fields[name] for name in ("acr", "birads", "recommendation"))
@@ -1,10 +1,26 @@
 """
-This script samples 1000 random entries from the breast-level_annotations.csv
+This script samples random entries from the breast-level_annotations.csv
 and creates a file `image_list.txt` containing the paths to the corresponding DICOM images.
+
+Only the columns needed for filtering are loaded, and the parsed table is cached as
+Parquet next to the CSV so later runs skip CSV parsing entirely.
+
+With --streaming, the CSV is instead read in chunks and a fixed number of studies is
+sampled per stratum (e.g. per BI-RADS category). Each study is represented by its image
+with the smallest seeded key, found in a first pass that keeps 16 bytes per study;
+the second pass holds only the sample itself, never the annotation table.
 """
+import argparse
+import heapq
 from pathlib import Path
 import pandas as pd  # pyright: ignore[reportMissingImports]
 
+try:
+    import pyarrow  # noqa: F401  # pyright: ignore[reportMissingImports]
+    HAS_PYARROW = True
+except ImportError:
+    HAS_PYARROW = False
+
 # --- Constants ---
 # Use Path(__file__) to make paths relative to the script's location
 SCRIPT_DIR = Path(__file__).resolve().parent
@@ -13,24 +29,109 @@ CSV_PATH = SRC_DIR / "data/breast-level_annotations.csv"
 OUTPUT_FILE_PATH = SCRIPT_DIR / "image_list.txt"
 SAMPLE_SIZE = 1000
 RANDOM_STATE = 42
+LATERALITY = 'L'
+VIEW_POSITION = 'MLO'
+
+ID_COLUMNS = ['study_id', 'image_id']
+CATEGORICAL_COLUMNS = ['laterality', 'view_position']
+STRATUM_COLUMNS = ['breast_birads', 'breast_density', 'laterality', 'view_position']
+CHUNK_SIZE = 100_000
+
+def get_arguments():
+    """Parses command-line arguments."""
+    parser = argparse.ArgumentParser(
+        description="Sample one image per study from the annotation CSV and write their DICOM paths."
+    )
+    parser.add_argument("--csv_path", type=Path, default=CSV_PATH, help=f"Annotation CSV. Defaults to {CSV_PATH}")
+    parser.add_argument("--output_path", type=Path, default=OUTPUT_FILE_PATH, help=f"Output image list. Defaults to {OUTPUT_FILE_PATH}")
+    parser.add_argument("--sample_size", type=int, default=SAMPLE_SIZE, help=f"Number of studies to sample (per stratum with --streaming). Defaults to {SAMPLE_SIZE}")
+    parser.add_argument("--random_state", type=int, default=RANDOM_STATE, help=f"Random seed. Defaults to {RANDOM_STATE}")
+    parser.add_argument("--laterality", default=LATERALITY, help=f"Laterality filter (L/R), or 'any'. Defaults to {LATERALITY}")
+    parser.add_argument("--view_position", default=VIEW_POSITION, help=f"View filter (CC/MLO), or 'any'. Defaults to {VIEW_POSITION}")
+    parser.add_argument("--no_cache", action="store_true", help="Ignore and do not write the Parquet cache.")
+    parser.add_argument("--streaming", action="store_true", help="Read the CSV in chunks and sample per stratum with bounded memory.")
+    parser.add_argument("--stratify_by", nargs="*", default=[], choices=STRATUM_COLUMNS, help="Columns defining the strata in streaming mode.")
+    parser.add_argument("--chunksize", type=int, default=CHUNK_SIZE, help=f"Rows per chunk in streaming mode. Defaults to {CHUNK_SIZE}")
+    return parser.parse_args()
+
+def get_cache_path(csv_path):
+    """Returns the Parquet cache path that sits next to the annotation CSV."""
+    return csv_path.with_suffix(".parquet")
+
+def is_cache_fresh(csv_path, cache_path, columns):
+    """The cache is usable if it is newer than the CSV and holds every requested column."""
+    if not cache_path.is_file():
+        return False
+    if cache_path.stat().st_mtime < csv_path.stat().st_mtime:
+        return False
+    try:
+        import pyarrow.parquet as pq  # pyright: ignore[reportMissingImports]
+        cached_columns = set(pq.read_schema(cache_path).names)
+    except (OSError, ValueError):
+        return False
+    return set(columns) <= cached_columns
+
+def load_annotations(csv_path, columns=None, categorical_columns=None, use_cache=True):
+    """
+    Loads the requested annotation columns, using a Parquet cache when possible.
+    Categorical columns are parsed as pandas categories to keep the table small.
+    """
+    if columns is None:
+        columns = ID_COLUMNS + CATEGORICAL_COLUMNS
+    if categorical_columns is None:
+        categorical_columns = [c for c in CATEGORICAL_COLUMNS if c in columns]
+
+    cache_path = get_cache_path(csv_path)
+    use_cache = use_cache and HAS_PYARROW
+
+    if use_cache and is_cache_fresh(csv_path, cache_path, columns):
+        print(f"Loading cached annotations from {cache_path}...")
+        return pd.read_parquet(cache_path, columns=columns)
+
+    print(f"Reading annotations from {csv_path}...")
+    dtypes = {column: 'category' for column in categorical_columns}
+    dtypes.update({column: 'string' for column in columns if column not in dtypes})
+    read_kwargs = {'usecols': columns, 'dtype': dtypes}
+    if HAS_PYARROW:
+        read_kwargs['engine'] = 'pyarrow'
+    df = pd.read_csv(csv_path, **read_kwargs)
+
+    if use_cache:
+        try:
+            df.to_parquet(cache_path, index=False)
+            print(f"Cached parsed annotations to {cache_path}")
+        except (OSError, ValueError) as e:
+            print(f"Warning: Could not write Parquet cache {cache_path}: {e}")
+
+    return df
+
+def build_image_paths(df):
+    """Builds the relative DICOM path for every row with vectorized string ops."""
+    return "images/" + df['study_id'].astype(str) + "/" + df['image_id'].astype(str) + ".dicom"
 
-def create_image_list_from_csv(csv_path, output_path, sample_size, random_state):
+def create_image_list_from_csv(csv_path, output_path, sample_size, random_state,
+                               laterality=LATERALITY, view_position=VIEW_POSITION, use_cache=True):
     """
     Reads a CSV, samples it, and writes image paths to a text file.
+    Pass 'any' (or None) for laterality or view_position to disable that filter.
     """
     if not csv_path.is_file():
         print(f"Error: Annotation file not found at {csv_path}")
         return
 
-    print(f"Reading annotations from {csv_path}...")
     try:
-        df = pd.read_csv(csv_path)
+        df = load_annotations(csv_path, use_cache=use_cache)
     except (OSError, ValueError) as e:
         print(f"An error occurred while reading the CSV: {e}")
         return
 
-    print("Filtering images: laterality='L', view_position='MLO'")
-    filtered_df = df[(df['laterality'] == 'L') & (df['view_position'] == 'MLO')]
+    print(f"Filtering images: laterality='{laterality}', view_position='{view_position}'")
+    mask = pd.Series(True, index=df.index)
+    if laterality and laterality != 'any':
+        mask &= df['laterality'] == laterality
+    if view_position and view_position != 'any':
+        mask &= df['view_position'] == view_position
+    filtered_df = df[mask]
 
     print("Grouping by study to select one image per study...")
     unique_studies_df = filtered_df.drop_duplicates(subset=['study_id'], keep='first')
@@ -46,19 +147,219 @@ def create_image_list_from_csv(csv_path, output_path, sample_size, random_state)
 
     print(f"Writing image list to {output_path}...")
     try:
+        paths = build_image_paths(sample_df)
         with open(output_path, 'w', encoding='utf-8') as f:
-            for _, row in sample_df.iterrows():
-                path = f"images/{row['study_id']}/{row['image_id']}.dicom"
-                f.write(f"{path}\n")
+            if len(paths):
+                f.write("\n".join(paths) + "\n")
     except IOError as e:
         print(f"Error writing to output file {output_path}: {e}")
         return
 
     print(f"Successfully wrote {sample_size} image paths to {output_path}")
 
+def get_study_keys(study_ids, random_state):
+    """
+    Maps each study_id to a deterministic pseudo-random 64-bit key.
+    Every image of a study gets the same key, so keeping the smallest keys samples
+    studies uniformly and reproducibly regardless of how the CSV is chunked.
+    """
+    hash_key = f"{random_state:016d}"[-16:]
+    return pd.util.hash_pandas_object(study_ids, index=False, hash_key=hash_key).to_numpy()
+
+def get_image_keys(image_ids, random_state):
+    """
+    Maps each image_id to a deterministic pseudo-random 64-bit key. A study is
+    represented by its image with the smallest key, wherever that image is in the CSV.
+    """
+    hash_key = f"{random_state + 1:016d}"[-16:]
+    return pd.util.hash_pandas_object(image_ids, index=False, hash_key=hash_key).to_numpy()
+
+class StratifiedReservoir:
+    """
+    Keeps the `per_stratum` studies with the smallest keys in each stratum (bottom-k
+    reservoir sampling), with at most one image per study across all strata.
+    Memory is bounded by per_stratum times the number of strata.
+    """
+
+    def __init__(self, per_stratum):
+        self.per_stratum = per_stratum
+        # stratum -> max-heap of (-key, study_id, image_id)
+        self.reservoirs = {}
+        # study_id -> stratum holding it, to enforce one image per study
+        self.owners = {}
+
+    def threshold(self, stratum):
+        """Returns the largest key a new study may have to enter the stratum, or None if not full."""
+        reservoir = self.reservoirs.get(stratum)
+        if reservoir is None or len(reservoir) < self.per_stratum:
+            return None
+        return -reservoir[0][0]
+
+    def offer(self, stratum, key, study_id, image_id):
+        """Offers one image; returns True if it was kept."""
+        if study_id in self.owners:
+            return False
+
+        reservoir = self.reservoirs.setdefault(stratum, [])
+        item = (-key, study_id, image_id)
+        if len(reservoir) < self.per_stratum:
+            heapq.heappush(reservoir, item)
+        elif key < -reservoir[0][0]:
+            _, evicted_study_id, _ = heapq.heapreplace(reservoir, item)
+            del self.owners[evicted_study_id]
+        else:
+            return False
+
+        self.owners[study_id] = stratum
+        return True
+
+    def samples(self):
+        """Returns (stratum, study_id, image_id) tuples in a stable order."""
+        results = []
+        for stratum in sorted(self.reservoirs, key=str):
+            for neg_key, study_id, image_id in sorted(self.reservoirs[stratum], reverse=True):
+                results.append((stratum, study_id, image_id))
+        return results
+
+def read_filtered_chunks(csv_path, columns, dtypes, chunksize, laterality, view_position):
+    """Yields (rows_read, chunk) with each chunk restricted to the requested laterality and view."""
+    for chunk in pd.read_csv(csv_path, usecols=columns, dtype=dtypes, chunksize=chunksize):
+        rows_read = len(chunk)
+        if laterality and laterality != 'any':
+            chunk = chunk[chunk['laterality'] == laterality]
+        if view_position and view_position != 'any':
+            chunk = chunk[chunk['view_position'] == view_position]
+        yield rows_read, chunk
+
+def find_representative_keys(chunks, random_state):
+    """
+    First pass: the smallest image key of every study, as a Series indexed by study key.
+    """
+    representative_keys = pd.Series(dtype='uint64')
+    for _, chunk in chunks:
+        if chunk.empty:
+            continue
+        chunk_keys = pd.Series(
+            get_image_keys(chunk['image_id'], random_state),
+            index=get_study_keys(chunk['study_id'], random_state),
+        )
+        representative_keys = pd.concat([representative_keys, chunk_keys]).groupby(level=0).min()
+    return representative_keys
+
+def stream_stratified_sample(csv_path, per_stratum, random_state, stratify_by=(),
+                             laterality=LATERALITY, view_position=VIEW_POSITION, chunksize=CHUNK_SIZE):
+    """
+    Reads the CSV in chunks and samples up to `per_stratum` studies per stratum.
+    A study belongs to the stratum of its representative image (get_image_keys), so
+    the sample does not depend on the chunk size or on the row order of the CSV.
+    Returns a list of (stratum, study_id, image_id) tuples.
+    """
+    stratify_by = list(stratify_by)
+    filter_columns = [c for c in CATEGORICAL_COLUMNS if c not in stratify_by]
+    columns = ID_COLUMNS + stratify_by + filter_columns
+    dtypes = {column: 'string' for column in ID_COLUMNS}
+    dtypes.update({column: 'category' for column in stratify_by + filter_columns})
+
+    # The first pass reads only what the filters need
+    first_pass_columns = ID_COLUMNS + CATEGORICAL_COLUMNS
+    first_pass_dtypes = {column: dtypes.get(column, 'category') for column in first_pass_columns}
+    representative_keys = find_representative_keys(
+        read_filtered_chunks(csv_path, first_pass_columns, first_pass_dtypes, chunksize, laterality, view_position),
+        random_state,
+    )
+
+    reservoir = StratifiedReservoir(per_stratum)
+    total_rows = 0
+
+    for rows_read, chunk in read_filtered_chunks(csv_path, columns, dtypes, chunksize, laterality, view_position):
+        total_rows += rows_read
+        if chunk.empty:
+            continue
+
+        # Only each study's representative image is offered
+        sample_keys = get_study_keys(chunk['study_id'], random_state)
+        is_representative = get_image_keys(chunk['image_id'], random_state) == \
+            representative_keys.reindex(sample_keys).to_numpy()
+        chunk = chunk[is_representative].assign(sample_key=sample_keys[is_representative])
+        groups = chunk.groupby(stratify_by, observed=True, sort=False) if stratify_by else [((), chunk)]
+
+        for stratum, group in groups:
+            stratum = stratum if isinstance(stratum, tuple) else (stratum,)
+            threshold = reservoir.threshold(stratum)
+            if threshold is not None:
+                # Vectorized pre-filter: only studies that could enter the reservoir reach Python
+                group = group[group['sample_key'] < threshold]
+            for row in group.sort_values('sample_key').itertuples(index=False):
+                reservoir.offer(stratum, int(row.sample_key), row.study_id, row.image_id)
+
+    print(f"Scanned {total_rows} rows twice in chunks of {chunksize}.")
+    return reservoir.samples()
+
+def create_stratified_image_list(csv_path, output_path, per_stratum, random_state, stratify_by=(),
+                                 laterality=LATERALITY, view_position=VIEW_POSITION, chunksize=CHUNK_SIZE):
+    """
+    Streams the CSV, samples per stratum, and writes image paths to a text file.
+    """
+    if not csv_path.is_file():
+        print(f"Error: Annotation file not found at {csv_path}")
+        return
+
+    print(f"Streaming annotations from {csv_path}, stratified by {list(stratify_by) or 'nothing'}...")
+    try:
+        samples = stream_stratified_sample(
+            csv_path, per_stratum, random_state, stratify_by,
+            laterality=laterality, view_position=view_position, chunksize=chunksize,
+        )
+    except (OSError, ValueError) as e:
+        print(f"An error occurred while reading the CSV: {e}")
+        return
+
+    counts = {}
+    for stratum, _, _ in samples:
+        counts[stratum] = counts.get(stratum, 0) + 1
+    for stratum, count in counts.items():
+        label = ", ".join(f"{c}={v}" for c, v in zip(stratify_by, stratum)) or "all"
+        if count < per_stratum:
+            print(f"Warning: Stratum ({label}) only has {count} unique studies, fewer than {per_stratum}.")
+        else:
+            print(f"  - Stratum ({label}): {count} studies")
+
+    print(f"Writing image list to {output_path}...")
+    try:
+        with open(output_path, 'w', encoding='utf-8') as f:
+            for _, study_id, image_id in samples:
+                f.write(f"images/{study_id}/{image_id}.dicom\n")
+    except IOError as e:
+        print(f"Error writing to output file {output_path}: {e}")
+        return
+
+    print(f"Successfully wrote {len(samples)} image paths to {output_path}")
+
 def main():
     """Main function to run the script."""
-    create_image_list_from_csv(CSV_PATH, OUTPUT_FILE_PATH, SAMPLE_SIZE, RANDOM_STATE)
+    args = get_arguments()
+    if args.streaming:
+        create_stratified_image_list(
+            args.csv_path,
+            args.output_path,
+            args.sample_size,
+            args.random_state,
+            stratify_by=args.stratify_by,
+            laterality=args.laterality,
+            view_position=args.view_position,
+            chunksize=args.chunksize,
+        )
+        return
+
+    create_image_list_from_csv(
+        args.csv_path,
+        args.output_path,
+        args.sample_size,
+        args.random_state,
+        laterality=args.laterality,
+        view_position=args.view_position,
+        use_cache=not args.no_cache,
+    )
 
 if __name__ == "__main__":
     main()
@@ -0,0 +1,240 @@
+"""
+template_drafting.py
+Speculative drafts for the fine-tune's templated answers.
+
+Answers follow one of the RESPONSE_TEMPLATES sentences and end with a fixed
+clinical action, so most answer tokens follow from the last few. TemplateDrafter
+indexes the token n-grams of every rendered template and proposes the
+continuation all templates agree on. transformers' assisted decoding checks the
+draft in one forward pass and keeps the longest prefix that greedy decoding
+would have produced, so the output is the same as plain greedy generation.
+"""
+
+import itertools
+import logging
+
+from inference_metrics import speculative_tokens_per_step
+from report_fields import CLINICAL_ACTIONS, DEFAULT_CLINICAL_ACTION, RESPONSE_TEMPLATES
+
+MAX_NGRAM_SIZE = 3
+NUM_DRAFT_TOKENS = 10
+ACR_VALUES = ("1", "2", "3", "4")
+# Two different findings, so nothing is ever drafted in place of the real findings
+FINDINGS_SAMPLES = ("mass", "calcifications")
+# Release whose private candidate-generator factory install_speculation hooks into
+TRANSFORMERS_MAJOR_VERSION = 5
+# Image inputs and encoder outputs of the vision model, dropped from the draft model's kwargs
+VISION_MODEL_KWARGS = ("pixel_values", "pixel_attention_mask", "spatial_shapes", "image_sizes", "mm_encoder_outputs")
+
+
+def render_template_corpus():
+    """Every template rendered with every ACR value, BI-RADS category and sample finding."""
+    texts = []
+    for template, (birads, action), acr, findings in itertools.product(
+        RESPONSE_TEMPLATES, CLINICAL_ACTIONS.items(), ACR_VALUES, FINDINGS_SAMPLES
+    ):
+        texts.append(template.format(findings=findings, acr=acr, birads=birads, clinical_action=action))
+    for template, acr, findings in itertools.product(RESPONSE_TEMPLATES, ACR_VALUES, FINDINGS_SAMPLES):
+        texts.append(template.format(findings=findings, acr=acr, birads="?", clinical_action=DEFAULT_CLINICAL_ACTION))
+    return texts
+
+
+class TemplateDrafter:
+    """
+    Maps every n-gram (n <= max_ngram_size) of the tokenized templates to the tokens
+    that follow it, truncated to the prefix shared by all of its occurrences.
+    """
+
+    def __init__(self, tokenizer, max_ngram_size=MAX_NGRAM_SIZE, num_draft_tokens=NUM_DRAFT_TOKENS, texts=None,
+                 blocked_token_ids=()):
+        self.max_ngram_size = max_ngram_size
+        self.num_draft_tokens = num_draft_tokens
+        # Drafts are cut before these; an <image> token copied from the prompt would
+        # otherwise be verified against image features that do not exist
+        self.blocked_token_ids = set(tokenizer.all_special_ids) | set(blocked_token_ids)
+        self.table = {}
+        for text in texts if texts is not None else render_template_corpus():
+            self._add(tokenizer(text, add_special_tokens=False)["input_ids"])
+
+    def _add(self, token_ids):
+        for n in range(1, self.max_ngram_size + 1):
+            for i in range(len(token_ids) - n):
+                key = tuple(token_ids[i:i + n])
+                continuation = tuple(token_ids[i + n:i + n + self.num_draft_tokens])
+                existing = self.table.get(key)
+                if existing is None:
+                    self.table[key] = continuation
+                elif existing != continuation:
+                    common = 0
+                    while common < min(len(existing), len(continuation)) and existing[common] == continuation[common]:
+                        common += 1
+                    self.table[key] = existing[:common]
+
+    def draft(self, token_ids):
+        """Tokens the templates predict after token_ids (longest matching n-gram first)."""
+        token_ids = list(token_ids)
+        for n in range(min(self.max_ngram_size, len(token_ids)), 0, -1):
+            continuation = self.table.get(tuple(token_ids[-n:]))
+            if continuation:
+                return list(continuation)
+        return []
+
+
+class SpeculationStats:
+    """Verification steps and drafted/accepted token counts of one generate() call."""
+
+    def __init__(self):
+        self.steps = 0
+        self.draft_tokens = 0
+        self.accepted_tokens = 0
+
+    def record_step(self, input_ids, candidate_input_ids):
+        self.steps += 1
+        self.draft_tokens += candidate_input_ids.shape[1] - input_ids.shape[1]
+
+    @property
+    def tokens_per_step(self):
+        return speculative_tokens_per_step(self.accepted_tokens, self.steps)
+
+
+class TemplateCandidateGenerator:
+    """
+    Candidate generator for transformers' assisted decoding. Drafts come from the
+    templates, falling back to regular prompt lookup when the templates have none.
+    """
+
+    requires_model_outputs = False
+
+    def __init__(self, drafter, fallback, max_length, stats):
+        self.drafter = drafter
+        self.fallback = fallback
+        self.max_length = max_length
+        self.stats = stats
+
+    def get_candidates(self, input_ids, **kwargs):
+        import torch
+
+        # Leave room for the token the target model adds after the draft
+        room = self.max_length - input_ids.shape[1] - 1
+        draft = self.drafter.draft(input_ids[0, -self.drafter.max_ngram_size:].tolist())[:max(room, 0)]
+        if draft:
+            draft_ids = torch.tensor([draft], dtype=input_ids.dtype, device=input_ids.device)
+            candidate_input_ids = torch.cat([input_ids, draft_ids], dim=1)
+        else:
+            candidate_input_ids, _ = self.fallback.get_candidates(input_ids, **kwargs)
+            for offset, token_id in enumerate(candidate_input_ids[0, input_ids.shape[1]:].tolist()):
+                if token_id in self.drafter.blocked_token_ids:
+                    candidate_input_ids = candidate_input_ids[:, :input_ids.shape[1] + offset]
+                    break
+
+        self.stats.record_step(input_ids, candidate_input_ids)
+        return candidate_input_ids, None
+
+    def update_candidate_strategy(self, input_ids, scores, num_matches):
+        self.stats.accepted_tokens += int(num_matches)
+        self.fallback.update_candidate_strategy(input_ids, scores, num_matches)
+
+
+def record_assisted_stats(candidate_generator, stats):
+    """
+    Count steps and accepted tokens of a draft-model candidate generator. Its methods
+    are wrapped on the instance rather than the generator replaced, because generate()
+    checks isinstance(..., AssistedCandidateGenerator) to carry the draft length over.
+    """
+    get_candidates = candidate_generator.get_candidates
+    update_candidate_strategy = candidate_generator.update_candidate_strategy
+
+    def counting_get_candidates(input_ids, **kwargs):
+        candidate_input_ids, candidate_logits = get_candidates(input_ids, **kwargs)
+        stats.record_step(input_ids, candidate_input_ids)
+        return candidate_input_ids, candidate_logits
+
+    def counting_update_candidate_strategy(input_ids, scores, num_matches):
+        stats.accepted_tokens += int(num_matches)
+        update_candidate_strategy(input_ids, scores, num_matches)
+
+    candidate_generator.get_candidates = counting_get_candidates
+    candidate_generator.update_candidate_strategy = counting_update_candidate_strategy
+
+
+class SpeculationHook:
+    """Holds the SpeculationStats of the model's last assisted generate() call."""
+
+    def __init__(self, drafter=None):
+        self.drafter = drafter
+        self.last_stats = None
+
+    def wrap(self, candidate_generator, prompt_lookup_class, assisted_class):
+        if self.drafter is not None and isinstance(candidate_generator, prompt_lookup_class):
+            self.last_stats = SpeculationStats()
+            return TemplateCandidateGenerator(
+                self.drafter, candidate_generator, candidate_generator.max_length, self.last_stats
+            )
+        if isinstance(candidate_generator, assisted_class):
+            # The draft model is text-only; it must not be handed the image inputs or features
+            for key in VISION_MODEL_KWARGS:
+                candidate_generator.assistant_kwargs.pop(key, None)
+            self.last_stats = SpeculationStats()
+            record_assisted_stats(candidate_generator, self.last_stats)
+        return candidate_generator
+
+
+def install_speculation(model, drafter=None):
+    """
+    Hook the model's candidate-generator factory on this instance only: with a drafter,
+    generate(prompt_lookup_num_tokens=...) drafts from the templates; with
+    generate(assistant_model=...) the vision inputs are kept from the draft model.
+    Both record their SpeculationStats on the returned hook.
+    transformers has no public hook for this, so versions other than the tested major
+    release, or without the factory, get None and the caller falls back to plain greedy.
+    """
+    import transformers
+
+    major_version = int(transformers.__version__.split(".")[0])
+    try:
+        from transformers.generation.candidate_generator import (
+            AssistedCandidateGenerator,
+            PromptLookupCandidateGenerator,
+        )
+    except ImportError:
+        AssistedCandidateGenerator = PromptLookupCandidateGenerator = None
+    original = getattr(model, "_get_candidate_generator", None)
+    if major_version != TRANSFORMERS_MAJOR_VERSION or original is None or AssistedCandidateGenerator is None:
+        logging.warning(
+            f"Speculative decoding is only wired up for transformers {TRANSFORMERS_MAJOR_VERSION}.x "
+            f"(found {transformers.__version__}); decoding without it"
+        )
+        return None
+
+    hook = SpeculationHook(drafter)
+
+    def get_candidate_generator(*args, **kwargs):
+        hook.last_stats = None
+        return hook.wrap(original(*args, **kwargs), PromptLookupCandidateGenerator, AssistedCandidateGenerator)
+
+    model._get_candidate_generator = get_candidate_generator
+    return hook
+
+
+def simulate_acceptance(drafter, answers_token_ids):
+    """
+    Replay greedy verification against known answers (e.g. training targets or
+    previous model outputs), assuming the model produces exactly those tokens.
+
+    Returns:
+        SpeculationStats: steps and tokens accepted if the model produced these answers
+    """
+    stats = SpeculationStats()
+    for token_ids in answers_token_ids:
+        position = 0
+        while position < len(token_ids):
+            draft = drafter.draft(token_ids[:position])
+            accepted = 0
+            while accepted < len(draft) and position + accepted < len(token_ids) - 1 \
+                    and draft[accepted] == token_ids[position + accepted]:
+                accepted += 1
+            stats.steps += 1
+            stats.draft_tokens += len(draft)
+            stats.accepted_tokens += accepted
+            position += accepted + 1
+    return stats
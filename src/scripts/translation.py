@@ -1,8 +1,12 @@
 """
 This script translates medical findings from a CSV file from Portuguese to English
 using the Gemini API, processing the data sequentially to respect API rate limits.
+Finished rows are appended to a journal, so a re-run resumes where the last one stopped
+and only retries rows that failed.
 """
 
+import hashlib
+import json
 import os
 import time
 from pathlib import Path
@@ -16,6 +20,8 @@ SCRIPT_DIR = Path(__file__).resolve().parent
 SRC_DIR = SCRIPT_DIR.parent
 INPUT_CSV_PATH = SRC_DIR / "data/inbreast-csv.csv"
 OUTPUT_CSV_PATH = INPUT_CSV_PATH.with_name(f"{INPUT_CSV_PATH.stem}_translated.csv")
+# Append-only log of finished rows so an interrupted run can resume where it stopped
+JOURNAL_PATH = INPUT_CSV_PATH.with_name(f"{INPUT_CSV_PATH.stem}_translated.journal.jsonl")
 
 COLUMN_TO_TRANSLATE = 'Findings Notes (in Portuguese)'
 TRANSLATED_COLUMN_NAME = 'Findings Notes (English)'
@@ -199,6 +205,70 @@ def translate_text(client: genai.Client, text: str, retry_count: int = 0):
         print(f"    Error: Translation failed for '{cleaned_text[:30]}...' after {MAX_RETRIES} retries: {e}")
         return "[Translation Error]", True
 
+def source_hash(text):
+    """Short hash of the cleaned source text, stored with each journal record."""
+    return hashlib.sha256(clean_input_text(text).encode('utf-8')).hexdigest()[:16]
+
+def load_journal(journal_path):
+    """
+    Reads completed translations from the journal.
+    Returns a dict mapping row index to its record ({'translation', 'source'});
+    later lines win over earlier ones.
+    """
+    completed = {}
+    if not journal_path.is_file():
+        return completed
+
+    with open(journal_path, 'r', encoding='utf-8') as f:
+        for line_number, line in enumerate(f, 1):
+            line = line.strip()
+            if not line:
+                continue
+            try:
+                record = json.loads(line)
+                completed[int(record['row'])] = {'translation': record['translation'], 'source': record.get('source')}
+            except (ValueError, KeyError, TypeError):
+                # A crash mid-write can leave a truncated last line; that row is simply redone
+                print(f"    Warning: Ignoring malformed journal line {line_number}.")
+
+    return completed
+
+def open_journal(journal_path):
+    """
+    Opens the journal for appending. A crash mid-write can leave a last line
+    without a newline; it is terminated first so the next record starts on its own line.
+    """
+    if journal_path.is_file() and journal_path.stat().st_size > 0:
+        with open(journal_path, 'rb+') as f:
+            f.seek(-1, os.SEEK_END)
+            if f.read(1) != b"\n":
+                f.write(b"\n")
+    return open(journal_path, 'a', encoding='utf-8')
+
+def append_to_journal(journal_file, row_index, translation, source_text):
+    """Appends one finished translation to the journal and flushes it to disk."""
+    record = {'row': row_index, 'source': source_hash(source_text), 'translation': translation}
+    journal_file.write(json.dumps(record, ensure_ascii=False) + "\n")
+    journal_file.flush()
+    os.fsync(journal_file.fileno())
+
+def get_journaled_translation(completed, row_index, source_text):
+    """
+    The journaled translation of a row, or None if there is none or it was made
+    from different source text (the input CSV was edited or reordered since).
+    """
+    record = completed.get(row_index)
+    if record is None or record['source'] != source_hash(source_text):
+        return None
+    return record['translation']
+
+def is_row_done(completed, row_index, source_text):
+    """A row is done if it has a matching journaled translation that is not an error marker."""
+    translation = get_journaled_translation(completed, row_index, source_text)
+    if translation is None:
+        return False
+    return translation == "" or validate_translation_output(translation)
+
 def main():
     """Main function to orchestrate the translation process."""
     client = configure_llm()
@@ -218,22 +288,41 @@ def main():
     
     notes_to_translate = df[COLUMN_TO_TRANSLATE].tolist()
     total_rows = len(notes_to_translate)
-    all_translations = []
 
-    print(f"Starting sequential translation of {total_rows} rows...")
+    completed = load_journal(JOURNAL_PATH)
+    stale_rows = sum(
+        1 for i in range(total_rows)
+        if i in completed and get_journaled_translation(completed, i, notes_to_translate[i]) is None
+    )
+    if stale_rows:
+        print(f"Warning: {stale_rows} journaled rows no longer match the input text and will be translated again.")
+    pending_rows = [i for i in range(total_rows) if not is_row_done(completed, i, notes_to_translate[i])]
+    if completed:
+        print(f"Resuming from {JOURNAL_PATH}: {total_rows - len(pending_rows)} rows already done, {len(pending_rows)} remaining.")
+
+    print(f"Starting sequential translation of {len(pending_rows)} rows...")
     
-    for i, note in enumerate(notes_to_translate):
-        print(f"  - Processing row {i + 1}/{total_rows}...")
-        
-        translation, llm_used = translate_text(client, note)
-        print(f"    -> Row {i + 1} Translation: {translation}")
-        all_translations.append(translation)
-        
-        # Respect the rate limit before the next request, only if LLM was used
-        if llm_used and i < total_rows - 1:
-            time.sleep(REQUEST_DELAY)
+    with open_journal(JOURNAL_PATH) as journal_file:
+        for position, i in enumerate(pending_rows):
+            print(f"  - Processing row {i + 1}/{total_rows}...")
+            
+            translation, llm_used = translate_text(client, notes_to_translate[i])
+            print(f"    -> Row {i + 1} Translation: {translation}")
+            completed[i] = {'translation': translation, 'source': source_hash(notes_to_translate[i])}
+            append_to_journal(journal_file, i, translation, notes_to_translate[i])
+            
+            # Respect the rate limit before the next request, only if LLM was used
+            if llm_used and position < len(pending_rows) - 1:
+                time.sleep(REQUEST_DELAY)
             
     print("Translation complete.")
+
+    # A blank source row is journaled as "" and must stay empty rather than become an error
+    all_translations = [
+        t if (t := get_journaled_translation(completed, i, notes_to_translate[i])) is not None
+        else "[Translation Error]"
+        for i in range(total_rows)
+    ]
     
     # Validation statistics
     successful_translations = sum(1 for t in all_translations if validate_translation_output(t))
@@ -250,8 +339,13 @@ def main():
     
     print(f"\nSaving translated data to {OUTPUT_CSV_PATH}...")
     try:
-        df.to_csv(OUTPUT_CSV_PATH, index=False, encoding='utf-8')
+        # Write to a temporary file first so a crash never leaves a half-written CSV
+        tmp_output_path = OUTPUT_CSV_PATH.with_name(OUTPUT_CSV_PATH.name + ".tmp")
+        df.to_csv(tmp_output_path, index=False, encoding='utf-8')
+        os.replace(tmp_output_path, OUTPUT_CSV_PATH)
         print(f"Successfully saved translated file to {OUTPUT_CSV_PATH}")
+        if failed_translations:
+            print(f"Kept journal at {JOURNAL_PATH}; re-run to retry the {failed_translations} failed rows.")
     except IOError as e:
         print(f"Error saving file: {e}")
 